@@ -0,0 +1,399 @@
+import os, asyncio, functools, weakref
+import numpy as np
+from .utils import *
+from .pfunc import pfunc, pfunc_vienna_command_, pfunc_vienna_result_, pfunc_contrafold_command_, pfunc_contrafold_result_, \
+    pfunc_rnastructure_command_, rnastructure_energy_command_, pfunc_rnastructure_result_, rnasoft_command_, \
+    pfunc_rnasoft_result_, rnasoft_pair_lines_, nupack_command_, pfunc_nupack_result_, vfold_command_, pfunc_vfold_result_
+from .bpps import bpps, bpps_vienna_, bpps_contrafold_, bpps_nupack_output_, bpps_nupack_result_, \
+    bpps_rnastructure_command_, bpps_rnastructure_result_, bpps_vfold_result_
+from .sparse import triples_to_bpps
+from .parsers import parse_rnasoft_pairs
+from .mfe import mfe, mfe_vienna_command_, mfe_vienna_result_, mfe_contrafold_command_, mfe_contrafold_result_
+from .sample_structures import sample_structures, sample_vienna_command_, sample_vienna_result_
+
+DEBUG=False
+
+# max number of folding jobs running at once per event loop, default os.cpu_count()
+MAX_CONCURRENCY=None
+
+_semaphores = weakref.WeakKeyDictionary()
+
+def set_max_concurrency(n):
+    '''Set how many folding jobs may run at once on each event loop.
+
+    Takes effect for event loops that have not started a job yet.
+
+    Args:
+    n (int): max concurrent jobs, None for os.cpu_count()
+    '''
+    global MAX_CONCURRENCY
+    MAX_CONCURRENCY = n
+    _semaphores.clear()
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY or os.cpu_count() or 1)
+    return _semaphores[loop]
+
+async def _run(command, stdin=None, cwd=None, timeout=None, cleanup=()):
+    '''Run one folding binary without blocking the event loop.
+
+    If the call is cancelled or times out, the child is killed and the files in
+    `cleanup` are removed before the error propagates.
+
+    Returns
+        int, bytes, bytes: return code, stdout, stderr
+    '''
+    if DEBUG: print(' '.join(command))
+
+    async with _semaphore():
+        proc = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(
+                input=stdin.encode('utf-8') if stdin is not None else None), timeout)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+            remove_files(*cleanup)
+            raise
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    return proc.returncode, stdout, stderr
+
+async def _run_blocking(func, *args, timeout=None, **kwargs):
+    '''Run a blocking in-process arnie call (arnie_np) on the default executor, under the same
+    concurrency limit. Cancelling or timing out stops the wait; the computation runs to completion.
+    '''
+    async with _semaphore():
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(None, functools.partial(func, *args, **kwargs)), timeout)
+
+def _split_package(package):
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+    return pkg, version
+
+async def apfunc(seq, package='vienna_2', T=37,
+    constraint=None, motif=None,
+    dangles=True, noncanonical=False,
+    bpps=False, param_file=None, coaxial=True, reweight=None, return_free_energy=False, timeout=None):
+    ''' Compute partition function for RNA sequence, as a coroutine.
+
+    Package binaries run as asyncio subprocesses, killed (and their temp files removed) if
+    the call is cancelled or times out; arnie_np runs `pfunc` on the default executor.
+
+        Args:
+        timeout (float): seconds before the call is abandoned with asyncio.TimeoutError
+        (remaining args as in `pfunc`)
+
+    Returns
+        float: Z (or free energy), or Z and the temp file name if bpps
+    '''
+    pkg, version = _split_package(package)
+
+    if not bpps and pkg!='arnie': # if bpps, already printed these warnings
+        if not dangles and pkg not in ['vienna', 'nupack']:
+            print('Warning: %s does not support dangles options' % pkg)
+        if not coaxial and pkg not in ['rnastructure', 'vfold']:
+            print('Warning: %s does not support coaxial options' % pkg)
+
+    if pkg=='vienna':
+        command, stdin, output_dot_ps_file = pfunc_vienna_command_(seq, T=T, version=version, constraint=constraint,
+            motif=motif, param_file=param_file, dangles=dangles, bpps=bpps, reweight=reweight)
+
+        returncode, stdout, stderr = await _run(command, stdin=stdin, cwd=scratch_dir(), timeout=timeout,
+            cleanup=[output_dot_ps_file])
+
+        if returncode:
+            remove_files(output_dot_ps_file)
+            raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
+
+        Z, tmp_file = pfunc_vienna_result_(stdout, stderr, output_dot_ps_file, T=T, return_free_energy=return_free_energy)
+
+    elif pkg=='contrafold':
+        command, fname, posterior_fname = pfunc_contrafold_command_(seq, version=version, constraint=constraint,
+            bpps=bpps, param_file=param_file)
+
+        try:
+            returncode, stdout, stderr = await _run(command, timeout=timeout, cleanup=[posterior_fname])
+        finally:
+            remove_files(fname)
+
+        if returncode:
+            remove_files(posterior_fname)
+            raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+
+        Z, tmp_file = pfunc_contrafold_result_(stdout, posterior_fname)
+
+    elif pkg=='rnastructure':
+        # two binaries in a row; the timeout covers both
+        Z, tmp_file = await asyncio.wait_for(_pfunc_rnastructure(seq, T=T, constraint=constraint, coaxial=coaxial,
+            bpps=bpps), timeout)
+
+    elif pkg=='rnasoft':
+        if constraint is not None:
+            print("ERROR: RNAsoft is unable to handle constraints for calculating partition functions, returning unconstrained Z.")
+
+        returncode, stdout, stderr = await _run(rnasoft_command_(seq, version=version), timeout=timeout)
+
+        if returncode:
+            raise Exception('RNAsoft partition failed: on %s\n%s' % (seq, stderr))
+
+        Z, tmp_file = pfunc_rnasoft_result_(stdout.decode('utf-8'), bpps=bpps)
+
+    elif pkg=='nupack':
+        command, seqfile = nupack_command_('pfunc', seq, version=version, T=T, dangles=dangles)
+
+        try:
+            returncode, stdout, stderr = await _run(command, timeout=timeout)
+        finally:
+            remove_files(seqfile)
+
+        if returncode:
+            raise Exception('Nupack pfunc failed: on %s\n%s' % (seq, stderr))
+
+        Z, tmp_file = pfunc_nupack_result_(stdout), None
+
+    elif pkg=='vfold':
+        command, DIR, seqfile, outfile = vfold_command_('VfoldThermal', seq, version=version, T=T, coaxial=coaxial)
+
+        try:
+            #vfold precompiled binaries don't work being called from elsewhere
+            returncode, stdout, stderr = await _run(command, cwd=DIR, timeout=timeout, cleanup=[outfile])
+        finally:
+            remove_files(seqfile)
+
+        if returncode:
+            remove_files(outfile)
+            raise Exception('VfoldThermal_npk failed: on %s\n%s' % (seq, stderr))
+
+        Z, tmp_file = pfunc_vfold_result_(outfile), None
+        remove_files(outfile)
+
+    elif pkg=='arnie':
+        return await _run_blocking(pfunc, seq, package=package, T=T, constraint=constraint, motif=motif,
+            dangles=dangles, noncanonical=noncanonical, bpps=bpps, param_file=param_file, coaxial=coaxial,
+            reweight=reweight, return_free_energy=return_free_energy, timeout=timeout)
+
+    else:
+        raise ValueError('package %s not understood.' % package)
+
+    if bpps:
+        return Z, tmp_file
+    else:
+        remove_files(tmp_file)
+        return Z
+
+async def _pfunc_rnastructure(seq, T=37, constraint=None, coaxial=True, bpps=False):
+    '''RNAstructure partition, then EnsembleEnergy unless bpps; the .pfs file is removed if either fails or is cancelled'''
+    command, seqfile, pfsfile, fname = pfunc_rnastructure_command_(seq, T=T, constraint=constraint, coaxial=coaxial)
+
+    try:
+        try:
+            returncode, stdout, stderr = await _run(command)
+        finally:
+            remove_files(seqfile, fname)
+
+        if returncode:
+            raise Exception('RNAstructure partition failed: on %s\n%s' % (seq, stderr))
+
+        if bpps:
+            return 0, pfsfile
+
+        returncode, stdout, stderr = await _run(rnastructure_energy_command_(pfsfile))
+
+        if returncode:
+            raise Exception('RNAstructure EnsembleEnergy failed: on %s\n%s' % (seq, stderr))
+
+    except BaseException:
+        remove_files(pfsfile)
+        raise
+
+    return pfunc_rnastructure_result_(stdout, T=T), pfsfile
+
+async def abpps(sequence, package='vienna', constraint=None, T=37, coaxial=True, dangles=True, param_file=None, reweight=None,
+    sparse=False, threshold=0, timeout=None):
+    ''' Compute base pairing probability matrix for RNA sequence, as a coroutine.
+
+    Package binaries run as asyncio subprocesses, killed (and their temp files removed) if
+    the call is cancelled or times out; arnie_np runs `bpps` on the default executor.
+
+    Args:
+    timeout (float): seconds before the call is abandoned with asyncio.TimeoutError
+    (remaining args as in `bpps`)
+
+    Returns
+    array: NxN matrix of base pair probabilities (SparseBPPs if sparse)
+    '''
+    pkg, version = _split_package(package)
+
+    if pkg!='arnie':
+        if not dangles and pkg not in ['vienna','nupack']:
+            print('Warning: %s does not support dangles options' % pkg)
+        if not coaxial and pkg not in ['rnastructure','vfold']:
+            print('Warning: %s does not support coaxial options' % pkg)
+
+    if pkg=='vienna':
+        _, tmp_file = await apfunc(sequence, package=package, bpps=True, constraint=constraint, T=T,
+            dangles=dangles, param_file=param_file, reweight=reweight, timeout=timeout)
+        return bpps_vienna_(sequence, tmp_file, sparse=sparse, threshold=threshold)
+
+    elif pkg=='contrafold':
+        _, tmp_file = await apfunc(sequence, package=package, bpps=True, constraint=constraint, T=T,
+            param_file=param_file, timeout=timeout)
+        return bpps_contrafold_(sequence, tmp_file, sparse=sparse, threshold=threshold)
+
+    elif pkg=='rnastructure':
+        return await asyncio.wait_for(_bpps_rnastructure(sequence, T=T, constraint=constraint, coaxial=coaxial,
+            sparse=sparse, threshold=threshold), timeout)
+
+    elif pkg=='rnasoft':
+        returncode, stdout, stderr = await _run(rnasoft_command_(sequence, version=version), timeout=timeout)
+
+        if returncode:
+            raise Exception('RNAsoft partition failed: on %s\n%s' % (sequence, stderr))
+
+        i, j, p = parse_rnasoft_pairs('\n'.join(rnasoft_pair_lines_(stdout.decode('utf-8'))))
+        return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
+
+    elif pkg=='nupack':
+        command, seqfile = nupack_command_('pairs', sequence, version=version, T=T, dangles=dangles)
+        ppairs_file = bpps_nupack_output_(seqfile)
+
+        try:
+            returncode, stdout, stderr = await _run(command, timeout=timeout, cleanup=[ppairs_file])
+        finally:
+            remove_files(seqfile)
+
+        if returncode:
+            remove_files(ppairs_file)
+            raise Exception('Nupack pfunc failed: on %s\n%s' % (sequence, stderr))
+
+        return bpps_nupack_result_(sequence, ppairs_file, sparse=sparse, threshold=threshold)
+
+    elif pkg=='vfold':
+        command, DIR, seqfile, outfile = vfold_command_('Vfold2d', sequence, version=version, T=T, coaxial=coaxial)
+
+        try:
+            #vfold precompiled binaries don't work being called from elsewhere
+            returncode, stdout, stderr = await _run(command, cwd=DIR, timeout=timeout, cleanup=[outfile])
+        finally:
+            remove_files(seqfile)
+
+        if returncode:
+            remove_files(outfile)
+            raise Exception('Vfold2d_npk failed: on %s\n%s' % (sequence, stderr))
+
+        return bpps_vfold_result_(sequence, outfile, sparse=sparse, threshold=threshold)
+
+    elif pkg=='arnie':
+        return await _run_blocking(bpps, sequence, package=package, constraint=constraint, T=T, coaxial=coaxial,
+            dangles=dangles, param_file=param_file, reweight=reweight, sparse=sparse, threshold=threshold, timeout=timeout)
+
+    else:
+        raise ValueError('package %s not understood.' % package)
+
+async def _bpps_rnastructure(sequence, T=37, constraint=None, coaxial=True, sparse=False, threshold=0):
+    '''RNAstructure partition, then ProbabilityPlot of its .pfs file'''
+    _, pfsfile = await _pfunc_rnastructure(sequence, T=T, constraint=constraint, coaxial=coaxial, bpps=True)
+    command, outfile = bpps_rnastructure_command_(pfsfile)
+
+    try:
+        returncode, stdout, stderr = await _run(command, cleanup=[outfile])
+    except BaseException:
+        remove_files(pfsfile)
+        raise
+
+    if returncode:
+        remove_files(pfsfile, outfile)
+        raise Exception('RNAstructure ProbabilityPlot failed: on %s\n%s' % (sequence, stderr))
+
+    return bpps_rnastructure_result_(sequence, pfsfile, outfile, sparse=sparse, threshold=threshold)
+
+async def amfe(seq, package='vienna_2', T=37,
+    constraint=None, motif=None,
+    dangles=True, noncanonical=False,
+    bpps=False, param_file=None, coaxial=True, reweight=None, viterbi=False, timeout=None):
+    ''' Compute MFE structure (within package) for RNA sequence, as a coroutine.
+
+        Args:
+        timeout (float): seconds before the call is abandoned with asyncio.TimeoutError
+        (remaining args as in `mfe`)
+
+    Returns
+        string: MFE structure
+    '''
+    pkg, version = _split_package(package)
+
+    if pkg=='vienna':
+        command, stdin = mfe_vienna_command_(seq, T=T, version=version, constraint=constraint, motif=motif,
+            param_file=param_file, dangles=dangles, reweight=reweight)
+
+        returncode, stdout, stderr = await _run(command, stdin=stdin, cwd=scratch_dir(), timeout=timeout)
+
+        if returncode:
+            raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
+
+        return mfe_vienna_result_(stdout, stderr)
+
+    elif pkg=='contrafold':
+        if not bpps:
+            if not dangles:
+                print('Warning: %s does not support dangles options' % pkg)
+            if not coaxial:
+                print('Warning: %s does not support coaxial options' % pkg)
+
+        command, fname = mfe_contrafold_command_(seq, version=version, constraint=constraint,
+            param_file=param_file, viterbi=viterbi)
+
+        try:
+            returncode, stdout, stderr = await _run(command, timeout=timeout)
+        finally:
+            remove_files(fname)
+
+        if returncode:
+            raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+
+        return mfe_contrafold_result_(stdout)
+
+    else:
+        return await _run_blocking(mfe, seq, package=package, T=T, constraint=constraint, motif=motif,
+            dangles=dangles, noncanonical=noncanonical, bpps=bpps, param_file=param_file, coaxial=coaxial,
+            reweight=reweight, viterbi=viterbi, timeout=timeout)
+
+async def asample_structures(seq, n_samples=10, package='vienna_2', T=37, constraint=None,
+    dangles=True, reweight=None, nonredundant=False, timeout=None):
+    ''' Draw stochastic sampled structures for RNA sequence, as a coroutine. Possible packages: 'vienna_1', 'vienna_2'
+
+        Args:
+        timeout (float): seconds before the call is abandoned with asyncio.TimeoutError
+        (remaining args as in `sample_structures`)
+
+    Returns
+        list of structures
+    '''
+    pkg, version = _split_package(package)
+
+    if pkg=='vienna':
+        command, stdin = sample_vienna_command_(seq, n_samples=n_samples, T=T, version=version, constraint=constraint,
+            dangles=dangles, reweight=reweight, nonredundant=nonredundant)
+
+        returncode, stdout, stderr = await _run(command, stdin=stdin, timeout=timeout)
+
+        if returncode:
+            raise Exception('RNAsubopt failed: on %s\n%s' % (seq, stderr))
+
+        return sample_vienna_result_(stdout, stderr)
+
+    else:
+        raise ValueError('package %s either not understood or not supported at this moment.' % package)
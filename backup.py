@@ -1,3 +1,7 @@
+import re
+import numpy as np
+from .utils import iter_combo_placements
+
 def combine_constraint(ss_list):
     """ Combines a list of dot-bracket notation secondary structure 
 
@@ -86,7 +90,8 @@ def combo_list_to_dbn_list(seq, final_combo_list, apt_idx_list, apt_ss_list):
     dbn_string_list = []
     for combo in final_combo_list:
         dbn_string=['.']*len(seq)
-        temp = apt_idx_list[combo,:][:,1:3]
+        # a combination of rows of apt_idx_list, or (start, finish) per fragment
+        temp = combo if apt_idx_list is None else apt_idx_list[combo,:][:,1:3]
         
         # Fill in the dbn string with the aptamer ss
         for (start, finish), apt_ss in zip(temp, apt_ss_list):
@@ -129,46 +134,11 @@ def write_combo_constraints(seq, raw_apt_seq, raw_apt_ss, verbose=False):
         print(seq)
         print(raw_apt_seq)
         print(raw_apt_ss)
-    # split everything by +
-    apt_seq_list = raw_apt_seq.split('+')
+    # Walk the feasible combinations of aptamer fragments lazily (see utils.iter_combo_placements)
     apt_ss_list = raw_apt_ss.split('+')
-    if len(apt_seq_list) != len(apt_ss_list):
-        raise ValueError('Missing + in aptamer sequence or secondary structure')
-
-    # Iterate through each aptamer fragment and save its idx,
-    apt_idx_list = []
-    for idx, (apt_seq, apt_ss)  in enumerate(zip(apt_seq_list, apt_ss_list)):
-        if seq.find(apt_seq) == -1:
-            raise ValueError("Aptamer segment {} not found".format(idx+1))
-        if len(apt_seq) != len(apt_ss):
-            raise ValueError("Mismatch between aptamer sequence and aptamer secondary structure")
-
-        # Save all locations of each fragment
-        for m in re.finditer(apt_seq, seq):
-            #Note: cannot get overlapping segments
-            span = m.span()
-            start = span[0]
-            finish = span[1]
-            ss_length = len(apt_seq)
-            apt_idx_list.append([idx, start, finish, ss_length])
-    apt_idx_list = np.array(apt_idx_list)
-
-    # Now combine aptamer fragments into full secondary structure constraints
-    N_frag = len(apt_ss_list) # Number of fragments to stitch together
+    dbn_list = []
+    for spans in iter_combo_placements(seq, raw_apt_seq, raw_apt_ss):
+        dbn_list += combo_list_to_dbn_list(seq, [spans], None, apt_ss_list)
 
-    # Get a list of all possible combination (each combination is a list as well)
-    temp = np.array([np.where(apt_idx_list[:,0] == idx)[0] for idx in range(N_frag)])
-    if len(temp) > 1:
-        combo = np.meshgrid(*temp)
-        combo_list = np.array(combo).T.reshape(-1,N_frag) # reformat the combinations
-    else:
-        combo_list = np.array([[x] for x in temp[0]])
-
-    # Check each combination to make sure it's feasible, if not remove
-    final_combo_list = prune_combo_list(combo_list, apt_idx_list, N_frag)
-    
-    # Convert each combination into a dbn_string
-    dbn_list = combo_list_to_dbn_list(seq, final_combo_list, apt_idx_list, apt_ss_list)
-    
     # List will be empty if nothing can be in order (only for >= 3 fragments)
-    return dbn_list
\ No newline at end of file
+    return dbn_list
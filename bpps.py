@@ -3,14 +3,18 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
-from .pfunc import pfunc
+from .config import package_locs, locate
+from .pfunc import pfunc, pfunc_batch, rnasoft_output_, rnasoft_pair_lines_, vienna_together_, nupack_command_, vfold_command_
+from .parallel import map_ordered
+from .bppstore import fold_conditions
+from . import cache, npfold
+from .sparse import SparseBPPs, triples_to_bpps
+from .parsers import parse_vienna_dot_plot, parse_contrafold_posteriors, parse_rnasoft_pairs, parse_nupack_ppairs, parse_rnastructure_probs, parse_vfold_pij
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
-def bpps(sequence, package='vienna', constraint=None, T=37, coaxial=True, dangles=True,param_file=None,reweight=None):
+@cache.cached('bpps', skip=lambda arguments: arguments['sparse'] or arguments['store'] is not None, together=lambda arguments: vienna_together_(arguments, 'bpps'))
+def bpps(sequence, package='vienna', constraint=None, T=37, coaxial=True, dangles=True,param_file=None,reweight=None,sparse=False,threshold=0,store=None):
     ''' Compute base pairing probability matrix for RNA sequence.
 
     Args:
@@ -21,12 +25,32 @@ def bpps(sequence, package='vienna', constraint=None, T=37, coaxial=True, dangle
     dangles (bool): dangles or not, specifiable for vienna, nupack
     coaxial (bool): coaxial stacking or not, specifiable for rnastructure, vfold
     noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
-
-    Possible packages: 'vienna_2', 'vienna_1','contrafold_1','contrafold_2','nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1'
+    sparse (bool): return a SparseBPPs of (i, j, p) triples instead of the dense matrix, which is never built
+    threshold (float): with sparse, keep only pairs with probability above this
+    store (BPPStore): read the result from this store if it holds the sequence (and constraint),
+        else compute it, append it and return it as stored. A store holds one package and set of
+        conditions, and raises ValueError for others.
+
+    Possible packages: 'vienna_2', 'vienna_1','contrafold_1','contrafold_2','nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1',
+    'arnie_np' (built-in numpy model, see npfold.py)
  
     Returns
-    array: NxN matrix of base pair probabilities
+    array: NxN matrix of base pair probabilities (SparseBPPs if sparse)
   '''
+    if store is not None:
+        conditions = fold_conditions(package, T=T, dangles=dangles, coaxial=coaxial, param_file=param_file, reweight=reweight)
+        store.check(conditions)
+        try:
+            stored = store.get(sequence, constraint=constraint, sparse=sparse)
+        except KeyError:
+            # all pairs go to the store, so its unpaired vector is exact; it applies its own threshold
+            result = bpps(sequence, package=package, constraint=constraint, T=T, coaxial=coaxial, dangles=dangles,
+                param_file=param_file, reweight=reweight, sparse=sparse)
+            store.put(sequence, result, constraint=constraint, conditions=conditions)
+            # hand back what later hits read: the store's dtype and threshold
+            stored = store.get(sequence, constraint=constraint, sparse=sparse)
+        return stored.threshold(threshold) if sparse else stored
+
     try:
         pkg, version = package.lower().split('_')
     except:
@@ -38,124 +62,195 @@ def bpps(sequence, package='vienna', constraint=None, T=37, coaxial=True, dangle
         print('Warning: %s does not support coaxial options' % pkg)
 
     if pkg=='nupack':
-        return bpps_nupack_(sequence, version = version, dangles = dangles, T = T)
+        return bpps_nupack_(sequence, version = version, dangles = dangles, T = T, sparse=sparse, threshold=threshold)
     elif pkg=='vfold':
-    	return bpps_vfold_(sequence, version = version, T = T, coaxial = coaxial)
+    	return bpps_vfold_(sequence, version = version, T = T, coaxial = coaxial, sparse=sparse, threshold=threshold)
+    elif pkg=='rnasoft':
+        return bpps_rnasoft_(sequence, version = version, sparse=sparse, threshold=threshold)
+    elif pkg=='arnie':
+        return bpps_arnie_(sequence, version = version, T = T, constraint = constraint, sparse=sparse, threshold=threshold)
     else:
         _, tmp_file = pfunc(sequence, package=package, bpps=True, constraint=constraint, T=T, coaxial=coaxial, dangles=dangles, param_file=param_file,reweight=reweight)
         if 'contrafold' in package:
-            return bpps_contrafold_(sequence, tmp_file)
+            return bpps_contrafold_(sequence, tmp_file, sparse=sparse, threshold=threshold)
         elif 'vienna' in package:
-            return bpps_vienna_(sequence, tmp_file)
-        elif 'rnasoft' in package:
-            return bpps_rnasoft_(sequence, tmp_file)
+            return bpps_vienna_(sequence, tmp_file, sparse=sparse, threshold=threshold)
         elif 'rnastructure' in package:
-            return bpps_rnastructure_(sequence, tmp_file, coaxial=coaxial)
+            return bpps_rnastructure_(sequence, tmp_file, coaxial=coaxial, sparse=sparse, threshold=threshold)
         else:
             raise RuntimeError('package not yet implemented')
 
-def bpps_vienna_(sequence, tmp_file):
+def bpps_batch(sequences, package='vienna_2', constraints=None, T=37, coaxial=True, dangles=True, param_file=None, reweight=None,
+    sparse=False, threshold=0):
+    ''' Compute base pairing probability matrices for many RNA sequences.
 
-    dot_fname = tmp_file
+    For vienna 2, all sequences are folded by one multi-record `RNAfold -p` run and
+    the per-record dot plots are split back out. Other packages call `bpps` per sequence.
 
-    probs=np.zeros([len(sequence), len(sequence)])
-    with open(dot_fname,'r') as f:
-        for line in f.readlines():
-            if 'ubox' in line:
-                try:
-                    i, j, p, _ = line.split()
-                    i, j, p = int(i)-1, int(j)-1, float(p)**2
-                    probs[i,j] = p
-                    probs[j,i] = p
-                except:
-                    pass
-    os.remove(dot_fname)
-    return probs
+    Args:
+    sequences (list): nucleic acid sequences
+    constraints (list): structure constraint per sequence, None for unconstrained entries
+    (remaining args as in `bpps`)
 
-def bpps_contrafold_(sequence, tmp_file):
+    Returns
+    list of NxN matrices of base pair probabilities (SparseBPPs if sparse), in input order
+    '''
+    sequences = list(sequences)
 
-    fname = tmp_file
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
 
-    probs=np.zeros([len(sequence), len(sequence)])
+    if pkg=='vienna' and (version is None or version.startswith('2')):
+        results = pfunc_batch(sequences, package=package, T=T, constraints=constraints, dangles=dangles,
+            bpps=True, param_file=param_file, reweight=reweight)
+        return [bpps_vienna_(seq, tmp_file, sparse=sparse, threshold=threshold) for seq, (_, tmp_file) in zip(sequences, results)]
 
-    for line in open(fname).readlines():
-        if len(line.split(':')) > 1:
-            first_ind = int(line.split()[0])-1
-            for x in line.split()[2:]:
-                second_ind = int(x.split(':')[0])-1
-                p = float(x.split(':')[1])
-                probs[first_ind, second_ind] = p
-                probs[second_ind, first_ind] = p
+    if constraints is None:
+        constraints = [None]*len(sequences)
+    elif len(constraints) != len(sequences):
+        raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(sequences)))
 
-    os.remove(fname)
+    return [bpps(seq, package=package, constraint=constraint, T=T, coaxial=coaxial, dangles=dangles,
+        param_file=param_file, reweight=reweight, sparse=sparse, threshold=threshold) for seq, constraint in zip(sequences, constraints)]
 
-    return probs
+def bpps_many(sequences, package='vienna_2', constraints=None, n_jobs=None, backend='process', raise_errors=False, **kwargs):
+    ''' Compute base pairing probability matrices for many RNA sequences on a pool of workers.
 
-def bpps_rnasoft_(sequence, tmp_file):
-    fname = tmp_file
+    Args:
+    sequences (list): nucleic acid sequences
+    constraints (list): structure constraint per sequence, None for unconstrained entries
+    n_jobs (int): number of workers, default os.cpu_count()
+    backend (str): 'process' or 'thread'. Large matrices come back from processes through shared memory.
+    raise_errors (bool): raise the first failure instead of returning it in place
+    (remaining keyword args are passed to `bpps`)
+
+    Returns
+    list of NxN matrices in input order; a failed sequence holds the exception it raised
+    '''
+    sequences = list(sequences)
+    if constraints is None:
+        constraints = [None]*len(sequences)
+    elif len(constraints) != len(sequences):
+        raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(sequences)))
+
+    return map_ordered(_bpps_item, list(zip(sequences, constraints)), n_jobs=n_jobs, backend=backend,
+        raise_errors=raise_errors, package=package, **kwargs)
+
+def unpaired_probs(sequences, package='vienna_2', constraints=None, n_jobs=None, **kwargs):
+    ''' Probability that each nucleotide is unpaired, summed straight from the package's (i, j, p)
+    pair list, in O(N + pairs) memory; no NxN matrix (except for packages that only give one).
+
+    Args:
+    sequences (str or list): one sequence, or a batch folded on n_jobs worker processes
+    constraints (str or list): constraint, or one per sequence of a batch
+    (remaining keyword args are passed to `bpps`)
+
+    Returns
+    length-N array, or list of them for a batch
+    '''
+    return _pair_vectors(sequences, 'unpaired', package, constraints, n_jobs, kwargs)
+
+def positional_entropy(sequences, package='vienna_2', constraints=None, n_jobs=None, **kwargs):
+    ''' Positional (Shannon) entropy of each nucleotide's pairing, natural log, from the pair list
+    as in `unpaired_probs`.'''
+    return _pair_vectors(sequences, 'entropy', package, constraints, n_jobs, kwargs)
+
+def expected_partner(sequences, package='vienna_2', constraints=None, n_jobs=None, **kwargs):
+    ''' Probability-weighted mean partner position (0-indexed) of each nucleotide, -1 if it never
+    pairs, from the pair list as in `unpaired_probs`.'''
+    return _pair_vectors(sequences, 'expected_partner', package, constraints, n_jobs, kwargs)
+
+def _pair_vectors(sequences, method, package, constraints, n_jobs, kwargs):
+    if isinstance(sequences, str):
+        return _pair_vector_item((sequences, constraints), method=method, package=package, **kwargs)
+
+    sequences = list(sequences)
+    if constraints is None:
+        constraints = [None]*len(sequences)
+    elif len(constraints) != len(sequences):
+        raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(sequences)))
+
+    # workers send back vectors, not matrices
+    return map_ordered(_pair_vector_item, list(zip(sequences, constraints)), n_jobs=n_jobs, raise_errors=True,
+        method=method, package=package, **kwargs)
+
+def _pair_vector_item(item, method='unpaired', **kwargs):
+    sequence, constraint = item
+    kwargs.setdefault('threshold', 0)
+    return getattr(bpps(sequence, constraint=constraint, sparse=True, **kwargs), method)()
 
-    probs=np.zeros([len(sequence), len(sequence)])
-    for line in open(fname).readlines():
-        i,j,p = int(line.split()[0]), int(line.split()[1]), float(line.split()[2])
-        probs[i,j] = p
-        probs[j,i] = p
+def _bpps_item(item, **kwargs):
+    sequence, constraint = item
+    return bpps(sequence, constraint=constraint, **kwargs)
 
+def bpps_vienna_(sequence, tmp_file, sparse=False, threshold=0):
+
+    dot_fname = tmp_file
+
+    i, j, p = parse_vienna_dot_plot(dot_fname)
+    os.remove(dot_fname)
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
+
+def bpps_contrafold_(sequence, tmp_file, sparse=False, threshold=0):
+
+    fname = tmp_file
+
+    i, j, p = parse_contrafold_posteriors(fname)
     os.remove(fname)
 
-    return probs
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
 
-def bpps_nupack_(sequence, version='95', T=37, dangles=True):
+def bpps_rnasoft_(sequence, version=None, sparse=False, threshold=0):
+    # pair probabilities are read straight from simfold_pf stdout, no temp file
 
-    if not version: version='95'
-    
-    nupack_materials={'95': 'rna1995', '99': 'rna1999'}
+    i, j, p = parse_rnasoft_pairs('\n'.join(rnasoft_pair_lines_(rnasoft_output_(sequence, version=version))))
 
-    DIR = package_locs['nupack']
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
 
-    if dangles:
-        dangle_option='some'
-    else:
-        dangle_option='none'
+def bpps_arnie_(sequence, version='np', T=37, constraint=None, sparse=False, threshold=0):
+    # McCaskill inside/outside of the built-in numpy model, in-process
+    if version not in [None, 'np']:
+        raise ValueError('package arnie_%s not understood, use arnie_np.' % version)
+
+    probs = npfold.fold(sequence, T=T, constraint=constraint)['bpps']
+    if sparse:
+        return SparseBPPs.from_dense(probs, threshold=threshold)
+    return probs
 
-    seqfile = write([sequence])
+def bpps_nupack_(sequence, version=DEFAULT_VERSIONS['nupack'], T=37, dangles=True, sparse=False, threshold=0):
 
-    command=['%s/pairs' % DIR, '%s' % seqfile.replace('.in',''),
-      '-T', str(T), '-material', nupack_materials[version], '-dangles', dangle_option]
+    command, seqfile = nupack_command_('pairs', sequence, version=version, T=T, dangles=dangles)
+    ppairs_file = bpps_nupack_output_(seqfile)
 
+    if DEBUG: print(' '.join(command))
     p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
 
     stdout, stderr = p.communicate()
 
+    remove_files(seqfile)
+
     if p.returncode:
+        remove_files(ppairs_file)
         raise Exception('Nupack pfunc failed: on %s\n%s' % (sequence, stderr))
 
-    ppairs_file = '%s.ppairs' % seqfile.replace('.in','')
-    os.remove(seqfile)
-
-    probs=np.zeros([len(sequence), len(sequence)])
+    return bpps_nupack_result_(sequence, ppairs_file, sparse=sparse, threshold=threshold)
 
-    with open(ppairs_file, 'r') as f:
-        for line in f.readlines():
-            if not line.startswith('%'):
-                fields = line.split()
-                if len(fields) > 1:
-                    if int(fields[1]) <= len(sequence):
-                        i, j, p = int(fields[0])-1, int(fields[1])-1, float(fields[2])
-                        probs[i,j] = p
-                        probs[j,i] = p
+def bpps_nupack_output_(seqfile):
+    """the .ppairs file nupack pairs writes next to its input"""
+    return '%s.ppairs' % seqfile.replace('.in','')
 
+def bpps_nupack_result_(sequence, ppairs_file, sparse=False, threshold=0):
+    """read (and remove) the pair probabilities of a nupack pairs run"""
+    i, j, p = parse_nupack_ppairs(ppairs_file, len(sequence))
+    remove_files(ppairs_file)
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
 
-    return probs
-
-def bpps_rnastructure_(sequence, tmp_file, coaxial=True):
-
-    DIR = package_locs['rnastructure']
+def bpps_rnastructure_(sequence, tmp_file, coaxial=True, sparse=False, threshold=0):
 
     pfsfile = tmp_file #'%s/rnastructtmp.pfs' % package_locs['TMP']
-    outfile = '%s.probs' % (tmp_file.replace('.pfs',''))
-    command = ['%s/ProbabilityPlot' % DIR, pfsfile, outfile, '-t']
-
-    probs=np.zeros([len(sequence), len(sequence)])
+    command, outfile = bpps_rnastructure_command_(pfsfile)
 
     if DEBUG: print(' '.join(command))
     p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -169,50 +264,37 @@ def bpps_rnastructure_(sequence, tmp_file, coaxial=True):
         print(stderr)
 
     if p.returncode:
-        raise Exception('RNAstructure ProbabilityPlot failed: on %s\n%s' % (seq, stderr))
-
-    with open(outfile, 'r') as f:
-        for line in f.readlines()[2:]:
-            fields = line.split()
-            i, j, p = int(fields[0])-1, int(fields[1])-1, 10**(-1*float(fields[2]))
-            probs[i,j] = p
-            probs[j,i] = p
-    
-    os.remove(outfile)
-    os.remove(pfsfile)
-    return probs
-
-def bpps_vfold_(sequence, version='0',T=37, coaxial=True):
-    #available versions: 0 for Turner 04 params, 1 for Mfold 2.3 params
-
-    DIR = package_locs["vfold"]
+        remove_files(pfsfile, outfile)
+        raise Exception('RNAstructure ProbabilityPlot failed: on %s\n%s' % (sequence, stderr))
 
-    cwd = os.getcwd()
-    os.chdir(DIR) #vfold precompiled binaries don't work being called from elsewhere
+    return bpps_rnastructure_result_(sequence, pfsfile, outfile, sparse=sparse, threshold=threshold)
 
-    if DEBUG: print(os.getcwd())
+def bpps_rnastructure_command_(pfsfile):
+    """ProbabilityPlot call writing the pair probabilities of a .pfs file as text
 
-    seqfile = write([sequence])
-
-    outfile = filename()+'.pij'
-
-    if sys.platform=="linux":
-        platform='linux'
-    elif sys.platform=="darwin":
-        platform='mac'
-    elif sys.platform=="win32":
-        platform='win'
-    else:
-        raise RuntimeError('Vfold has binaries for linux, macOS, and win')
+    Returns
+        list, str: command, output file
+    """
+    outfile = '%s.probs' % (pfsfile.replace('.pfs',''))
+    return ['%s/ProbabilityPlot' % locate('rnastructure'), pfsfile, outfile, '-t'], outfile
+
+def bpps_rnastructure_result_(sequence, pfsfile, outfile, sparse=False, threshold=0):
+    """read the pair probabilities of a ProbabilityPlot run, removing its input and output"""
+    i, j, p = parse_rnastructure_probs(outfile)
+    remove_files(outfile, pfsfile)
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
+
+def bpps_vfold_(sequence, version='0',T=37, coaxial=True, sparse=False, threshold=0):
+    #available versions: 0 for Turner 04 params, 1 for Mfold 2.3 params
 
-    command = ['./Vfold2d_npk_%s.o %d %d %s %s %d' % (platform, int(coaxial), T, seqfile, outfile, int(version))]
+    command, DIR, seqfile, outfile = vfold_command_('Vfold2d', sequence, version=version, T=T, coaxial=coaxial)
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    #vfold precompiled binaries don't work being called from elsewhere
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=DIR)
 
     stdout, stderr = p.communicate()
-    os.chdir(cwd)
 
     if DEBUG:
         print('stdout')
@@ -220,19 +302,17 @@ def bpps_vfold_(sequence, version='0',T=37, coaxial=True):
         print('stderr')
         print(stderr)
     if p.returncode:
+        remove_files(seqfile, outfile)
         raise Exception('Vfold2d_npk failed: on %s\n%s' % (sequence, stderr))
 
-    os.remove(seqfile)
-    probs = np.zeros([len(sequence),len(sequence)])
-    p_ij_output = np.loadtxt(outfile,usecols=(0,2,3)) #col 0: set of inds 1, col 1: set of inds 2, col 2: bpp
-
-    for i,j,p in p_ij_output:
-    	probs[int(i-1),int(j-1)] = p
-    	probs[int(j-1),int(i-1)] = p
-    os.remove(outfile)
+    remove_files(seqfile)
+    return bpps_vfold_result_(sequence, outfile, sparse=sparse, threshold=threshold)
 
-    return probs
-    #output: take second field of last line for Z 
+def bpps_vfold_result_(sequence, outfile, sparse=False, threshold=0):
+    """read (and remove) the pair probabilities of a Vfold2d run"""
+    i, j, p = parse_vfold_pij(outfile)
+    remove_files(outfile)
+    return triples_to_bpps(i, j, p, len(sequence), sparse=sparse, threshold=threshold)
 
 
 
@@ -0,0 +1,271 @@
+import os, json, hashlib
+import numpy as np
+from .sparse import SparseBPPs
+from .cache import normalize_sequence, normalize_package, file_digest
+
+DEBUG=False
+
+# bump when the layout of data.bin or index.tsv changes
+STORE_VERSION=1
+
+ALIGN = 8
+
+def store_key(seq, constraint=None):
+    '''hash a store files a sequence (and constraint) under'''
+    text = normalize_sequence(seq) if constraint is None else '%s|%s' % (normalize_sequence(seq), constraint)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def fold_conditions(package='vienna', T=37, dangles=True, coaxial=True, param_file=None, reweight=None):
+    '''the conditions a store's matrices are folded under, normalized as in cache keys
+    (parameter files by content)'''
+    return {'package': normalize_package(package), 'T': float(T), 'dangles': bool(dangles), 'coaxial': bool(coaxial),
+        'param_file': file_digest(param_file), 'reweight': file_digest(reweight)}
+
+class BPPStore:
+    '''Base pair probabilities of many sequences in one append-only dataset directory:
+
+        meta.json   layout and dtype, fixed when the store is created, and the fold
+                    conditions (`fold_conditions`), fixed by the first put that gives them
+        data.bin    records, each 8-byte aligned
+        index.tsv   a line per record: key, name, offset, N, nnz, sequence
+
+    A record is the upper triangle of the matrix ('triu': N(N-1)/2 values, row by row) or its
+    pairs above threshold ('sparse': int32 i, int32 j, then p), followed by the N unpaired
+    probabilities. Reads are numpy views of a memory map of data.bin, so `triu`, `pairs` and
+    `unpaired` copy nothing. Putting a sequence again appends a new record that the index
+    points to instead; old records stay in data.bin.
+
+    One process writes at a time; any number can read. A record is indexed only after it is
+    written, so an interrupted writer leaves no partial entries.
+
+    Args:
+    path (str): store directory, created if missing
+    layout (str): 'triu' or 'sparse' for a new store
+    dtype: float type of stored probabilities for a new store, e.g. np.float16 or np.float32
+    threshold (float): sparse layout keeps pairs above this probability
+    '''
+
+    def __init__(self, path, layout='triu', dtype=np.float32, threshold=0):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        meta_file = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta['version'] != STORE_VERSION:
+                raise ValueError('%s is a version %s store, this arnie reads version %d' % (path, meta['version'], STORE_VERSION))
+        else:
+            if layout not in ['triu', 'sparse']:
+                raise ValueError('layout %s not understood, use triu or sparse' % layout)
+            meta = {'version': STORE_VERSION, 'layout': layout, 'dtype': np.dtype(dtype).name, 'threshold': threshold}
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+
+        self.layout = meta['layout']
+        self.dtype = np.dtype(meta['dtype'])
+        self.threshold = meta['threshold']
+        self.conditions = meta.get('conditions')
+        self._meta_file = meta_file
+
+        self._data_file = os.path.join(path, 'data.bin')
+        self._index_file = os.path.join(path, 'index.tsv')
+        self._map = None
+        self._entries = {} # key -> (name, offset, N, nnz, sequence)
+        self._names = {}
+        self._index_size = 0
+        self.refresh()
+
+    def refresh(self):
+        '''Read index lines appended (by another process) since the store was opened.'''
+        if not os.path.exists(self._index_file):
+            return
+        with open(self._index_file, 'rb') as f:
+            f.seek(self._index_size)
+            text = f.read()
+        complete = text.rfind(b'\n') + 1 # skip a line still being written
+        self._index_size += complete
+        for line in text[:complete].decode('utf-8').splitlines():
+            key, name, offset, N, nnz, seq = line.split('\t')
+            self._entries[key] = (name, int(offset), int(N), int(nnz), seq)
+            if name:
+                self._names[name] = key
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        return self._key(item) in self._entries
+
+    def __repr__(self):
+        return 'BPPStore(%r, layout=%s, dtype=%s, entries=%d)' % (self.path, self.layout, self.dtype.name, len(self))
+
+    def _key(self, item, constraint=None):
+        '''key of a name given to put, or of a sequence'''
+        if constraint is None and item in self._names:
+            return self._names[item]
+        return store_key(item, constraint)
+
+    def _entry(self, item, constraint=None):
+        key = self._key(item, constraint)
+        if key not in self._entries:
+            raise KeyError('%s is not in %s' % (item if len(item) < 50 else item[:47] + '...', self.path))
+        return self._entries[key]
+
+    def names(self):
+        '''names of the entries, in the order they were first put (sequences where no name was given)'''
+        return [name or seq for name, _, _, _, seq in self._entries.values()]
+
+    def sequences(self):
+        return [seq for _, _, _, _, seq in self._entries.values()]
+
+    def check(self, conditions):
+        '''Raise ValueError if the store holds matrices folded under other conditions.
+
+        Args:
+        conditions (dict): from `fold_conditions`
+        '''
+        if self.conditions is None:
+            with open(self._meta_file) as f:
+                self.conditions = json.load(f).get('conditions') # set by another process since we opened
+        if self.conditions is not None and self.conditions != json.loads(json.dumps(conditions)):
+            differ = ', '.join('%s %s, not %s' % (key, self.conditions.get(key), value)
+                for key, value in sorted(conditions.items()) if self.conditions.get(key) != value)
+            raise ValueError('%s holds matrices folded with %s' % (self.path, differ))
+
+    def _record_conditions(self, conditions):
+        with open(self._meta_file) as f:
+            meta = json.load(f)
+        meta['conditions'] = conditions
+        tmp_file = '%s.tmp' % self._meta_file
+        with open(tmp_file, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_file, self._meta_file)
+        self.conditions = json.loads(json.dumps(conditions))
+
+    def put(self, seq, bpps, name=None, constraint=None, conditions=None):
+        '''Append the NxN matrix or SparseBPPs of seq.
+
+        Args:
+        name (str): id to look the entry up by besides the sequence, e.g. a file name
+        constraint (str): store the entry under seq and this constraint
+        conditions (dict): what bpps was folded under (`fold_conditions`); recorded by the first
+            put that gives them, and a ValueError for any later put under other conditions
+
+        The unpaired vector is taken before a sparse store drops pairs below its threshold, so
+        it is exact for a matrix or a SparseBPPs of all pairs; a SparseBPPs thresholded by the
+        caller gives an unpaired vector that is too high wherever pairs were dropped.
+        '''
+        if conditions is not None:
+            self.check(conditions)
+
+        N = len(seq)
+        if self.layout == 'sparse':
+            if not isinstance(bpps, SparseBPPs):
+                matrix = np.asarray(bpps)
+                unpaired = 1 - matrix.sum(axis=0)
+                bpps = SparseBPPs.from_dense(matrix, threshold=self.threshold)
+            else:
+                unpaired = bpps.unpaired()
+                if self.threshold > 0:
+                    bpps = bpps.threshold(self.threshold)
+            payload = [bpps.i.astype(np.int32), bpps.j.astype(np.int32), bpps.p.astype(self.dtype)]
+            nnz = bpps.nnz
+        else:
+            matrix = bpps.toarray() if isinstance(bpps, SparseBPPs) else np.asarray(bpps)
+            unpaired = 1 - matrix.sum(axis=0)
+            payload = [matrix[np.triu_indices(N, k=1)].astype(self.dtype)]
+            nnz = len(payload[0])
+        if len(unpaired) != N:
+            raise ValueError('matrix is %d long, sequence %d' % (len(unpaired), N))
+        payload.append(unpaired.astype(self.dtype))
+
+        with open(self._data_file, 'ab') as f:
+            offset = f.tell()
+            offset += -offset % ALIGN
+            f.write(b'\0'*(offset - f.tell()))
+            for x in payload:
+                f.write(np.ascontiguousarray(x).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        if conditions is not None and self.conditions is None:
+            self._record_conditions(conditions)
+
+        key = store_key(seq, constraint)
+        name = '' if name is None else str(name)
+        with open(self._index_file, 'a') as f:
+            f.write('%s\t%s\t%d\t%d\t%d\t%s\n' % (key, name, offset, N, nnz, seq))
+        self.refresh()
+
+    def _view(self, offset, dtype, count):
+        end = offset + np.dtype(dtype).itemsize*count
+        if self._map is None or end > len(self._map):
+            self._map = np.memmap(self._data_file, dtype=np.uint8, mode='r') # reopen to see appended records
+        return self._map[offset:end].view(dtype)
+
+    def _parts(self, entry):
+        '''memory-mapped views of a record's payload arrays and unpaired vector'''
+        _, offset, N, nnz, _ = entry
+        parts = []
+        for dtype in ([np.int32, np.int32, self.dtype] if self.layout == 'sparse' else [self.dtype]):
+            parts.append(self._view(offset, dtype, nnz))
+            offset += parts[-1].nbytes
+        return parts, self._view(offset, self.dtype, N)
+
+    def triu(self, item, constraint=None):
+        '''zero-copy upper triangle values of a triu store entry, row by row'''
+        if self.layout != 'triu':
+            raise ValueError('%s stores sparse pairs; use pairs()' % self.path)
+        return self._parts(self._entry(item, constraint))[0][0]
+
+    def pairs(self, item, constraint=None):
+        '''i, j, p of the stored pairs (zero-copy views in a sparse store)'''
+        return self._pairs(self._entry(item, constraint))
+
+    def _pairs(self, entry):
+        parts, _ = self._parts(entry)
+        if self.layout == 'sparse':
+            return tuple(parts)
+        i, j = np.triu_indices(entry[2], k=1)
+        keep = np.flatnonzero(parts[0])
+        return i[keep].astype(np.int32), j[keep].astype(np.int32), parts[0][keep]
+
+    def unpaired(self, item, constraint=None):
+        '''zero-copy unpaired probabilities of an entry'''
+        return self._parts(self._entry(item, constraint))[1]
+
+    def get(self, item, constraint=None, sparse=False):
+        '''symmetric NxN float64 matrix of an entry (by sequence or name), or SparseBPPs'''
+        return self._matrix(self._entry(item, constraint), sparse)
+
+    def _matrix(self, entry, sparse):
+        N = entry[2]
+        if sparse:
+            return SparseBPPs(*self._pairs(entry), N)
+        parts, _ = self._parts(entry)
+        matrix = np.zeros([N, N])
+        if self.layout == 'sparse':
+            i, j, p = parts
+            matrix[i, j] = matrix[j, i] = p
+        else:
+            i, j = np.triu_indices(N, k=1)
+            matrix[i, j] = matrix[j, i] = parts[0]
+        return matrix
+
+    def iter_batches(self, batch_size=256, sparse=False, unpaired=False):
+        '''Stream the entries in the order they were first put.
+
+        Yields
+        (names, values) per batch_size entries: matrices (SparseBPPs if sparse), or the
+        zero-copy unpaired vectors if unpaired
+        '''
+        keys = list(self._entries)
+        for start in range(0, len(keys), batch_size):
+            entries = [self._entries[key] for key in keys[start:start+batch_size]]
+            names = [name or seq for name, _, _, _, seq in entries]
+            if unpaired:
+                values = [self._parts(entry)[1] for entry in entries]
+            else:
+                values = [self._matrix(entry, sparse) for entry in entries]
+            yield names, values
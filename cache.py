@@ -0,0 +1,368 @@
+import os, json, hashlib, inspect, functools, tempfile, threading
+from collections import OrderedDict, namedtuple
+import numpy as np
+from .utils import *
+
+DEBUG=False
+
+# bump when the stored format or the meaning of a key changes
+CACHE_VERSION=1
+
+_disk = None
+
+def enable_disk_cache(path=None, max_size=1<<30):
+    '''Keep `pfunc`, `bpps` and `mfe` results on disk and reuse them across runs.
+
+    Entries are keyed by a hash of the normalized sequence, the package and every other
+    argument, with `param_file` and `reweight` files hashed by content. Several processes
+    can share one cache directory. Clear it (`clear_disk_cache`) after upgrading a package.
+
+    Args:
+    path (str): cache directory, default `arnie_cache` under TMP from the arnie file
+    max_size (int): bytes kept before least recently used entries are evicted
+    '''
+    global _disk
+    if path is None:
+        path = os.path.join(load_package_locations()['TMP'], 'arnie_cache')
+    _disk = DiskCache(path, max_size=max_size)
+
+def disable_disk_cache():
+    '''Stop reading and writing the disk cache. Stored entries are kept.'''
+    global _disk
+    _disk = None
+
+def clear_disk_cache():
+    '''Remove every entry from the enabled disk cache.'''
+    if _disk is not None:
+        _disk.clear()
+
+def disk_cache_info():
+    '''Hit/miss statistics of this process and current size of the enabled disk cache.
+
+    Returns
+    dict with keys hits, misses, writes, evictions, entries, size, max_size, path (None if disabled)
+    '''
+    if _disk is None:
+        return None
+    return _disk.info()
+
+class DiskCache:
+    '''Directory of `<key[:2]>/<key>.npy` entries.
+
+    Writers go through a temp file and `os.replace`, so readers never see partial
+    entries and concurrent writers of the same key just overwrite each other. An
+    entry's mtime is refreshed on every hit and is what eviction orders by.
+    '''
+
+    def __init__(self, path, max_size=1<<30):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        self.hits = self.misses = self.writes = self.evictions = 0
+        self._size = None # bytes on disk, estimated between scans
+        self._lock = threading.Lock()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key[:2], '%s.npy' % key)
+
+    def get(self, key, N):
+        '''stored value for `key` (sequence length N), or None'''
+        fname = self._fname(key)
+        try:
+            value = unpack_value(np.load(fname, allow_pickle=False), N)
+            os.utime(fname)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+
+        fd, tmp_fname = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(fname))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, pack_value(value), allow_pickle=False)
+            os.replace(tmp_fname, fname)
+        except BaseException:
+            remove_files(tmp_fname)
+            raise
+        self.writes += 1
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += os.path.getsize(fname)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for subdir in os.scandir(self.path):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.npy'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError: # evicted by another process
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # drop least recently used entries down to 90% of max_size, so the scan isn't repeated every write
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, fname in entries:
+            if size <= 0.9*self.max_size:
+                break
+            try:
+                os.remove(fname)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        with self._lock:
+            for _, _, fname in self._entries():
+                remove_files(fname)
+            self._size = 0
+
+    def info(self):
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'writes': self.writes, 'evictions': self.evictions,
+            'entries': len(entries), 'size': sum(size for _, size, _ in entries), 'max_size': self.max_size, 'path': self.path}
+
+def pack_value(value):
+    '''array to store for a result: 0-d for scalars and structures, the upper
+    triangle for a symmetric, zero-diagonal NxN matrix'''
+    if isinstance(value, np.ndarray) and value.ndim == 2:
+        if np.array_equal(value, value.T) and not np.any(np.diag(value)):
+            return value[np.triu_indices(value.shape[0], k=1)]
+        return value
+    return np.array(value)
+
+def unpack_value(arr, N):
+    if arr.ndim == 0:
+        if arr.dtype.kind == 'U':
+            return str(arr[()])
+        return arr[()]
+    if arr.ndim == 1:
+        matrix = np.zeros([N, N], dtype=arr.dtype)
+        i, j = np.triu_indices(N, k=1)
+        if len(i) != len(arr):
+            raise ValueError('cache entry does not match sequence length %d' % N)
+        matrix[i, j] = arr
+        matrix[j, i] = arr
+        return matrix
+    return arr
+
+def normalize_sequence(seq):
+    return seq.strip().upper().replace('T', 'U')
+
+def normalize_package(package):
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+    if not version:
+        version = DEFAULT_VERSIONS.get(pkg)
+    return pkg if version is None else '%s_%s' % (pkg, version)
+
+def file_digest(fname):
+    '''content hash of a parameter file, or the name itself if it can't be read'''
+    if fname is None:
+        return None
+    try:
+        with open(fname, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return str(fname)
+
+def make_key(kind, arguments):
+    '''hash of a call's normalized arguments
+
+    Args:
+    kind (str): function name, e.g. 'bpps'
+    arguments (dict): bound arguments, the sequence first
+    '''
+    normalized = {}
+    for name, value in arguments.items():
+        if name in ['seq', 'sequence']:
+            value = normalize_sequence(value)
+        elif name == 'package':
+            value = normalize_package(value)
+        elif name in ['param_file', 'reweight']:
+            value = file_digest(value)
+        elif isinstance(value, np.generic):
+            value = value.item()
+        normalized[name] = value
+
+    text = json.dumps([CACHE_VERSION, kind, normalized], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _nbytes(value):
+    return value.nbytes if isinstance(value, np.ndarray) else 64
+
+def _copy(value):
+    # callers may modify the matrices they get back
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+class Memo:
+    '''In-memory LRU of results, bounded by entry count and by bytes.'''
+
+    def __init__(self, maxsize=1024, max_bytes=1<<28):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy(self._entries[key])
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        if value is None or _nbytes(value) > self.max_bytes:
+            return
+        value = _copy(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _nbytes(self._entries.pop(key))
+            self._entries[key] = value
+            self.nbytes += _nbytes(value)
+            while len(self._entries) > self.maxsize or self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+            self.nbytes = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries), self.nbytes)
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize', 'nbytes'])
+
+_memo = None
+
+def enable_memo(maxsize=1024, max_bytes=1<<28):
+    '''Remember `pfunc`, `bpps` and `mfe` results in this process.
+
+    With the memo on, a vienna 2 `pfunc` or `bpps` call runs `RNAfold -p` once and
+    stores Z, free energy, MFE structure and pair probabilities together, so the
+    matching `pfunc`, `free_energy`, `mfe` and `bpps` calls that follow are free.
+    (An `mfe` call runs `-p0` and fills in Z and free energy.)
+
+    Args:
+    maxsize (int): max number of results kept
+    max_bytes (int): max bytes of results kept
+    '''
+    global _memo
+    _memo = Memo(maxsize=maxsize, max_bytes=max_bytes)
+
+def disable_memo():
+    '''Stop memoizing and drop the remembered results.'''
+    global _memo
+    _memo = None
+
+def cache_clear():
+    '''Drop the remembered results and reset the memo statistics.'''
+    if _memo is not None:
+        _memo.clear()
+
+def cache_info():
+    '''Memo statistics, as `CacheInfo(hits, misses, maxsize, currsize, nbytes)` (None if disabled).'''
+    if _memo is None:
+        return None
+    return _memo.info()
+
+_signatures = {}
+
+def store(kind, seq, value, **kwargs):
+    '''Put a result computed elsewhere into the enabled caches, as if `kind(seq, **kwargs)`
+    had returned it. Keyword args that `kind` does not take are ignored.'''
+    if value is None or kind not in _signatures or (_memo is None and _disk is None):
+        return
+    signature = _signatures[kind]
+    bound = signature.bind(seq, **{k: v for k, v in kwargs.items() if k in signature.parameters})
+    bound.apply_defaults()
+    key = make_key(kind, bound.arguments)
+    if _memo is not None:
+        _memo.put(key, value)
+    if _disk is not None:
+        _disk.put(key, value)
+
+def cached(kind, skip=lambda arguments: False, together=None):
+    '''Decorator that looks calls up in the enabled caches before running them.
+
+    Args:
+    kind (str): name the results are stored under
+    skip (callable): given the bound arguments, True for calls that must not be cached
+      (e.g. ones that hand back temp files)
+    together (callable): given the bound arguments, computes the result while `store`-ing
+      the related results that come out of the same run; returns None where it doesn't
+      apply. Only used with the memo on.
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+        _signatures[kind] = signature
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _disk is None and _memo is None:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if skip(bound.arguments):
+                return func(*args, **kwargs)
+
+            key = make_key(kind, bound.arguments)
+
+            if _memo is not None:
+                value = _memo.get(key)
+                if value is not None:
+                    if DEBUG: print('memo hit %s %s' % (kind, key))
+                    return value
+
+            if _disk is not None:
+                N = len(next(iter(bound.arguments.values())))
+                value = _disk.get(key, N)
+                if value is not None:
+                    if DEBUG: print('disk cache hit %s %s' % (kind, key))
+                    if _memo is not None:
+                        _memo.put(key, value)
+                    return value
+
+            value = None
+            if together is not None and _memo is not None:
+                value = together(bound.arguments)
+            if value is None:
+                value = func(*args, **kwargs)
+
+            if value is not None:
+                if _memo is not None:
+                    _memo.put(key, value)
+                if _disk is not None:
+                    _disk.put(key, value)
+            return value
+
+        return wrapper
+    return decorator
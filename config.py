@@ -0,0 +1,103 @@
+import os, threading
+from collections.abc import Mapping
+
+DEBUG=False
+
+# entries of the arnie file that are settings rather than packages
+SETTINGS = ['TMP', 'SCRATCH']
+
+_lock = threading.RLock()
+_arnie_file = None # set by configure(), else $ARNIEFILE
+_locations = None  # parsed arnie file with overrides applied
+_overrides = {}
+_resolved = {}
+
+def configure(arnie_file=None, **locations):
+    '''Set arnie up from code instead of (or on top of) $ARNIEFILE.
+
+    Args:
+    arnie_file (str): arnie file to read instead of $ARNIEFILE
+    **locations: entries that take precedence over the file, e.g. vienna_2='/opt/vienna/bin', TMP='/tmp'.
+      Without any arnie file, these alone make up the configuration.
+    '''
+    global _arnie_file
+    with _lock:
+        if arnie_file is not None:
+            _arnie_file = arnie_file
+        _overrides.update({key: str(value) for key, value in locations.items()})
+        reload()
+
+def reload():
+    '''Forget the parsed arnie file and resolved package paths; they're read again on next use.'''
+    global _locations
+    with _lock:
+        _locations = None
+        _resolved.clear()
+
+def read_arnie_file(fname):
+    '''Parse an arnie file (`name: path` per line, # for comments) into a dict.'''
+    locations = {}
+    with open(fname, 'r') as f:
+        for line in f.readlines():
+            if line.strip() and not line.startswith('#'):
+                key, value = line.split(':', 1)
+                locations[key.strip()] = value.strip()
+    return locations
+
+def locations():
+    '''Package locations and settings, read once from the arnie file on first use.
+
+    Returns
+    dict of name to path ('None' for packages that aren't installed)
+    '''
+    global _locations
+    if _locations is None:
+        with _lock:
+            if _locations is None:
+                fname = _arnie_file or os.environ.get('ARNIEFILE')
+                if fname:
+                    parsed = read_arnie_file(fname)
+                elif _overrides:
+                    parsed = {}
+                else:
+                    raise RuntimeError('No arnie file: set $ARNIEFILE or call arnie.config.configure().')
+                parsed.update(_overrides)
+                if DEBUG: print('read package locations from %s' % fname)
+                _locations = parsed
+    return _locations
+
+def locate(package):
+    '''Directory of a package's binaries, checked once per package.
+
+    Args:
+    package (str): arnie file entry, e.g. 'vienna_2'
+
+    Returns
+    str: absolute path
+    '''
+    if package not in _resolved:
+        path = locations().get(package, 'None')
+        if path == 'None':
+            raise RuntimeError('%s is not set in the arnie file.' % package)
+        path = os.path.abspath(os.path.expanduser(path))
+        if not os.path.isdir(path):
+            raise RuntimeError('%s location %s does not exist.' % (package, path))
+        _resolved[package] = path
+    return _resolved[package]
+
+class PackageLocations(Mapping):
+    '''Read-only view of `locations()` that only parses the arnie file when first looked at.'''
+
+    def __getitem__(self, key):
+        return locations()[key]
+
+    def __iter__(self):
+        return iter(locations())
+
+    def __len__(self):
+        return len(locations())
+
+    def __repr__(self):
+        return repr(locations())
+
+package_locs = PackageLocations()
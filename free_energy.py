@@ -3,13 +3,11 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .config import package_locs
 from .pfunc import pfunc
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
 def free_energy(seq, constraint=None, package='vienna_2', T=37, dangles=True, reweight=None, ensemble=True, param_file=None):
 	''' Compute free energy of RNA sequence. If structure is given, computes free energy of that structure. 
 			Otherwise, returns MFE structure of sequence [NOT IMPLEMENTED YET].
@@ -1,11 +1,59 @@
 import numpy as np
 import argparse, sys
 from arnie.mea.mea_utils import *
-from copy import copy
+from arnie.sparse import SparseBPPs
+from arnie.mea.threshknot import threshknot_partners
+from numpy.lib.stride_tricks import as_strided
+
+def fill_W(bpps, gamma=1.0, min_hp_length=3):
+    '''MEA dynamic program, one anti-diagonal (all cells with j - i = d) at a time.
+
+    W[i,j] = max(W[i+1,j], W[i,j-1], (gamma+1)*bpps[i,j] + W[i+1,j-1] - 1, max_k W[i,k] + W[k+1,j])
+
+    The split max over k reads W[i, i+1:j] and W[i+2:j+1, j] for every i at once through
+    strided views of W, so no cell is visited from python. An array of G gammas is run
+    in the same pass as a leading axis.
+
+    Returns:
+    W (NxN float64 array), tb (NxN int8 array, index of the winning option above);
+    GxNxN for an array of gammas
+    '''
+    gamma = np.asarray(gamma, dtype=np.float64)
+    N = bpps.shape[0]
+    W = np.zeros(gamma.shape + (N, N))
+    tb = np.zeros(gamma.shape + (N, N), dtype=np.int8)
+    *sg, s0, s1 = W.strides
+    weight = (gamma + 1)[..., None]
+
+    for d in range(min_hp_length, N):
+        i = np.arange(N-d)
+        j = i + d
+        shape = gamma.shape + (N-d, d-1)
+
+        # row i from column i+1 to j-1, and column j from row i+2 to j
+        left = as_strided(W[..., :, 1:], shape=shape, strides=(*sg, s0+s1, s1), writeable=False)
+        right = as_strided(W[..., 2:, d:], shape=shape, strides=(*sg, s0+s1, s0), writeable=False)
+
+        options = np.stack([W[..., i+1, j], W[..., i, j-1], weight*bpps[i,j] + W[..., i+1, j-1] - 1, np.max(left + right, axis=-1)])
+        W[..., i, j] = np.max(options, axis=0)
+        tb[..., i, j] = np.argmax(options, axis=0) #0: 5' pass, 1: 3' pass, 2: bp, 3: multiloop
+
+    return W, tb
 
 class MEA:
     def __init__(self, bpps, gamma = 1.0, debug=False, run_probknot_heuristic = False, theta=0):
+        self.setup(bpps, gamma, debug, theta)
+        self.run_probknot_heuristic = run_probknot_heuristic
+
+        if run_probknot_heuristic:
+            self.run_ProbKnot()
+        else:
+            self.run_MEA()
+
+    def setup(self, bpps, gamma, debug=False, theta=0):
         self.debug = debug
+        if isinstance(bpps, SparseBPPs):
+            bpps = bpps.toarray() # the DP below is dense anyway
         self.bpps = bpps
         self.N=self.bpps.shape[0]
         self.gamma = gamma
@@ -14,28 +62,40 @@ class MEA:
         self.MEA_bp_list = []
         self.structure = ['.']*self.N
         self.MEA_bp_matrix = np.zeros([self.N, self.N])
-        self.tb = np.zeros([self.N, self.N])
+        self.tb = np.zeros([self.N, self.N], dtype=np.int8)
         self.min_hp_length = 3
+        self.run_probknot_heuristic = False
         self.evaluated = False
 
-        if run_probknot_heuristic:
-            self.run_ProbKnot()
-        else:
-            self.run_MEA()
-        
-    def fill_W(self, i, j):
-        options = [self.W[i+1, j], self.W[i, j-1], (self.gamma+1)*self.bpps[i,j] + self.W[i+1, j-1] - 1,\
-                np.max([self.W[i,k] + self.W[k+1, j] for k in range(i+1,j)])]
-        self.W[i,j] = np.max(options) 
-        self.tb[i,j] = np.argmax(options) #0: 5' pass, 1: 3' pass, 2: bp, 3: multiloop
+    @classmethod
+    def for_gammas(cls, bpps, gammas, debug=False):
+        '''MEA structures for a list of gammas, from a single DP pass over all of them.
+
+        Holds G float64 NxN weight matrices at once; split long gamma lists for big N.
+
+        Returns: list of MEA objects, one per gamma, as MEA(bpps, gamma) would give.
+        '''
+        gammas = list(gammas)
+        results = []
+        for gamma in gammas:
+            mea = cls.__new__(cls)
+            mea.setup(bpps, gamma, debug)
+            results.append(mea)
+        if len(results) == 0:
+            return results
+
+        W, tb = fill_W(results[0].bpps, gammas, results[0].min_hp_length)
+        for mea, W_g, tb_g in zip(results, W, tb):
+            mea.W, mea.tb = W_g, tb_g
+            mea.structure_from_W()
+        return results
         
     def run_MEA(self):
         # fill weight matrix
-        for length in range(self.min_hp_length, self.N):
-            for i in range(self.N-length):
-                j = i + length
-                self.fill_W(i,j)
-                
+        self.W, self.tb = fill_W(self.bpps, self.gamma, self.min_hp_length)
+        self.structure_from_W()
+
+    def structure_from_W(self):
         self.traceback(0,self.N-1)
         
         for x in self.MEA_bp_list:
@@ -48,50 +108,42 @@ class MEA:
 
     def run_ProbKnot(self):
 
-        #Threshknot step: filter out bps below cutoff theta
-        threshknot_filter = np.where(self.bpps <= self.theta)
-        filtered_bpps = copy(self.bpps)
-        filtered_bpps[threshknot_filter] = 0
+        # ThreshKnot: pairs above theta that are the most probable pair of both their nucleotides
+        partners = threshknot_partners(self.bpps, theta=self.theta)
+        i, j = convert_partners_to_pairs(partners)
+        keep = j - i > 1
+        i, j = i[keep], j[keep]
 
-        output = np.zeros([self.N, self.N])
-        
-        # ProbKnot heuristic part 1: get all base pairs where p(ij) == p_max(i)
-        output[np.where(self.bpps == np.max(self.bpps, axis=0))] = 1
-        
-        # ProbKnot heuristic part 2: get all base pairs where p(ij) == p_max(j)
-        self.MEA_bp_matrix = np.clip(output+np.transpose(output)-1,0,1)
-
-        for [i, j] in np.array(np.where(self.MEA_bp_matrix == 1)).T:
-            if np.abs(i - j) > 1:
-                if [j,i] not in self.MEA_bp_list:
-                    self.MEA_bp_list.append([i,j])
-                    self.structure[i] = '('
-                    self.structure[j] = ')'
-        print('Warning: formatting pseudoknotted dot-bracket structures not yet supported. Any pseudoknotted stems will only appear as parentheses (not brackets).')
-        self.structure = ''.join(self.structure)
+        self.MEA_bp_list = [[a, b] for a, b in zip(i.tolist(), j.tolist())]
+        self.MEA_bp_matrix = np.zeros([self.N, self.N])
+        self.MEA_bp_matrix[i, j] = 1
+        self.MEA_bp_matrix[j, i] = 1
+        self.structure = convert_partners_to_dotbracket(convert_pairs_to_partners(i, j, self.N))
 
         if not self.evaluated: self.evaluated = True
 
     def traceback(self, i, j):
-        if j <= i:
-            return
-        elif self.tb[i,j] == 0: #5' neighbor
-            if self.debug: print(i,j, "5'")
-            self.traceback(i+1,j)
-        elif self.tb[i,j] == 1: #3' neighbor
-            if self.debug: print(i,j, "3'")
-            self.traceback(i,j-1)
-        elif self.tb[i,j] == 2: # base pair
-            if self.debug: print(i,j,'bp')
-            self.MEA_bp_list.append((i,j))
-            self.traceback(i+1,j-1)
-        else: #multiloop
-            for k in range(i+1,j):
-                if self.W[i,j] == self.W[i, k] + self.W[k+1,j]:
-                    if self.debug: print(i,j,"multiloop, k=",k)
-                    self.traceback(i,k)
-                    self.traceback(k+1,j)
-                    break
+        # explicit stack instead of recursion, visiting cells in the same (depth-first, 5' side first) order
+        stack = [(i, j)]
+        while stack:
+            i, j = stack.pop()
+            if j <= i:
+                continue
+            elif self.tb[i,j] == 0: #5' neighbor
+                if self.debug: print(i,j, "5'")
+                stack.append((i+1,j))
+            elif self.tb[i,j] == 1: #3' neighbor
+                if self.debug: print(i,j, "3'")
+                stack.append((i,j-1))
+            elif self.tb[i,j] == 2: # base pair
+                if self.debug: print(i,j,'bp')
+                self.MEA_bp_list.append((i,j))
+                stack.append((i+1,j-1))
+            else: #multiloop
+                k = i + 1 + int(np.argmax(self.W[i, i+1:j] + self.W[i+2:j+1, j]))
+                if self.debug: print(i,j,"multiloop, k=",k)
+                stack.append((k+1,j))
+                stack.append((i,k))
 
     def score_expected(self):
         '''Compute expected values of TP, FP, etc from predicted MEA structure.
@@ -100,31 +152,12 @@ class MEA:
          pseudoexpected SEN, PPV, MCC, F-score'''
 
         if not self.evaluated: 
-            if run_probknot_heuristic:
+            if self.run_probknot_heuristic:
                 self.run_ProbKnot()
             else:
                 self.run_MEA()
 
-        pred_m = self.MEA_bp_matrix[np.triu_indices(self.N)]
-        probs = self.bpps[np.triu_indices(self.N)]
-
-        TP = np.sum(np.multiply(pred_m, probs)) + 1e-6
-        TN = 0.5*self.N*self.N-1 - np.sum(pred_m) - np.sum(probs) + TP + 1e-6
-        FP = np.sum(np.multiply(pred_m, 1-probs)) + 1e-6
-        FN = np.sum(np.multiply(1-pred_m, probs)) + 1e-6
-
-        a,b = np.triu_indices(self.N)
-        cFP = 1e-6
-        for i in range(len(pred_m)):
-            if np.sum(self.MEA_bp_matrix,axis=0)[a[i]] + np.sum(self.MEA_bp_matrix,axis=0)[b[i]]==0:
-               cFP += np.multiply(pred_m[i], 1-probs[i])
-
-        sen = TP/(TP + FN)
-        ppv = TP/(TP + FP - cFP)
-        mcc = (TP*TN - (FP - cFP)*FN)/np.sqrt((TP + FP - cFP)*(TP + FN)*(TN + FP - cFP)*(TN + FN))
-        fscore = 2*TP/(2*TP + FP - cFP + FN)
-
-        return [sen, ppv, mcc, fscore]
+        return score_expected(self.MEA_bp_matrix, self.bpps)
 
     def score_ground_truth(self, ground_truth_struct, allow_pseudoknots=False):
         if len(ground_truth_struct[0])==1:
@@ -1,29 +1,19 @@
 import numpy as np
-import argparse, sys
+import argparse, sys, os
+from arnie.structures import *
+from arnie.utils import load_matrix
 
 def convert_dotbracket_to_matrix(s):
-    m = np.zeros([len(s),len(s)])
-    for char_set in [['(',')'], ['[',']'],['{','}']]:
-        bp1=[]
-        bp2=[]
-        for i, char in enumerate(s):
-            if char==char_set[0]:
-                bp1.append(i)
-            if char==char_set[1]:
-                bp2.append(i)
-        for i in list(reversed(bp1)):
-            for j in bp2:
-                if j > i:
-                    m[i,j]=1.0
-                    bp2.remove(j)
-                    break
-    return m
+    # upper triangle only
+    return convert_partners_to_matrix(convert_dotbracket_to_partners(s, brackets=['()', '[]', '{}']), symmetric=False)
 
 def convert_matrix_to_dotbracket(m):
-    print('not implemented yet!')
-    pass
+    return convert_partners_to_dotbracket(convert_matrix_to_partners(m))
 
 def load_matrix_or_dbn(s):
+    if os.path.splitext(s)[1].lower() in ['.npy', '.npz']:
+        return load_matrix(s)
+
     num_lines = sum(1 for line in open(s))
 
     if num_lines > 2: #heuristic here
@@ -49,26 +39,7 @@ def score_ground_truth(pred_matrix, true_matrix):
     assert true_matrix.shape[0] == N
     assert true_matrix.shape[1] == N
 
-    true = true_matrix[np.triu_indices(N)]
-    pred = pred_matrix[np.triu_indices(N)]
-
-    TP, FP, cFP, TN, FN = 0, 0, 0, 0, 0
-
-    for i in range(len(true)):
-        if true[i] == 1:
-            if pred[i] == 1: 
-                TP += 1
-            else:
-                FN += 1
-        elif true[i] == 0:
-            if pred[i] == 0: 
-                TN += 1
-            else: 
-                FP += 1
-                #check for compatible false positive
-                a,b = np.triu_indices(N)
-                if np.sum(true_matrix,axis=0)[a[i]]+ np.sum(true_matrix,axis=0)[b[i]]==0:
-                   cFP +=1
+    TP, FP, cFP, TN, FN = [int(x) for x in count_ground_truth(pred_matrix, true_matrix)]
 
     # cFP = 0 #for debugging
 
@@ -98,3 +69,114 @@ def score_ground_truth(pred_matrix, true_matrix):
         fscore = 2*ppv*sen/(ppv+sen)
 
     return sen, ppv, mcc, fscore, N
+
+def count_ground_truth(pred_matrices, true_matrices):
+    '''TP, FP, cFP (compatible false positives), TN, FN over the top triangle (diagonal included)
+    of predicted vs true base pair matrices.
+
+    A false positive is compatible if neither of its nucleotides pairs in the true structure.
+    Entries count as paired if exactly 1 and unpaired if exactly 0, as in score_ground_truth.
+
+    Args:
+    pred_matrices, true_matrices: NxN matrices, or stacks of them (BxNxN)
+
+    Returns: TP, FP, cFP, TN, FN (ints, or length-B arrays for stacks)
+    '''
+    pred_matrices, true_matrices = np.asarray(pred_matrices), np.asarray(true_matrices)
+    N = true_matrices.shape[-1]
+    a, b = np.triu_indices(N)
+
+    true = true_matrices[..., a, b]
+    pred = pred_matrices[..., a, b]
+    true_paired, true_unpaired = true == 1, true == 0
+    pred_paired, pred_unpaired = pred == 1, pred == 0
+
+    col_sums = np.sum(true_matrices, axis=-2)
+    compatible = col_sums[..., a] + col_sums[..., b] == 0
+
+    TP = np.sum(true_paired & pred_paired, axis=-1)
+    FN = np.sum(true_paired & ~pred_paired, axis=-1)
+    TN = np.sum(true_unpaired & pred_unpaired, axis=-1)
+    FP = np.sum(true_unpaired & ~pred_unpaired, axis=-1)
+    cFP = np.sum(true_unpaired & ~pred_unpaired & compatible, axis=-1)
+
+    return TP, FP, cFP, TN, FN
+
+def metrics_from_counts(TP, FP, cFP, TN, FN):
+    '''sen, ppv, mcc, fscore arrays from count arrays, with the conventions of score_ground_truth
+    for empty denominators.'''
+    TP, FP, cFP, TN, FN = [np.asarray(x, dtype=np.float64) for x in [TP, FP, cFP, TN, FN]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sen = np.where(TP + FN == 0, 1, TP/(TP + FN))
+        ppv = np.where(TP + FP - cFP == 0, 1, TP/(TP + FP - cFP))
+
+        mcc_num = (TP*TN - (FP - cFP)*FN)
+        mcc_denom = np.sqrt((TP + FP - cFP)*(TP + FN)*(TN + FP - cFP)*(TN + FN))
+        mcc = np.where(mcc_denom == 0, mcc_num, mcc_num/mcc_denom)
+
+        fscore = np.where(ppv + sen == 0, 0, 2*ppv*sen/(ppv+sen))
+
+    return sen, ppv, mcc, fscore
+
+def score_ground_truth_batch(pred_matrices, true_matrices):
+    '''score_ground_truth for many structures at once.
+
+    Args:
+    pred_matrices, true_matrices: BxNxN stacks, or equal-length lists of NxN matrices
+        (lengths may differ between items; same-length items are scored together)
+
+    Returns: sen, ppv, mcc, fscore, N as length-B arrays
+    '''
+    if len(pred_matrices) != len(true_matrices):
+        raise ValueError('got %d predicted and %d true structures' % (len(pred_matrices), len(true_matrices)))
+
+    lengths = np.array([np.shape(m)[-1] for m in true_matrices], dtype=np.int64)
+    counts = np.zeros([5, len(lengths)], dtype=np.int64)
+
+    for N in np.unique(lengths):
+        idx = np.flatnonzero(lengths == N)
+        if isinstance(pred_matrices, np.ndarray) and isinstance(true_matrices, np.ndarray):
+            pred, true = pred_matrices[idx], true_matrices[idx]
+        else:
+            pred = np.stack([pred_matrices[k] for k in idx])
+            true = np.stack([true_matrices[k] for k in idx])
+        assert pred.shape == true.shape
+        counts[:, idx] = count_ground_truth(pred, true)
+
+    sen, ppv, mcc, fscore = metrics_from_counts(*counts)
+    return sen, ppv, mcc, fscore, lengths
+
+def score_expected(pred_matrices, bpps):
+    '''Expected values of TP, FP, etc of predicted structures under a base pair probability matrix.
+
+    Args:
+    pred_matrices: NxN predicted base pair matrix, or a stack of them (GxNxN)
+    bpps: NxN base pair probabilities (or one per prediction, GxNxN)
+
+    Returns:
+    pseudoexpected SEN, PPV, MCC, F-score (floats, or length-G arrays for stacks)'''
+    pred_matrices, bpps = np.asarray(pred_matrices), np.asarray(bpps)
+    N = bpps.shape[-1]
+    a, b = np.triu_indices(N)
+
+    # row-contiguous, so each structure's sums round exactly as for a single matrix
+    pred_m = np.ascontiguousarray(pred_matrices[..., a, b])
+    probs = np.ascontiguousarray(np.broadcast_to(bpps[..., a, b], pred_m.shape))
+
+    TP = np.sum(np.multiply(pred_m, probs), axis=-1) + 1e-6
+    TN = 0.5*N*N-1 - np.sum(pred_m, axis=-1) - np.sum(probs, axis=-1) + TP + 1e-6
+    FP = np.sum(np.multiply(pred_m, 1-probs), axis=-1) + 1e-6
+    FN = np.sum(np.multiply(1-pred_m, probs), axis=-1) + 1e-6
+
+    # compatible false positives: predicted pairs between two nucleotides the prediction leaves unpaired
+    col_sums = np.sum(pred_matrices, axis=-2)
+    compatible = col_sums[..., a] + col_sums[..., b] == 0
+    cFP = 1e-6 + np.sum(np.where(compatible, np.multiply(pred_m, 1-probs), 0), axis=-1)
+
+    sen = TP/(TP + FN)
+    ppv = TP/(TP + FP - cFP)
+    mcc = (TP*TN - (FP - cFP)*FN)/np.sqrt((TP + FP - cFP)*(TP + FN)*(TN + FP - cFP)*(TN + FN))
+    fscore = 2*TP/(2*TP + FP - cFP + FN)
+
+    return [sen, ppv, mcc, fscore]
@@ -1,32 +1,140 @@
 import numpy as np
 from arnie.bpps import bpps
+from arnie.sparse import SparseBPPs
+from arnie.bppstore import BPPStore
+from arnie.structures import convert_pairs_to_partners, convert_partners_to_dotbracket
 
-def threshknot_util(sequence, package='vienna_2', theta=0):
+def threshknot_util(sequence, package='vienna_2', theta=0, sparse=False):
     '''
     Inputs:
     sequence: RNA sequence
     package: folding package to use
-    
+    sparse: work on (i, j, p) triples throughout and return a SparseBPPs instead of a matrix
+
     Set theta = 0 to not filter base pairs as in ThreshKnot.
-    
+
     Returns: N x N matrix of base pair probabilities. Nonzero entries represent base pairs
     predicted in final (possibly pseudoknotted) structure.
     Probabilities are their associated probability (obvs).
     '''
-    
+
+    if sparse:
+        return threshknot_sparse_(bpps(sequence, package=package, sparse=True, threshold=theta))
+
     bp_matrix = bpps(sequence, package=package)
-    
-    # if desired, filter base pair probabilities below a cutoff
-    bp_matrix[np.where(bp_matrix <= theta)] = 0
-    output = np.zeros([len(sequence),len(sequence)])
-    
-    # ProbKnot heuristic part 1: get all base pairs where p(ij) == p_max(i)
-    output[np.where(bp_matrix == np.max(bp_matrix,axis=0))] = 1
-    
-    # ProbKnot heuristic part 2: get all base pairs where p(ij) == p_max(j)
-    array_of_bps = np.clip(output+np.transpose(output)-1,0,1)
-    
+
+    partners = threshknot_partners(bp_matrix, theta=theta)
+
     # setting all bp probabilities not corresponding to a final selected base pair to zero
-    bp_matrix[np.where(array_of_bps == 0)] = 0
-    
-    return bp_matrix
+    output = np.zeros([len(sequence),len(sequence)])
+    i = np.flatnonzero(partners >= 0)
+    output[i, partners[i]] = bp_matrix[i, partners[i]]
+    return output
+
+def threshknot_sparse_(bp_pairs, theta=0):
+    '''ProbKnot heuristic on SparseBPPs: keep pairs above theta whose probability is the
+    largest of both their nucleotides.'''
+
+    rows, i, j, p, _ = _triples([bp_pairs], theta)
+    keep = _select(rows*bp_pairs.N + i, rows*bp_pairs.N + j, p, bp_pairs.N, iterative=False)
+    return SparseBPPs(i[keep], j[keep], p[keep], bp_pairs.N)
+
+def threshknot(probs, theta=0, iterative=False):
+    '''ThreshKnot: pairs with probability above theta that are the most probable pair of
+    both their nucleotides, pseudoknots allowed.
+
+    Inputs:
+    probs: NxN base pair probability matrix, a stack of them (MxNxN), a SparseBPPs, a list
+        of matrices / SparseBPPs (lengths may differ), or a BPPStore (every entry, in order)
+    theta: probability cutoff
+    iterative: after each round, pick again among the nucleotides still unpaired, until no
+        new pair is found
+
+    Exact ties are broken in favor of the 5'-most pair, so each nucleotide gets one partner.
+
+    Returns: partner array(s) (int32, -1 unpaired) and dot-bracket structure(s), with
+    pseudoknotted stems in [], {}, <>, ...; for a stack, an MxN array and a list of strings,
+    for a list, lists.
+    '''
+    partners = threshknot_partners(probs, theta=theta, iterative=iterative)
+    if isinstance(partners, list):
+        return partners, [convert_partners_to_dotbracket(x) for x in partners]
+    return partners, convert_partners_to_dotbracket(partners)
+
+def threshknot_partners(probs, theta=0, iterative=False):
+    '''Partner arrays of the ThreshKnot structures, see threshknot.'''
+    if isinstance(probs, BPPStore):
+        probs = [x for _, batch in probs.iter_batches(sparse=True) for x in batch]
+    if isinstance(probs, (list, tuple)):
+        items = list(probs)
+    else:
+        items = probs if (isinstance(probs, np.ndarray) and probs.ndim == 3) else [probs]
+
+    rows, i, j, p, lengths = _triples(items, theta)
+
+    # one id per nucleotide across all structures
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    keep = _select(offsets[rows] + i, offsets[rows] + j, p, offsets[-1], iterative)
+
+    if isinstance(probs, np.ndarray) and probs.ndim == 3:
+        return convert_pairs_to_partners(i[keep], j[keep], probs.shape[-1], rows=rows[keep], n_structures=len(items))
+
+    partners = [convert_pairs_to_partners(i[keep][rows[keep] == r], j[keep][rows[keep] == r], N) for r, N in enumerate(lengths)]
+    if isinstance(probs, (list, tuple)):
+        return partners
+    return partners[0]
+
+def _triples(items, theta):
+    '''(structure, i, j, p) of every pair above theta with i < j, sorted; and the lengths'''
+    rows, i, j, p, lengths = [], [], [], [], []
+    for r, item in enumerate(items):
+        if isinstance(item, SparseBPPs):
+            bp_pairs = item.threshold(theta)
+            i_r, j_r, p_r, N = bp_pairs.i.astype(np.int64), bp_pairs.j.astype(np.int64), bp_pairs.p, bp_pairs.N
+        else:
+            item = np.asarray(item)
+            N = item.shape[0]
+            i_r, j_r = np.triu_indices(N, k=1)
+            p_r = np.maximum(item[i_r, j_r], item[j_r, i_r]) # upper triangular input too
+            keep = p_r > theta
+            i_r, j_r, p_r = i_r[keep], j_r[keep], p_r[keep]
+        rows.append(np.full(len(p_r), r))
+        i.append(i_r)
+        j.append(j_r)
+        p.append(p_r)
+        lengths.append(N)
+
+    if len(items) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows).astype(np.int64), np.concatenate(i), np.concatenate(j), np.concatenate(p), np.array(lengths, dtype=np.int64)
+
+def _select(a, b, p, n_nodes, iterative):
+    '''indices of the pairs (a, b) (sorted, a < b, numbered across all structures) kept by ThreshKnot'''
+    paired = np.zeros(n_nodes, dtype=bool)
+    active = np.ones(len(p), dtype=bool)
+    chosen = []
+
+    while active.any():
+        idx = np.flatnonzero(active)
+        maxp = np.zeros(n_nodes)
+        np.maximum.at(maxp, a[idx], p[idx])
+        np.maximum.at(maxp, b[idx], p[idx])
+        keep = idx[(p[idx] == maxp[a[idx]]) & (p[idx] == maxp[b[idx]])]
+
+        # a tie can give a nucleotide two partners; keep the first pair
+        if np.any(np.bincount(np.concatenate([a[keep], b[keep]]), minlength=n_nodes) > 1):
+            used, untied = set(), []
+            for k in keep:
+                if a[k] not in used and b[k] not in used:
+                    used.update([a[k], b[k]])
+                    untied.append(k)
+            keep = np.array(untied, dtype=np.int64)
+
+        chosen.append(keep)
+        paired[a[keep]] = paired[b[keep]] = True
+
+        if not iterative or len(keep) == 0:
+            break
+        active &= ~paired[a] & ~paired[b]
+
+    return np.sort(np.concatenate(chosen)) if chosen else np.zeros(0, dtype=np.int64)
@@ -3,12 +3,14 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .config import package_locs, locate
+from . import pool, cache, npfold
+from .parallel import map_ordered
+from .pfunc import vienna_together_
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+@cache.cached('mfe', together=lambda arguments: vienna_together_(arguments, 'mfe'))
 def mfe(seq, package='vienna_2', T=37,
     constraint=None, motif=None,
     dangles=True, noncanonical=False,
@@ -28,7 +30,7 @@ def mfe(seq, package='vienna_2', T=37,
         noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
 
         Possible packages: 
-        'vienna_2', 'vienna_1','contrafold_1','contrafold_2'
+        'vienna_2', 'vienna_1','contrafold_1','contrafold_2','arnie_np'
         
     Returns
         string: MFE structure
@@ -51,12 +53,83 @@ def mfe(seq, package='vienna_2', T=37,
     elif pkg=='contrafold':
         struct = mfe_contrafold_(seq, version=version, T=T, constraint=constraint, param_file=param_file,viterbi=viterbi)
 
+    elif pkg=='arnie':
+        if version not in [None, 'np']:
+            raise ValueError('package %s not understood, use arnie_np.' % package)
+        struct, _ = npfold.mfe(seq, T=T, constraint=constraint)
+
     else:
         raise ValueError('package %s not understood.' % package)
 
     return struct
 
-def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=None, dangles=True, reweight=None):
+def mfe_batch(seqs, package='vienna_2', T=37, constraints=None,
+    dangles=True, param_file=None, coaxial=True, reweight=None, viterbi=False):
+    ''' Compute MFE structures for many RNA sequences.
+
+        For vienna 2, all sequences (each with its own optional constraint) are folded
+        by a single RNAfold process reading one multi-record input. Other packages
+        fall back to one `mfe` call per sequence.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraint per sequence, None for unconstrained entries
+        (remaining args as in `mfe`)
+
+    Returns
+        list of MFE structures, in input order
+    '''
+    seqs = list(seqs)
+
+    if constraints is not None:
+        constraints = list(constraints)
+        if len(constraints) != len(seqs):
+            raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(seqs)))
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if pkg=='vienna' and (version is None or version.startswith('2')):
+        return mfe_vienna_batch_(seqs, version=version, T=T, dangles=dangles, constraints=constraints,
+            param_file=param_file, reweight=reweight)
+
+    structs = []
+    for i, seq in enumerate(seqs):
+        constraint = constraints[i] if constraints is not None else None
+        structs.append(mfe(seq, package=package, T=T, constraint=constraint, dangles=dangles,
+            param_file=param_file, coaxial=coaxial, reweight=reweight, viterbi=viterbi))
+    return structs
+
+def mfe_many(seqs, package='vienna_2', constraints=None, n_jobs=None, backend='process', raise_errors=False, **kwargs):
+    ''' Compute MFE structures for many RNA sequences on a pool of workers.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraint per sequence, None for unconstrained entries
+        n_jobs (int): number of workers, default os.cpu_count()
+        backend (str): 'process' or 'thread'
+        raise_errors (bool): raise the first failure instead of returning it in place
+        (remaining keyword args are passed to `mfe`)
+
+    Returns
+        list of MFE structures in input order; a failed sequence holds the exception it raised
+    '''
+    seqs = list(seqs)
+    if constraints is None:
+        constraints = [None]*len(seqs)
+    elif len(constraints) != len(seqs):
+        raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(seqs)))
+
+    return map_ordered(_mfe_item, list(zip(seqs, constraints)), n_jobs=n_jobs, backend=backend,
+        raise_errors=raise_errors, package=package, **kwargs)
+
+def _mfe_item(item, **kwargs):
+    seq, constraint = item
+    return mfe(seq, constraint=constraint, **kwargs)
+
+def mfe_vienna_(seq, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, motif=None, param_file=None, dangles=True, reweight=None):
     """get partition function structure representation and Z
 
     Args:
@@ -69,25 +142,67 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
     """
 
     if not version:
-        version='2'
+        version=DEFAULT_VERSIONS['vienna']
+
+    if pool.ENABLED and version.startswith('2') and motif is None:
+        result = pool.fold(seq, 'mfe', constraint=constraint, T=T,
+            dangles=dangles, param_file=param_file, reweight=reweight)
+        if result['omitted']:
+            raise ValueError('Constraint caused impossible structure')
+        return result['lines'][1].split(' ')[0]
+
+    command, stdin = mfe_vienna_command_(seq, T=T, version=version, constraint=constraint, motif=motif,
+        param_file=param_file, dangles=dangles, reweight=reweight)
+
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=scratch_dir())
+    stdout, stderr = p.communicate(input=stdin.encode('utf-8'))
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
+
+    return mfe_vienna_result_(stdout, stderr)
+
+def mfe_vienna_command_(seq, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, motif=None, param_file=None, dangles=True, reweight=None):
+    """build the RNAfold call for `mfe_vienna_`
+
+    Returns
+        list, str: command and stdin
+    """
+
+    if not version:
+        version=DEFAULT_VERSIONS['vienna']
 
     if version.startswith('2'):
-        LOC=package_locs['vienna_2']
+        LOC=locate('vienna_2')
     elif version.startswith('1'):
-        LOC=package_locs['vienna_1']
+        LOC=locate('vienna_1')
     else:
         raise RuntimeError('Error, vienna version %s not present' % version)
 
     command = ['%s/RNAfold' % LOC, '-T', str(T), '-p0'] #p0 doesn't predict bpps, saves time
+
+    # sequence goes in on stdin, and no structure plot is drawn
+    if version.startswith('2'):
+        command.append('--noPS')
+    else:
+        command.append('-noPS')
+
     if motif is not None:
         command.append('--motif="%s"' % motif)
 
     if constraint is not None:
-        fname = write([seq, constraint])
+        stdin = '%s\n%s\n' % (seq, constraint)
         command.append('-C')
         command.append('--enforceConstraint')
     else:
-        fname = write([seq])
+        stdin = '%s\n' % seq
 
     if not dangles:
         command.append('--dangles=0')
@@ -98,11 +213,63 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
     if param_file:
         command.append('--paramFile=%s' % param_file)
 
-    with open(fname) as f:
-        if DEBUG: print(fname)
-        if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = p.communicate()
+    return command, stdin
+
+def mfe_vienna_result_(stdout, stderr):
+    """read the MFE structure from the output of a `mfe_vienna_command_` run"""
+
+    if 'omitting constraint' in stderr.decode('utf-8'):
+        raise ValueError('Constraint caused impossible structure')
+    else:
+        return stdout.decode('utf-8').split('\n')[1].split(' ')[0]
+
+def mfe_vienna_batch_(seqs, T=37, version=DEFAULT_VERSIONS['vienna'], constraints=None, param_file=None, dangles=True, reweight=None):
+    """get MFE structures for many sequences from one multi-record RNAfold run (vienna 2 only)
+
+    Args:
+        seqs (list): nucleic acid sequences
+        T (float): temperature
+        constraints (list): structure constraint or None per sequence
+    Returns
+        list of MFE structures, in input order
+    """
+
+    if not version:
+        version=DEFAULT_VERSIONS['vienna']
+
+    if not version.startswith('2'):
+        raise RuntimeError('Error, batch mode needs vienna 2, got version %s' % version)
+
+    if len(seqs) == 0:
+        return []
+
+    LOC=locate('vienna_2')
+
+    output_id = local_rand_filename()
+
+    command = ['%s/RNAfold' % LOC, '-T', str(T), '--id-prefix=%s' % output_id, '--noPS']
+
+    has_constraints = constraints is not None and any([c is not None for c in constraints])
+
+    if has_constraints:
+        stdin = vienna_records_input(seqs, constraints)
+        command.append('-C')
+        command.append('--enforceConstraint')
+    else:
+        stdin = vienna_records_input(seqs)
+
+    if not dangles:
+        command.append('--dangles=0')
+
+    if reweight is not None:
+        command.append('--commands=%s' % reweight)
+
+    if param_file:
+        command.append('--paramFile=%s' % param_file)
+
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=scratch_dir())
+    stdout, stderr = p.communicate(input=stdin.encode('utf-8'))
 
     if DEBUG:
         print('stdout')
@@ -111,17 +278,27 @@ def mfe_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=
         print(stderr)
 
     if p.returncode:
-        raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
-    os.remove(fname)
-    os.remove('rna.ps')
+        raise Exception('RNAfold failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
 
-    if 'omitting constraint' in stderr.decode('utf-8'):
-        raise ValueError('Constraint caused impossible structure')
-    else:
-        return stdout.decode('utf-8').split('\n')[1].split(' ')[0]
+    records = split_vienna_records(stdout.decode('utf-8'))
+    if len(records) != len(seqs):
+        raise Exception('RNAfold returned %d records for %d sequences\n%s' % (len(records), len(seqs), stderr))
+
+    structs = []
+    for record_id, lines in records:
+        structs.append(lines[1].split(' ')[0])
+
+    if has_constraints and 'omitting constraint' in stderr.decode('utf-8'):
+        # the warning can't be attributed to a record; refolding singly raises for the impossible one
+        for i, constraint in enumerate(constraints):
+            if constraint is not None:
+                mfe_vienna_(seqs[i], T=T, version=version, constraint=constraint, param_file=param_file,
+                    dangles=dangles, reweight=reweight)
+
+    return structs
 
 
-def mfe_contrafold_(seq, T=37, version='2', constraint=None, param_file=None,viterbi=False):
+def mfe_contrafold_(seq, T=37, version=DEFAULT_VERSIONS['contrafold'], constraint=None, param_file=None,viterbi=False):
     """get partition function structure representation and free energy
 
     Args:
@@ -133,17 +310,44 @@ def mfe_contrafold_(seq, T=37, version='2', constraint=None, param_file=None,vit
         float: partition function
         Note: If the constraint is impossible then Z wil be equal to the Z unconstrained
     """
-    if not version: version='2'
+    command, fname = mfe_contrafold_command_(seq, version=version, constraint=constraint, param_file=param_file, viterbi=viterbi)
 
-    fname = '%s.in' % filename()
+    if DEBUG: print(' '.join(command))
+
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    stdout, stderr = p.communicate()
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    remove_files(fname)
+
+    if p.returncode:
+        raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+
+    return mfe_contrafold_result_(stdout)
+
+def mfe_contrafold_command_(seq, version=DEFAULT_VERSIONS['contrafold'], constraint=None, param_file=None, viterbi=False):
+    """build the contrafold call for `mfe_contrafold_`
+
+    Returns
+        list, str: command and the input file written for it
+    """
+    if not version: version=DEFAULT_VERSIONS['contrafold']
 
     if version.startswith('2'):
-        LOC=package_locs['contrafold_2']
+        LOC=locate('contrafold_2')
     elif version.startswith('1'):
-        LOC=package_locs['contrafold_1']
+        LOC=locate('contrafold_1')
     else:
         raise RuntimeError('Error, Contrafold version %s not present' % version)
 
+    fname = '%s.in' % filename()
+
     command = ['%s/contrafold' % LOC, 'predict', fname]
 
     if param_file is not None:
@@ -158,20 +362,8 @@ def mfe_contrafold_(seq, T=37, version='2', constraint=None, param_file=None,vit
     else:
         convert_dbn_to_contrafold_input(seq, ''.join(['.' for x in range(len(seq))]), fname)
 
-    if DEBUG: print(' '.join(command))
-
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-
-    stdout, stderr = p.communicate()
-
-    if DEBUG:
-        print('stdout')
-        print(stdout)
-        print('stderr')
-        print(stderr)
-    if p.returncode:
-        raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+    return command, fname
 
-    os.remove(fname)
-    
+def mfe_contrafold_result_(stdout):
+    """read the predicted structure from the output of a `mfe_contrafold_command_` run"""
     return stdout.decode('utf-8').split('\n')[-2]
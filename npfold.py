@@ -0,0 +1,600 @@
+import os
+import numpy as np
+
+DEBUG=False
+
+# Nearest-neighbor model of package='arnie_np', a subset of Turner 2004 read from
+# parameter_files/rna_turner2004.par (energies at 37 C, kcal/mol):
+#   stacks:          stack table, GU pairs included
+#   hairpins:        initiation by loop length (logarithmic beyond 30) + terminal AU/GU
+#                    penalty; no terminal mismatches, special tri/tetra/hexaloops
+#   bulges:          initiation by length; 1-nt bulges add the stack of the adjacent
+#                    pairs, longer ones the terminal AU/GU penalty of both pairs
+#   interior loops:  initiation by total length + Ninio asymmetry + terminal AU/GU
+#                    penalty of both pairs; no 1x1/1x2/2x2 tables or mismatches
+#   multiloops:      ML_CLOSING + ML_BRANCH per branch (closing pair included) +
+#                    ML_UNPAIRED per unpaired nucleotide + terminal AU/GU penalty per branch
+#   exterior loop:   terminal AU/GU penalty per branch; no dangles or coaxial stacking
+# Interior loops are at most MAXLOOP unpaired nucleotides, hairpins at least 3.
+# Temperature only enters through kT.
+
+PARAMETER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parameter_files', 'rna_turner2004.par')
+
+ML_CLOSING = 3.4
+ML_BRANCH = 0.4
+ML_UNPAIRED = 0.0
+MAXLOOP = 30
+MIN_HAIRPIN = 3
+
+# Vienna pair types: CG, GC, GU, UG, AU, UA are 1..6, 0 is no pair
+PAIR_TYPES = {('C','G'): 1, ('G','C'): 2, ('G','U'): 3, ('U','G'): 4, ('A','U'): 5, ('U','A'): 6}
+RTYPE = np.array([0, 2, 1, 4, 3, 6, 5])
+
+_params = None
+
+def read_parameter_file(fname=PARAMETER_FILE):
+    '''Sections of a ViennaRNA 2.0 parameter file as dict of name -> flat array (dcal/mol, INF as inf).'''
+    sections, name = {}, None
+    with open(fname) as f:
+        for line in f:
+            line = line.split('/*')[0].strip()
+            if line.startswith('#'):
+                name = line[1:].strip()
+                sections[name] = []
+            elif line and name is not None:
+                sections[name].extend([np.inf if x == 'INF' else float(x) for x in line.split()
+                    if x == 'INF' or x.lstrip('-').isdigit()])
+    return {name: np.array(values) for name, values in sections.items()}
+
+def load_parameters():
+    '''Energy arrays of the model (kcal/mol), read once from PARAMETER_FILE.'''
+    global _params
+    if _params is not None:
+        return _params
+
+    raw = read_parameter_file(PARAMETER_FILE)
+
+    stack = np.full([7, 7], np.inf)
+    stack[1:, 1:] = raw['stack'].reshape(7, 7)[:6, :6] / 100
+
+    misc = raw['Misc'] / 100
+    ninio = raw['NINIO'] / 100
+    terminal_AU = np.array([0, 0, 0, 1, 1, 1, 1]) * misc[2]
+
+    # interior loop table over outer type, reversed inner type and the two loop sides
+    interior = np.full([7, 7, MAXLOOP+1, MAXLOOP+1], np.inf)
+    for a in range(MAXLOOP+1):
+        for b in range(MAXLOOP+1-a):
+            u = a + b
+            if u == 0:
+                energy = stack
+            elif a == 0 or b == 0:
+                if u == 1:
+                    energy = raw['bulge'][u]/100 + stack
+                else:
+                    energy = raw['bulge'][u]/100 + terminal_AU[:, None] + terminal_AU[None, :]
+            else:
+                energy = raw['interior'][u]/100 + min(ninio[2], ninio[0]*abs(a-b)) + terminal_AU[:, None] + terminal_AU[None, :]
+            interior[1:, 1:, a, b] = (energy + np.zeros([7, 7]))[1:, 1:]
+
+    _params = {'stack': stack, 'hairpin': raw['hairpin']/100, 'terminal_AU': terminal_AU,
+        'interior': interior, 'lxc': 1.07856}
+    return _params
+
+def kT(T=37):
+    # same constant arnie uses to turn vienna free energies into Z
+    return .0019899*(273+T)
+
+def hairpin_energy(L, t):
+    '''hairpin loop of L unpaired nucleotides closed by pair type t (arrays allowed)'''
+    P = load_parameters()
+    L, t = np.asarray(L), np.asarray(t)
+    init = P['hairpin'][np.minimum(L, MAXLOOP)]
+    with np.errstate(divide='ignore'):
+        extra = np.where(L > MAXLOOP, P['lxc']*np.log(np.maximum(L, 1)/MAXLOOP), 0)
+    return init + extra + P['terminal_AU'][t]
+
+class _Problem:
+    '''sequence, pair types and constraint masks shared by the recursions'''
+
+    def __init__(self, seq, constraint=None):
+        seq = seq.upper().replace('T', 'U')
+        N = len(seq)
+        self.seq, self.N = seq, N
+
+        ptype = np.zeros([N, N], dtype=np.int64)
+        for i in range(N):
+            for j in range(i+MIN_HAIRPIN+1, N):
+                ptype[i, j] = PAIR_TYPES.get((seq[i], seq[j]), 0)
+
+        must_pair = np.zeros(N, dtype=bool)
+        if constraint is not None:
+            if len(constraint) != N:
+                raise ValueError('constraint length %d does not match sequence length %d' % (len(constraint), N))
+            stack, forced = [], []
+            for k, c in enumerate(constraint):
+                if c == '(':
+                    stack.append(k)
+                elif c == ')':
+                    if not stack:
+                        raise ValueError('unbalanced constraint %s' % constraint)
+                    forced.append((stack.pop(), k))
+                elif c == 'x':
+                    ptype[k, :] = 0
+                    ptype[:, k] = 0
+                elif c != '.':
+                    raise ValueError("constraint character %s not understood, use '(', ')', 'x' or '.'" % c)
+            if stack:
+                raise ValueError('unbalanced constraint %s' % constraint)
+
+            idx = np.arange(N)
+            for p, q in forced:
+                keep = ptype[p, q]
+                ptype[p, :] = ptype[:, p] = ptype[q, :] = ptype[:, q] = 0
+                ptype[p, q] = keep
+                # no pair may cross a forced one
+                inside = (idx > p) & (idx < q)
+                outside = (idx < p) | (idx > q)
+                ptype[np.ix_(inside, outside)] = 0
+                ptype[np.ix_(outside, inside)] = 0
+                must_pair[[p, q]] = True
+
+        self.ptype = np.triu(ptype)
+        self.allowed = self.ptype > 0
+        # n_paired[x]: nucleotides among 0..x-1 that can't be left unpaired
+        self.n_paired = np.concatenate([[0], np.cumsum(must_pair)])
+
+    def free(self, p, q):
+        '''True where all of p..q (inclusive, empty if q < p) may be unpaired'''
+        p, q = np.asarray(p), np.asarray(q)
+        return (q < p) | (self.n_paired[np.clip(q+1, 0, self.N)] == self.n_paired[np.clip(p, 0, self.N)])
+
+def _logsumexp(x, axis=-1):
+    if x.shape[axis] == 0:
+        return np.full(np.delete(x.shape, axis), -np.inf)
+    m = np.max(x, axis=axis, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0)
+    with np.errstate(divide='ignore'):
+        return np.squeeze(np.log(np.sum(np.exp(x - m), axis=axis, keepdims=True)) + m, axis)
+
+def _loop_sizes():
+    a, b = np.meshgrid(np.arange(MAXLOOP+1), np.arange(MAXLOOP+1), indexing='ij')
+    keep = a + b <= MAXLOOP
+    return a[keep], b[keep]
+
+def _inside(prob, kT, reduce):
+    '''Fill QB, QM1, QM, QMM and the exterior E5 one anti-diagonal at a time.
+
+    Values are weights -E/kT combined with `reduce`: log-sum-exp gives log partition
+    functions, max (with kT=1) gives minus the minimum free energies.
+
+    QB[i,j]   i and j pair
+    QM1[i,j]  one multiloop branch starting with pair (i,l), l+1..j unpaired
+    QM[i,j]   one or more multiloop branches within i..j
+    QMM[i,j]  two or more multiloop branches within i..j
+    E5[j]     exterior loop of 0..j-1
+    '''
+    P = load_parameters()
+    N, ptype = prob.N, prob.ptype
+    AU = P['terminal_AU']
+    A, B = _loop_sizes()
+
+    QB, QM1, QM, QMM = [np.full([N, N], -np.inf) for _ in range(4)]
+
+    for d in range(MIN_HAIRPIN+1, N):
+        i = np.arange(N-d)
+        j = i + d
+        t = ptype[i, j]
+
+        terms = [np.where(prob.free(i+1, j-1), -hairpin_energy(d-1, t)/kT, -np.inf)[:, None]]
+
+        # interior loops, only for the cells that can pair
+        ab = A + B <= d - MIN_HAIRPIN - 3
+        c = np.flatnonzero(t)
+        if ab.any() and len(c):
+            a, b = A[ab], B[ab]
+            ic, jc = i[c, None], j[c, None]
+            k, l = ic + a + 1, jc - b - 1
+            energy = P['interior'][t[c, None], RTYPE[ptype[k, l]], a, b]
+            ok = prob.free(ic+1, k-1) & prob.free(l+1, jc-1)
+            loops = np.full([len(i), 1], -np.inf)
+            loops[c, 0] = reduce(np.where(ok, QB[k, l] - energy/kT, -np.inf), axis=1)
+            terms.append(loops)
+
+        if d >= 2*(MIN_HAIRPIN+2)+2:
+            terms.append((QMM[i+1, j-1] - (ML_CLOSING + ML_BRANCH + AU[t])/kT)[:, None])
+
+        QB[i, j] = np.where(t > 0, reduce(np.concatenate(terms, axis=1), axis=1), -np.inf)
+
+        # one branch (i,l), then unpaired up to j
+        m = np.arange(MIN_HAIRPIN+1, d+1)
+        l = i[:, None] + m
+        QM1[i, j] = reduce(np.where(prob.free(l+1, j[:, None]),
+            QB[i[:, None], l] - (ML_BRANCH + AU[ptype[i[:, None], l]] + ML_UNPAIRED*(d-m))/kT, -np.inf), axis=1)
+
+        # unpaired i..u-1 or branches in i..u-1, then the branch starting at u
+        s = np.arange(0, d-MIN_HAIRPIN)
+        u = i[:, None] + s
+        first = np.where(prob.free(i[:, None], u-1), QM1[u, j[:, None]] - ML_UNPAIRED*s/kT, -np.inf)
+        more = np.where(s > 0, QM[i[:, None], np.maximum(u-1, 0)] + QM1[u, j[:, None]], -np.inf)
+        QM[i, j] = reduce(np.concatenate([first, more], axis=1), axis=1)
+        QMM[i, j] = reduce(more, axis=1)
+
+    E5 = np.full(N+1, -np.inf)
+    E5[0] = 0
+    can_unpair = prob.free(np.arange(N), np.arange(N))
+    for j in range(1, N+1):
+        k = np.arange(j)
+        options = E5[k] + QB[k, j-1] - AU[ptype[k, j-1]]/kT
+        E5[j] = reduce(np.append(options, E5[j-1] if can_unpair[j-1] else -np.inf))
+
+    return {'QB': QB, 'QM1': QM1, 'QM': QM, 'QMM': QMM, 'E5': E5}
+
+def _outside(prob, kT, inside):
+    '''Outside weights of QB (log space), gathered from the parents of each cell,
+    longest spans first.'''
+    P = load_parameters()
+    N, ptype = prob.N, prob.ptype
+    AU = P['terminal_AU']
+    A, B = _loop_sizes()
+    QB, QM1, QM, E5 = inside['QB'], inside['QM1'], inside['QM'], inside['E5']
+
+    oE5 = np.full(N+1, -np.inf)
+    oE5[N] = 0
+    can_unpair = prob.free(np.arange(N), np.arange(N))
+    for j in range(N, 0, -1):
+        if can_unpair[j-1]:
+            oE5[j-1] = np.logaddexp(oE5[j-1], oE5[j])
+        k = np.arange(j)
+        oE5[k] = np.logaddexp(oE5[k], oE5[j] + QB[k, j-1] - AU[ptype[k, j-1]]/kT)
+
+    oQB, oQM1, oQM, oQMM = [np.full([N, N], -np.inf) for _ in range(4)]
+
+    for d in range(N-1, MIN_HAIRPIN, -1):
+        i = np.arange(N-d)
+        j = i + d
+        t = ptype[i, j]
+
+        # QMM[i,j] closes the multiloop of pair (i-1, j+1)
+        p, q = np.maximum(i-1, 0), np.minimum(j+1, N-1)
+        ok = (i >= 1) & (j <= N-2)
+        oQMM[i, j] = np.where(ok, oQB[p, q] - (ML_CLOSING + ML_BRANCH + AU[ptype[p, q]])/kT, -np.inf)
+
+        # QM[i,j] followed by the branch QM1[j+1, r] inside QM[i,r] or QMM[i,r]
+        r = j[:, None] + np.arange(1, N-d)
+        ok = r <= N-1
+        r = np.minimum(r, N-1)
+        right = np.where(ok, QM1[np.minimum(j[:, None]+1, N-1), r], -np.inf)
+        oQM[i, j] = _logsumexp(np.concatenate([oQM[i[:, None], r] + right, oQMM[i[:, None], r] + right], axis=1), axis=1)
+
+        # QM1[i,j] as the first branch of QM[h,j] (h..i-1 unpaired) or after branches QM[h,i-1]
+        s = np.arange(0, N-d)
+        h = i[:, None] - s
+        ok = h >= 0
+        h = np.maximum(h, 0)
+        first = np.where(ok & prob.free(h, i[:, None]-1), oQM[h, j[:, None]] - ML_UNPAIRED*s/kT, -np.inf)
+        left = np.where(ok & (s > 0), QM[h, np.maximum(i[:, None]-1, 0)], -np.inf)
+        oQM1[i, j] = _logsumexp(np.concatenate([first, oQM[h, j[:, None]] + left, oQMM[h, j[:, None]] + left], axis=1), axis=1)
+
+        # QB[i,j]: branch of QM1[i,r], inner pair of an interior loop, or exterior pair
+        terms = []
+        m = np.arange(0, N-d)
+        r = j[:, None] + m
+        ok = (r <= N-1)
+        r = np.minimum(r, N-1)
+        terms.append(np.where(ok & prob.free(j[:, None]+1, r),
+            oQM1[i[:, None], r] - (ML_BRANCH + AU[t][:, None] + ML_UNPAIRED*m)/kT, -np.inf))
+
+        ab = A + B <= N - d - 3
+        c = np.flatnonzero(t)
+        if ab.any() and len(c):
+            a, b = A[ab], B[ab]
+            ic, jc = i[c, None], j[c, None]
+            p, q = ic - a - 1, jc + b + 1
+            ok = (p >= 0) & (q <= N-1)
+            p, q = np.maximum(p, 0), np.minimum(q, N-1)
+            energy = P['interior'][ptype[p, q], RTYPE[t[c, None]], a, b]
+            ok &= prob.free(p+1, ic-1) & prob.free(jc+1, q-1)
+            loops = np.full([len(i), 1], -np.inf)
+            loops[c, 0] = _logsumexp(np.where(ok, oQB[p, q] - energy/kT, -np.inf), axis=1)
+            terms.append(loops)
+
+        terms.append((E5[i] + oE5[j+1] - AU[t]/kT)[:, None])
+
+        oQB[i, j] = np.where(t > 0, _logsumexp(np.concatenate(terms, axis=1), axis=1), -np.inf)
+
+    return oQB
+
+def fold(seq, T=37, constraint=None, bpps=True):
+    '''McCaskill partition function of the arnie_np model.
+
+    Args:
+    seq (str): nucleic acid sequence
+    T (float): temperature (Celsius)
+    constraint (str): '(' ')' forced pairs, 'x' unpaired, '.' free
+    bpps (bool): also compute base pair probabilities (outside pass)
+
+    Returns
+    dict with 'logZ', 'free_energy' (kcal/mol, inf if the constraint is impossible)
+    and 'bpps' (NxN array, or None)
+    '''
+    prob = _Problem(seq, constraint)
+    result = {'logZ': -np.inf, 'free_energy': np.inf, 'bpps': None}
+
+    if prob.N == 0:
+        result['logZ'], result['free_energy'] = 0.0, 0.0
+        if bpps:
+            result['bpps'] = np.zeros([0, 0])
+        return result
+
+    inside = _inside(prob, kT(T), _logsumexp)
+    logZ = inside['E5'][prob.N]
+    result['logZ'] = logZ
+    result['free_energy'] = -kT(T)*logZ if np.isfinite(logZ) else np.inf
+
+    if bpps:
+        probs = np.zeros([prob.N, prob.N])
+        if np.isfinite(logZ):
+            oQB = _outside(prob, kT(T), inside)
+            with np.errstate(invalid='ignore'):
+                probs = np.where(prob.allowed, np.exp(inside['QB'] + oQB - logZ), 0)
+            probs = probs + probs.T
+        result['bpps'] = probs
+
+    return result
+
+def mfe(seq, T=37, constraint=None):
+    '''Minimum free energy structure of the arnie_np model.
+
+    Returns
+    str, float: dot-bracket structure and its free energy (kcal/mol)
+    '''
+    prob = _Problem(seq, constraint)
+    if prob.N == 0:
+        return '', 0.0
+
+    inside = _inside(prob, 1, lambda x, axis=-1: np.max(x, axis=axis))
+    if not np.isfinite(inside['E5'][prob.N]):
+        raise ValueError('Constraint caused impossible structure')
+
+    pairs = _traceback(prob, inside)
+    structure = ['.']*prob.N
+    for i, j in pairs:
+        structure[i], structure[j] = '(', ')'
+    return ''.join(structure), -inside['E5'][prob.N]
+
+def _traceback(prob, inside, tol=1e-9):
+    P = load_parameters()
+    AU, ptype = P['terminal_AU'], prob.ptype
+    QB, QM1, QM, QMM, E5 = inside['QB'], inside['QM1'], inside['QM'], inside['QMM'], inside['E5']
+    close = lambda a, b: abs(a - b) <= tol*max(1, abs(b))
+
+    pairs, todo = [], [('E5', prob.N, None)]
+    while todo:
+        kind, i, j = todo.pop()
+
+        if kind == 'E5':
+            if i == 0:
+                continue
+            if prob.free(i-1, i-1) and close(E5[i-1], E5[i]):
+                todo.append(('E5', i-1, None))
+                continue
+            for k in range(i):
+                if ptype[k, i-1] and close(E5[k] + QB[k, i-1] - AU[ptype[k, i-1]], E5[i]):
+                    todo += [('E5', k, None), ('QB', k, i-1)]
+                    break
+
+        elif kind == 'QB':
+            pairs.append((i, j))
+            t = ptype[i, j]
+            if prob.free(i+1, j-1) and close(-hairpin_energy(j-i-1, t), QB[i, j]):
+                continue
+            found = False
+            for a in range(MAXLOOP+1):
+                for b in range(MAXLOOP+1-a):
+                    k, l = i+a+1, j-b-1
+                    if l-k > MIN_HAIRPIN and ptype[k, l] and prob.free(i+1, k-1) and prob.free(l+1, j-1) \
+                        and close(QB[k, l] - P['interior'][t, RTYPE[ptype[k, l]], a, b], QB[i, j]):
+                        todo.append(('QB', k, l))
+                        found = True
+                        break
+                if found:
+                    break
+            if not found:
+                todo.append(('QMM', i+1, j-1))
+
+        elif kind == 'QM1':
+            for l in range(i+MIN_HAIRPIN+1, j+1):
+                if ptype[i, l] and prob.free(l+1, j) \
+                    and close(QB[i, l] - ML_BRANCH - AU[ptype[i, l]] - ML_UNPAIRED*(j-l), QM1[i, j]):
+                    todo.append(('QB', i, l))
+                    break
+
+        else: # QM, QMM
+            for u in range(i, j-MIN_HAIRPIN):
+                if kind == 'QM' and prob.free(i, u-1) and close(QM1[u, j] - ML_UNPAIRED*(u-i), QM[i, j]):
+                    todo.append(('QM1', u, j))
+                    break
+                if u > i and close(QM[i, u-1] + QM1[u, j], (QM if kind == 'QM' else QMM)[i, j]):
+                    todo += [('QM', i, u-1), ('QM1', u, j)]
+                    break
+
+    return sorted(pairs)
+
+def sample(seq, n_samples=10, T=37, constraint=None, seed=None):
+    '''Boltzmann sampled structures of the arnie_np model, by stochastic traceback.
+
+    Args:
+    seed (int or np.random.Generator): same seed, same samples
+
+    Returns
+    list of dot-bracket structures, array of their energies (kcal/mol), array of
+    their Boltzmann probabilities
+    '''
+    for chunk in sample_iter(seq, n_samples=n_samples, T=T, constraint=constraint, seed=seed, chunk_size=max(n_samples, 1)):
+        return chunk
+    return [], np.zeros(0), np.zeros(0)
+
+def sample_iter(seq, n_samples=10, T=37, constraint=None, seed=None, chunk_size=1000):
+    '''`sample`, chunk_size structures at a time, all drawn from one inside pass and one
+    random stream: the chunks joined are the samples `sample` gives for the same seed.
+
+    Yields
+    (structures, energies, probabilities) per chunk
+    '''
+    prob = _Problem(seq, constraint)
+    rng = np.random.default_rng(seed)
+    sizes = [min(chunk_size, n_samples - start) for start in range(0, n_samples, chunk_size)]
+    if prob.N == 0:
+        for n in sizes:
+            yield ['']*n, np.zeros(n), np.ones(n)
+        return
+
+    inside = _inside(prob, kT(T), _logsumexp)
+    logZ = inside['E5'][prob.N]
+    if not np.isfinite(logZ):
+        raise ValueError('Constraint caused impossible structure')
+
+    options = {}
+    for n in sizes:
+        structures = []
+        for _ in range(n):
+            structure = ['.']*prob.N
+            for i, j in _stochastic_traceback(prob, inside, kT(T), rng, options):
+                structure[i], structure[j] = '(', ')'
+            structures.append(''.join(structure))
+
+        energies = np.array([energy_of_structure(seq, s, T=T) for s in structures])
+        yield structures, energies, np.exp(-energies/kT(T) - logZ)
+
+def _stochastic_traceback(prob, inside, kT, rng, options):
+    '''_traceback, picking each option with probability proportional to its weight.
+
+    `options` caches the cumulative distribution over the options of each visited cell,
+    shared across samples: after the first few samples most cells are lookups.
+    '''
+    P = load_parameters()
+    AU, ptype = P['terminal_AU'], prob.ptype
+    QB, QM1, QM, QMM, E5 = inside['QB'], inside['QM1'], inside['QM'], inside['QMM'], inside['E5']
+
+    def distribution(kind, i, j):
+        if kind == 'E5':
+            k = np.arange(i)
+            weights = np.append(E5[k] + QB[k, i-1] - AU[ptype[k, i-1]]/kT, E5[i-1] if prob.free(i-1, i-1) else -np.inf)
+            aux = None
+        elif kind == 'QB':
+            t, d = ptype[i, j], j - i
+            A, B = _loop_sizes()
+            ab = A + B <= d - MIN_HAIRPIN - 3
+            a, b = A[ab], B[ab]
+            k, l = i + a + 1, j - b - 1
+            interior = np.where(prob.free(i+1, k-1) & prob.free(l+1, j-1),
+                QB[k, l] - P['interior'][t, RTYPE[ptype[k, l]], a, b]/kT, -np.inf)
+            hairpin = -hairpin_energy(d-1, t)/kT if prob.free(i+1, j-1) else -np.inf
+            multi = QMM[i+1, j-1] - (ML_CLOSING + ML_BRANCH + AU[t])/kT if d >= 2*(MIN_HAIRPIN+2)+2 else -np.inf
+            weights = np.concatenate([[hairpin, multi], interior])
+            aux = (k, l)
+        elif kind == 'QM1':
+            l = np.arange(i+MIN_HAIRPIN+1, j+1)
+            weights = np.where(prob.free(l+1, j), QB[i, l] - (ML_BRANCH + AU[ptype[i, l]] + ML_UNPAIRED*(j-l))/kT, -np.inf)
+            aux = l
+        else: # QM, QMM
+            u = np.arange(i, j-MIN_HAIRPIN)
+            more = np.where(u > i, QM[i, np.maximum(u-1, 0)] + QM1[u, j], -np.inf)
+            first = np.where(prob.free(i, u-1), QM1[u, j] - ML_UNPAIRED*(u-i)/kT, -np.inf) if kind == 'QM' else np.full(len(u), -np.inf)
+            weights = np.concatenate([first, more])
+            aux = u
+        cdf = np.cumsum(np.exp(weights - np.max(weights)))
+        return cdf/cdf[-1], aux
+
+    pairs, todo = [], [('E5', prob.N, None)]
+    while todo:
+        kind, i, j = todo.pop()
+        if kind == 'E5' and i == 0:
+            continue
+
+        if (kind, i, j) not in options:
+            options[kind, i, j] = distribution(kind, i, j)
+        cdf, aux = options[kind, i, j]
+        c = min(int(np.searchsorted(cdf, rng.random(), side='right')), len(cdf)-1)
+
+        if kind == 'E5':
+            todo += [('E5', i-1, None)] if c == i else [('E5', c, None), ('QB', c, i-1)]
+
+        elif kind == 'QB':
+            pairs.append((i, j))
+            if c == 1:
+                todo.append(('QMM', i+1, j-1))
+            elif c > 1:
+                todo.append(('QB', int(aux[0][c-2]), int(aux[1][c-2])))
+
+        elif kind == 'QM1':
+            todo.append(('QB', i, int(aux[c])))
+
+        else: # QM, QMM
+            u = aux
+            if c < len(u):
+                todo.append(('QM1', int(u[c]), j))
+            else:
+                todo += [('QM', i, int(u[c-len(u)])-1), ('QM1', int(u[c-len(u)]), j)]
+
+    return sorted(pairs)
+
+def energy_of_structure(seq, structure, T=37):
+    '''Free energy (kcal/mol) of one secondary structure in the arnie_np model, loop by loop.
+
+    Returns inf for structures the model doesn't allow (non-canonical pairs, hairpins
+    under 3 nucleotides, interior loops over MAXLOOP).
+    '''
+    P = load_parameters()
+    AU = P['terminal_AU']
+    seq = seq.upper().replace('T', 'U')
+    N = len(seq)
+
+    partner, stack = [-1]*N, []
+    for k, c in enumerate(structure):
+        if c == '(':
+            stack.append(k)
+        elif c == ')':
+            i = stack.pop()
+            partner[i], partner[k] = k, i
+
+    def pair_type(i, j):
+        return PAIR_TYPES.get((seq[i], seq[j]), 0)
+
+    def branches(i, j):
+        '''pairs directly inside i..j, and the number of unpaired nucleotides between them'''
+        found, unpaired, k = [], 0, i
+        while k <= j:
+            if partner[k] > k:
+                found.append((k, partner[k]))
+                k = partner[k] + 1
+            else:
+                unpaired += 1
+                k += 1
+        return found, unpaired
+
+    energy = 0.0
+    for i in range(N):
+        j = partner[i]
+        if j < i:
+            continue
+        t = pair_type(i, j)
+        if t == 0 or j-i-1 < MIN_HAIRPIN:
+            return np.inf
+        inner, unpaired = branches(i+1, j-1)
+        if len(inner) == 0:
+            energy += hairpin_energy(j-i-1, t)
+        elif len(inner) == 1:
+            k, l = inner[0]
+            a, b = k-i-1, j-l-1
+            if a + b > MAXLOOP:
+                return np.inf
+            energy += P['interior'][t, RTYPE[pair_type(k, l)], a, b]
+        else:
+            energy += ML_CLOSING + ML_BRANCH*(len(inner)+1) + ML_UNPAIRED*unpaired + AU[t] \
+                + sum(AU[pair_type(k, l)] for k, l in inner)
+
+    outer, _ = branches(0, N-1)
+    energy += sum(AU[pair_type(k, l)] for k, l in outer)
+    return float(energy)
@@ -0,0 +1,127 @@
+import os, pickle, secrets, traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+DEBUG=False
+
+# arrays at least this big come back from worker processes through shared memory instead of a pickle
+SHARED_MEMORY_MIN_BYTES = 1<<20
+
+def map_ordered(func, items, n_jobs=None, backend='process', raise_errors=False, chunksize=1, **kwargs):
+    '''Apply `func(item, **kwargs)` to every item on a pool of workers.
+
+    Args:
+    func (callable): module-level function (must be picklable for the process backend)
+    items (list): inputs
+    n_jobs (int): number of workers, default os.cpu_count(). 1 runs serially in this process.
+    backend (str): 'process' or 'thread'. Threads suit the folding packages, which mostly wait on a subprocess.
+    raise_errors (bool): re-raise the first failure instead of returning it
+    chunksize (int): items handed to a process worker at a time
+
+    Returns
+    list of results in input order. A failed item holds the exception it raised, or
+    BrokenProcessPool if a worker process died before finishing it.
+    '''
+    items = list(items)
+
+    if backend not in ['process', 'thread']:
+        raise ValueError('backend %s not understood, use process or thread.' % backend)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    if n_jobs == 1 or len(items) <= 1:
+        results = [_call(func, item, kwargs) for item in items]
+
+    elif backend == 'thread':
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(lambda item: _call(func, item, kwargs), items))
+
+    else:
+        results = _map_processes(func, items, n_jobs, chunksize, kwargs)
+
+    if raise_errors:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    return results
+
+def _call(func, item, kwargs):
+    try:
+        return func(item, **kwargs)
+    except Exception as e:
+        if DEBUG: traceback.print_exc()
+        return e
+
+def _map_processes(func, items, n_jobs, chunksize, kwargs):
+    '''a future per chunk of items, so a worker that dies (BrokenProcessPool) only fails the
+    items it hit, or that were still waiting, and the rest keep their results'''
+    # shared memory blocks are named after their item, so those of results lost with a dead worker can be found
+    prefix = 'arnie_%s' % secrets.token_hex(6)
+    indexed = list(enumerate(items))
+    chunks = [indexed[k:k+chunksize] for k in range(0, len(items), chunksize)]
+    executor = ProcessPoolExecutor(max_workers=n_jobs)
+    results = []
+    try:
+        futures = [executor.submit(_call_chunk_in_process, func, chunk, kwargs, prefix) for chunk in chunks]
+        for future, chunk in zip(futures, chunks):
+            try:
+                packed = future.result()
+            except Exception as e:
+                if DEBUG: traceback.print_exc()
+                packed = [('result', e)]*len(chunk)
+            for x in packed:
+                results.append(_unpack(x))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        for index in range(len(items)):
+            if index >= len(results) or isinstance(results[index], Exception):
+                _unlink('%s_%d' % (prefix, index))
+    return results
+
+def _call_chunk_in_process(func, chunk, kwargs, prefix):
+    return [_call_in_process(func, item, kwargs, '%s_%d' % (prefix, index)) for index, item in chunk]
+
+def _call_in_process(func, item, kwargs, name):
+    result = _call(func, item, kwargs)
+
+    if isinstance(result, Exception):
+        try:
+            pickle.dumps(result)
+        except Exception:
+            result = RuntimeError(''.join(traceback.format_exception_only(type(result), result)))
+        return ('result', result)
+
+    if isinstance(result, np.ndarray) and result.nbytes >= SHARED_MEMORY_MIN_BYTES:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=result.nbytes)
+        np.ndarray(result.shape, dtype=result.dtype, buffer=shm.buf)[...] = result
+        # the parent unlinks it; keep this worker's resource tracker from doing so too
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        shm.close()
+        return ('shared_memory', (shm.name, result.shape, result.dtype.str))
+
+    return ('result', result)
+
+def _unpack(packed):
+    kind, payload = packed
+    if kind == 'result':
+        return payload
+
+    name, shape, dtype = payload
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        result = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+def _unlink(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
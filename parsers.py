@@ -0,0 +1,117 @@
+import io, re
+import numpy as np
+
+DEBUG=False
+
+# Each parser reads a whole output in one go, finds the block holding the pairs with a
+# single regex search and hands that block to np.loadtxt, returning 0-indexed arrays
+# i, j and p in file order. Outputs laid out unexpectedly go through a slower regex
+# over every line instead.
+
+_number = rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+
+def _read(fname):
+    with open(fname, 'rb') as f:
+        return f.read()
+
+def _empty():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+def _table(block, usecols):
+    return np.loadtxt(io.BytesIO(block), comments='%', usecols=usecols, ndmin=2)
+
+def _triples(fields):
+    '''(i, j, p) regex matches as byte strings -> 0-indexed int i, j and float p'''
+    if len(fields) == 0:
+        return _empty()
+    fields = np.array(fields, dtype=bytes)
+    return fields[:,0].astype(np.int64) - 1, fields[:,1].astype(np.int64) - 1, fields[:,2].astype(np.float64)
+
+_vienna_ubox = re.compile(rb'^[ \t]*(\d+)[ \t]+(\d+)[ \t]+(' + _number + rb')[ \t]+ubox[ \t]*\r?$', re.M)
+
+def parse_vienna_dot_plot(fname):
+    '''pair probabilities from the `i j sqrt(p) ubox` lines of an RNAfold dot plot'''
+    data = _read(fname)
+
+    first = _vienna_ubox.search(data)
+    if first is None:
+        return _empty()
+
+    # pair lines run up to showpage; the mfe structure's `lbox` lines are mixed in
+    end = data.find(b'showpage', first.start())
+    block = data[first.start():end if end >= 0 else len(data)]
+    try:
+        table = _table(block.replace(b'ubox', b'1').replace(b'lbox', b'0'), (0,1,2,3))
+        table = table[table[:,3] == 1]
+        i, j, sqrt_p = table[:,0].astype(np.int64) - 1, table[:,1].astype(np.int64) - 1, table[:,2]
+    except ValueError:
+        if DEBUG: print('unexpected dot plot layout in %s' % fname)
+        i, j, sqrt_p = _triples(_vienna_ubox.findall(data))
+
+    return i, j, sqrt_p**2
+
+_contrafold_line = re.compile(rb'^[ \t]*(\d+)[ \t]+\S+([^\n]*)$', re.M)
+_contrafold_pair = re.compile(rb'(\d+):(' + _number + rb')')
+
+def parse_contrafold_posteriors(fname):
+    '''pair probabilities from a contrafold `--posteriors` file (`i base j:p j:p ...` per line)'''
+    lines = _contrafold_line.findall(_read(fname))
+    counts = np.array([rest.count(b':') for _, rest in lines], dtype=np.int64)
+    if counts.sum() == 0:
+        return _empty()
+
+    i = np.repeat(np.array([first for first, _ in lines], dtype=bytes).astype(np.int64) - 1, counts)
+
+    rests = b' '.join([rest for _, rest in lines])
+    try:
+        values = np.loadtxt(io.BytesIO(rests.replace(b':', b' ')), ndmin=1)
+        if len(values) != 2*len(i):
+            raise ValueError
+        j, p = values[0::2].astype(np.int64) - 1, values[1::2]
+    except ValueError:
+        if DEBUG: print('unexpected posteriors layout in %s' % fname)
+        pairs = np.array(_contrafold_pair.findall(rests), dtype=bytes)
+        j, p = pairs[:,0].astype(np.int64) - 1, pairs[:,1].astype(np.float64)
+
+    return i, j, p
+
+_pair_line = re.compile(rb'^[ \t]*(\d+)[ \t]+(\d+)[ \t]+(' + _number + rb')', re.M)
+
+def parse_nupack_ppairs(fname, N):
+    '''pair probabilities from a nupack `pairs` .ppairs file, leaving out the j = N+1 (unpaired) lines'''
+    data = _read(fname)
+
+    first = _pair_line.search(data) # after the % header and the line holding N
+    if first is None:
+        return _empty()
+    try:
+        table = _table(data[first.start():], (0,1,2))
+        i, j, p = table[:,0].astype(np.int64) - 1, table[:,1].astype(np.int64) - 1, table[:,2]
+    except ValueError:
+        if DEBUG: print('unexpected ppairs layout in %s' % fname)
+        i, j, p = _triples(_pair_line.findall(data))
+
+    keep = j < N
+    return i[keep], j[keep], p[keep]
+
+def parse_rnastructure_probs(fname):
+    '''pair probabilities from `ProbabilityPlot -t` text output (two header lines, then `i j -log10(p)`)'''
+    table = np.loadtxt(fname, skiprows=2, usecols=(0,1,2), ndmin=2)
+    return table[:,0].astype(np.int64) - 1, table[:,1].astype(np.int64) - 1, 10**(-1*table[:,2])
+
+def parse_vfold_pij(fname):
+    '''pair probabilities from a Vfold2d .pij file (columns i, _, j, p)'''
+    table = np.loadtxt(fname, usecols=(0,2,3), ndmin=2)
+    return table[:,0].astype(np.int64) - 1, table[:,1].astype(np.int64) - 1, table[:,2]
+
+def parse_rnasoft_pairs(stdout):
+    '''pair probabilities from simfold_pf stdout; its indices are already 0-based
+
+    Args:
+    stdout (str): pair lines of the output, see `rnasoft_pair_lines_`
+    '''
+    data = stdout.encode('utf-8')
+    if not data.strip():
+        return _empty()
+    table = _table(data, (0,1,2))
+    return table[:,0].astype(np.int64), table[:,1].astype(np.int64), table[:,2]
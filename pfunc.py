@@ -3,12 +3,17 @@ import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .config import package_locs, locate
+from . import pool, cache
+from .parallel import map_ordered
+from .sparse import triples_to_bpps
+from .parsers import parse_vienna_dot_plot
+from . import npfold
 
 DEBUG=False
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
-
+@cache.cached('pfunc', skip=lambda arguments: arguments['bpps'], # bpps hands back a temp file
+    together=lambda arguments: vienna_together_(arguments, 'pfunc'))
 def pfunc(seq, package='vienna_2', T=37,
     constraint=None, motif=None,
     dangles=True, noncanonical=False,
@@ -25,7 +30,8 @@ def pfunc(seq, package='vienna_2', T=37,
         noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
 
         Possible packages: 
-        'vienna_2', 'vienna_1','contrafold_1','contrafold_2','nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1'
+        'vienna_2', 'vienna_1','contrafold_1','contrafold_2','nupack_95','nupack_99','rnasoft_2007','rnasoft_1999','rnastructure','vfold_0','vfold_1',
+        'arnie_np' (built-in numpy model, see npfold.py)
         
     Returns
         float: free energy 
@@ -63,6 +69,9 @@ def pfunc(seq, package='vienna_2', T=37,
     elif pkg=='vfold':
         Z, tmp_file = pfunc_vfold_(seq, version=version, T=T, coaxial=coaxial)
 
+    elif pkg=='arnie':
+        Z, tmp_file = pfunc_arnie_(seq, version=version, T=T, constraint=constraint, return_free_energy=return_free_energy)
+
     else:
         raise ValueError('package %s not understood.' % package)
 
@@ -75,7 +84,147 @@ def pfunc(seq, package='vienna_2', T=37,
                 os.remove(tmp_file)
         return Z
 
-def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_file=None,
+def pfunc_batch(seqs, package='vienna_2', T=37, constraints=None,
+    dangles=True, bpps=False, param_file=None, coaxial=True, reweight=None, return_free_energy=False):
+    ''' Compute partition functions for many RNA sequences.
+
+        For vienna 2, all sequences (each with its own optional constraint) are folded
+        by a single RNAfold process reading one multi-record input. Other packages
+        fall back to one `pfunc` call per sequence.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraint per sequence, None for unconstrained entries
+        (remaining args as in `pfunc`)
+
+    Returns
+        list: Z (or free energy) per sequence, in input order.
+            If bpps, list of (Z, tmp_file) tuples as returned by `pfunc(..., bpps=True)`.
+    '''
+    seqs = list(seqs)
+
+    if constraints is not None:
+        constraints = list(constraints)
+        if len(constraints) != len(seqs):
+            raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(seqs)))
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if pkg=='vienna' and (version is None or version.startswith('2')):
+        results = pfunc_vienna_batch_(seqs, version=version, T=T, dangles=dangles, constraints=constraints,
+            bpps=bpps, param_file=param_file, reweight=reweight, return_free_energy=return_free_energy)
+        if bpps:
+            return results
+        return [Z for Z, _ in results]
+
+    results = []
+    for i, seq in enumerate(seqs):
+        constraint = constraints[i] if constraints is not None else None
+        results.append(pfunc(seq, package=package, T=T, constraint=constraint, dangles=dangles, bpps=bpps,
+            param_file=param_file, coaxial=coaxial, reweight=reweight, return_free_energy=return_free_energy))
+    return results
+
+def pfunc_many(seqs, package='vienna_2', constraints=None, n_jobs=None, backend='process', raise_errors=False, **kwargs):
+    ''' Compute partition functions for many RNA sequences on a pool of workers.
+
+        Args:
+        seqs (list): nucleic acid sequences
+        constraints (list): structure constraint per sequence, None for unconstrained entries
+        n_jobs (int): number of workers, default os.cpu_count()
+        backend (str): 'process' or 'thread'
+        raise_errors (bool): raise the first failure instead of returning it in place
+        (remaining keyword args are passed to `pfunc`)
+
+    Returns
+        list of Z (or free energies) in input order; a failed sequence holds the exception it raised
+    '''
+    seqs = list(seqs)
+    if constraints is None:
+        constraints = [None]*len(seqs)
+    elif len(constraints) != len(seqs):
+        raise ValueError('Need one constraint (or None) per sequence, got %d for %d sequences' % (len(constraints), len(seqs)))
+
+    if kwargs.get('bpps'):
+        raise ValueError('pfunc_many does not hand back temp files; use bpps_many for base pair probabilities.')
+
+    return map_ordered(_pfunc_item, list(zip(seqs, constraints)), n_jobs=n_jobs, backend=backend,
+        raise_errors=raise_errors, package=package, **kwargs)
+
+def _pfunc_item(item, **kwargs):
+    seq, constraint = item
+    return pfunc(seq, constraint=constraint, **kwargs)
+
+def pfunc_constraints(seq, constraints, package='vienna_2', T=37, dangles=True, param_file=None,
+    reweight=None, n_jobs=None):
+    ''' Constrained ensemble free energies of one sequence under many constraints, e.g. the
+        output of `write_combo_constraints`.
+
+        Repeated constraints are folded once, and the unconstrained reference is folded once.
+        For vienna 2 everything goes through one multi-record RNAfold run. Constraints
+        that force a non-canonical pair are known to be impossible without folding. Other
+        packages make one `pfunc` call per constraint on n_jobs threads.
+
+        Args:
+        seq (str): nucleic acid sequence
+        constraints (list): constraint strings (None for unconstrained)
+        (remaining args as in `pfunc`)
+
+    Returns
+        array of free energies per constraint (kcal/mol, inf for impossible constraints),
+        array of probabilities of the constraint (Z_constrained/Z, 0 if impossible),
+        free energy of the unconstrained ensemble.
+        For contrafold the "free energies" are -log Z, as in `free_energy`.
+    '''
+    constraints = list(constraints)
+    unique = list(dict.fromkeys(constraints))
+    index = {c: k for k, c in enumerate(unique)}
+
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    kT = 1 if pkg == 'contrafold' else .0019899*(273+T)
+    energies = np.full(len(unique), np.inf)
+
+    if pkg=='vienna' and (version is None or version.startswith('2')):
+        possible = [k for k, c in enumerate(unique) if c is None or not constraint_forces_noncanonical_(seq, c)]
+        results = pfunc_vienna_batch_([seq]*(len(possible)+1), version=version, T=T, dangles=dangles,
+            constraints=[None] + [unique[k] for k in possible], param_file=param_file, reweight=reweight,
+            return_free_energy=True)
+        reference = results[0][0]
+        energies[possible] = [dG for dG, _ in results[1:]]
+
+    else:
+        Zs = pfunc_many([seq]*(len(unique)+1), constraints=[None] + unique, package=package, T=T, dangles=dangles,
+            param_file=param_file, reweight=reweight, n_jobs=n_jobs, backend='thread', raise_errors=True)
+        with np.errstate(divide='ignore'):
+            logZ = np.log(np.array(Zs, dtype=float))
+        reference = -kT*logZ[0]
+        energies = -kT*logZ[1:]
+
+    energies = energies[[index[c] for c in constraints]]
+    with np.errstate(over='ignore'):
+        probabilities = np.exp(-(energies - reference)/kT)
+    return energies, probabilities, reference
+
+def constraint_forces_noncanonical_(seq, constraint):
+    '''True if the constraint forces a pair RNAfold won't allow (it would omit the constraint)'''
+    seq = seq.upper().replace('T', 'U')
+    stack = []
+    for k, c in enumerate(constraint):
+        if c == '(':
+            stack.append(k)
+        elif c == ')' and stack:
+            i = stack.pop()
+            if seq[i] + seq[k] not in ['AU', 'UA', 'GC', 'CG', 'GU', 'UG']:
+                return True
+    return False
+
+def pfunc_vienna_(seq, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, motif=None, param_file=None,
                                     dangles=True, bpps=False, reweight=None, return_free_energy=False):
     """get partition function structure representation and Z
 
@@ -89,35 +238,85 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     """
 
     if not version:
-        version='2'
+        version=DEFAULT_VERSIONS['vienna']
+
+    if pool.ENABLED and version.startswith('2') and motif is None:
+        result = pool.fold(seq, 'bpps' if bpps else 'pfunc', constraint=constraint, T=T,
+            dangles=dangles, param_file=param_file, reweight=reweight)
+
+        if result['omitted']:
+            free_energy = np.inf # Impossible structure
+        else:
+            free_energy = parse_vienna_ensemble_energy('\n'.join(result['lines']))
+
+        if return_free_energy:
+            return free_energy, result['dot_plot']
+        else:
+            return np.exp(-1*free_energy/(.0019899*(273+T))), result['dot_plot']
+
+    command, stdin, output_dot_ps_file = pfunc_vienna_command_(seq, T=T, version=version, constraint=constraint,
+        motif=motif, param_file=param_file, dangles=dangles, bpps=bpps, reweight=reweight)
+
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=scratch_dir())
+    stdout, stderr = p.communicate(input=stdin.encode('utf-8'))
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        remove_files(output_dot_ps_file)
+        raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
+
+    return pfunc_vienna_result_(stdout, stderr, output_dot_ps_file, T=T, return_free_energy=return_free_energy)
+
+def pfunc_vienna_command_(seq, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, motif=None, param_file=None,
+                                    dangles=True, bpps=False, reweight=None):
+    """build the RNAfold call for `pfunc_vienna_`
+
+    Returns
+        list, str, str: command, stdin, dot plot file (None unless bpps) to be
+        written into the scratch dir, which is the working directory to run in
+    """
+
+    if not version:
+        version=DEFAULT_VERSIONS['vienna']
 
     if version.startswith('2'):
-        LOC=package_locs['vienna_2']
+        LOC=locate('vienna_2')
     elif version.startswith('1'):
-        LOC=package_locs['vienna_1']
+        LOC=locate('vienna_1')
     else:
         raise RuntimeError('Error, vienna version %s not present' % version)
 
+    # -p0 gives the ensemble free energy without computing pair probabilities
+    command = ['%s/RNAfold' % LOC, '-T', str(T), '-p' if bpps else '-p0']
 
-    command = ['%s/RNAfold' % LOC, '-T', str(T), '-p']
-
+    # sequence goes in on stdin; only the dot plot (if asked for) is written, into the scratch dir
+    output_id = local_rand_filename()
     if version.startswith('2'):
-        output_id = local_rand_filename()
-        output_dot_ps_file = "%s_0001_dp.ps" % output_id
         command.append('--id-prefix=%s' % output_id)
+        command.append('--noPS')
+        stdin = ''
+        output_dot_ps_file = "%s/%s_0001_dp.ps" % (scratch_dir(), output_id)
     else:
-        output_dot_ps_file = 'dot.ps'
+        command.append('-noPS')
+        stdin = '>%s\n' % output_id
+        output_dot_ps_file = "%s/%s_dp.ps" % (scratch_dir(), output_id)
 
     if motif is not None:
         command.append('--motif="%s"' % motif)
 
     if constraint is not None:
-        fname = write([seq, constraint])
+        stdin += '%s\n%s\n' % (seq, constraint)
         command.append('-C')
         if version=='2':
             command.append('--enforceConstraint')
     else:
-        fname = write([seq])
+        stdin += '%s\n' % seq
 
     if not dangles:
         command.append('--dangles=0')
@@ -128,31 +327,18 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     if param_file:
         command.append('--paramFile=%s' % param_file)
 
-    with open(fname) as f:
-        if DEBUG: print(fname)
-        if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = p.communicate()
-
-    if DEBUG:
-        print('stdout')
-        print(stdout)
-        print('stderr')
-        print(stderr)
+    if not bpps:
+        output_dot_ps_file = None
 
-    if p.returncode:
-        raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
-    os.remove(fname)
+    return command, stdin, output_dot_ps_file
 
-    if version.startswith('2'):
-        os.remove("%s_0001_ss.ps" % output_id)
+def pfunc_vienna_result_(stdout, stderr, output_dot_ps_file, T=37, return_free_energy=False):
+    """read Z (or free energy) from the output of a `pfunc_vienna_command_` run"""
 
     if 'omitting constraint' in stderr.decode('utf-8'):
         free_energy = np.inf # Impossible structure
     else:
-        m = re.search('([,|\(\.\)\]\[\{\}]+)\s+\[\s*(-*[0-9]+\.[0-9]+)', stdout.decode('utf-8'))
-
-        free_energy = float(m.group(2))
+        free_energy = parse_vienna_ensemble_energy(stdout.decode('utf-8'))
         if DEBUG: print('free_energy: ', free_energy)
 
     if return_free_energy:
@@ -160,7 +346,169 @@ def pfunc_vienna_(seq, T=37, version='2', constraint=None, motif=None, param_fil
     else: # return Z
         return np.exp(-1*free_energy/(.0019899*(273+T))), output_dot_ps_file
 
-def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False, param_file=None):
+def vienna_ensemble_(seq, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, param_file=None, dangles=True, reweight=None, bpps=True):
+    """fold once with RNAfold -p (-p0 without bpps) and keep everything it reports
+
+    Returns
+        dict with 'free_energy' (inf if the constraint is impossible), 'structure' (MFE
+        structure, None if the constraint is impossible) and 'bpps' (NxN matrix, None without bpps)
+    """
+    if pool.ENABLED and version.startswith('2'):
+        result = pool.fold(seq, 'bpps' if bpps else 'pfunc', constraint=constraint, T=T,
+            dangles=dangles, param_file=param_file, reweight=reweight)
+        lines, omitted, output_dot_ps_file = result['lines'], result['omitted'], result['dot_plot']
+
+    else:
+        command, stdin, output_dot_ps_file = pfunc_vienna_command_(seq, T=T, version=version, constraint=constraint,
+            param_file=param_file, dangles=dangles, bpps=bpps, reweight=reweight)
+
+        if DEBUG: print(' '.join(command))
+        p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=scratch_dir())
+        stdout, stderr = p.communicate(input=stdin.encode('utf-8'))
+
+        if p.returncode:
+            remove_files(output_dot_ps_file)
+            raise Exception('RNAfold failed: on %s\n%s' % (seq, stderr))
+
+        lines = [line for line in stdout.decode('utf-8').split('\n') if line.strip() and not line.startswith('>')]
+        omitted = 'omitting constraint' in stderr.decode('utf-8')
+
+    result = {'free_energy': np.inf, 'structure': None, 'bpps': None}
+    if not omitted:
+        result['free_energy'] = parse_vienna_ensemble_energy('\n'.join(lines))
+        result['structure'] = lines[1].split(' ')[0] # after the sequence echo
+
+    if bpps:
+        result['bpps'] = triples_to_bpps(*parse_vienna_dot_plot(output_dot_ps_file), len(seq))
+        remove_files(output_dot_ps_file)
+
+    return result
+
+def vienna_together_(arguments, kind):
+    """`cache.cached` hook: answer a vienna 2 pfunc/bpps/mfe call from one RNAfold run,
+    storing the pfunc, mfe and bpps results of the same run along the way"""
+    try:
+        pkg, version = arguments['package'].lower().split('_')
+    except:
+        pkg, version = arguments['package'].lower(), None
+
+    if pkg != 'vienna' or (version and not version.startswith('2')) or arguments.get('motif') is not None:
+        return None
+
+    seq = arguments['seq'] if 'seq' in arguments else arguments['sequence']
+    T = arguments['T']
+
+    # mfe runs -p0 anyway, which has the ensemble energy but no pair probabilities
+    result = vienna_ensemble_(seq, T=T, version=DEFAULT_VERSIONS['vienna'], constraint=arguments['constraint'],
+        param_file=arguments['param_file'], dangles=arguments['dangles'], reweight=arguments['reweight'], bpps=kind!='mfe')
+
+    shared = {name: arguments[name] for name in ['package', 'T', 'constraint', 'dangles', 'param_file', 'reweight', 'coaxial', 'noncanonical'] if name in arguments}
+    Z = np.exp(-1*result['free_energy']/(.0019899*(273+T)))
+
+    cache.store('pfunc', seq, result['free_energy'], return_free_energy=True, **shared)
+    cache.store('pfunc', seq, Z, return_free_energy=False, **shared)
+    cache.store('mfe', seq, result['structure'], **shared)
+    cache.store('bpps', seq, result['bpps'], **shared)
+
+    if kind=='pfunc':
+        return result['free_energy'] if arguments['return_free_energy'] else Z
+    elif kind=='mfe':
+        if result['structure'] is None:
+            raise ValueError('Constraint caused impossible structure')
+        return result['structure']
+    else:
+        return result['bpps']
+
+def pfunc_vienna_batch_(seqs, T=37, version=DEFAULT_VERSIONS['vienna'], constraints=None, param_file=None,
+                                    dangles=True, bpps=False, reweight=None, return_free_energy=False):
+    """get Z for many sequences from one multi-record RNAfold run (vienna 2 only)
+
+    Args:
+        seqs (list): nucleic acid sequences
+        T (float): temperature
+        constraints (list): structure constraint or None per sequence
+        bpps (bool): keep per-record dot plot files for base pair probabilities
+    Returns
+        list of (Z or free energy, dot plot file or None), in input order
+    """
+
+    if not version:
+        version=DEFAULT_VERSIONS['vienna']
+
+    if not version.startswith('2'):
+        raise RuntimeError('Error, batch mode needs vienna 2, got version %s' % version)
+
+    if len(seqs) == 0:
+        return []
+
+    LOC=locate('vienna_2')
+
+    output_id = local_rand_filename()
+
+    # -p0 gives the ensemble free energy without computing pair probabilities
+    command = ['%s/RNAfold' % LOC, '-T', str(T), '-p' if bpps else '-p0', '--id-prefix=%s' % output_id, '--noPS']
+
+    has_constraints = constraints is not None and any([c is not None for c in constraints])
+
+    if has_constraints:
+        stdin = vienna_records_input(seqs, constraints)
+        command.append('-C')
+        command.append('--enforceConstraint')
+    else:
+        stdin = vienna_records_input(seqs)
+
+    if not dangles:
+        command.append('--dangles=0')
+
+    if reweight is not None:
+        command.append('--commands=%s' % reweight)
+
+    if param_file:
+        command.append('--paramFile=%s' % param_file)
+
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=scratch_dir())
+    stdout, stderr = p.communicate(input=stdin.encode('utf-8'))
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    if p.returncode:
+        raise Exception('RNAfold failed: on batch of %d sequences\n%s' % (len(seqs), stderr))
+
+    records = split_vienna_records(stdout.decode('utf-8'))
+    if len(records) != len(seqs):
+        raise Exception('RNAfold returned %d records for %d sequences\n%s' % (len(records), len(seqs), stderr))
+
+    results = []
+    for record_id, lines in records:
+        free_energy = parse_vienna_ensemble_energy('\n'.join(lines))
+
+        if bpps:
+            output_dot_ps_file = "%s/%s_dp.ps" % (scratch_dir(), record_id)
+        else:
+            output_dot_ps_file = None
+
+        if return_free_energy:
+            results.append((free_energy, output_dot_ps_file))
+        else:
+            results.append((np.exp(-1*free_energy/(.0019899*(273+T))), output_dot_ps_file))
+
+    if has_constraints and 'omitting constraint' in stderr.decode('utf-8'):
+        # the warning can't be attributed to a record, so refold the constrained ones singly
+        if DEBUG: print('constraint omitted in batch, refolding constrained records one by one')
+        for i, constraint in enumerate(constraints):
+            if constraint is not None:
+                remove_files(results[i][1])
+                results[i] = pfunc_vienna_(seqs[i], T=T, version=version, constraint=constraint, param_file=param_file,
+                    dangles=dangles, bpps=bpps, reweight=reweight, return_free_energy=return_free_energy)
+
+    return results
+
+def pfunc_contrafold_(seq, T=37, version=DEFAULT_VERSIONS['contrafold'], constraint=None, bpps=False, param_file=None):
     """get partition function structure representation and free energy
 
     Args:
@@ -172,19 +520,48 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False, param
         float: partition function
         Note: If the constraint is impossible then Z wil be equal to the Z unconstrained
     """
-    if not version: version='2'
+    command, fname, posterior_fname = pfunc_contrafold_command_(seq, version=version, constraint=constraint,
+        bpps=bpps, param_file=param_file)
 
-    fname = '%s.in' % filename()
+    if DEBUG: print(' '.join(command))
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
+
+    stdout, stderr = p.communicate()
+
+    if DEBUG:
+        print('stdout')
+        print(stdout)
+        print('stderr')
+        print(stderr)
+
+    remove_files(fname)
+
+    if p.returncode:
+        remove_files(posterior_fname)
+        raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+
+    return pfunc_contrafold_result_(stdout, posterior_fname)
+
+def pfunc_contrafold_command_(seq, version=DEFAULT_VERSIONS['contrafold'], constraint=None, bpps=False, param_file=None):
+    """build the contrafold call for `pfunc_contrafold_`
+
+    Returns
+        list, str, str: command, input file written for it, posteriors file (None unless bpps)
+    """
+    if not version: version=DEFAULT_VERSIONS['contrafold']
 
     if version.startswith('2'):
-        LOC=package_locs['contrafold_2']
+        LOC=locate('contrafold_2')
     elif version.startswith('1'):
-        LOC=package_locs['contrafold_1']
+        LOC=locate('contrafold_1')
     else:
         raise RuntimeError('Error, Contrafold version %s not present' % version)
 
+    fname = '%s.in' % filename()
+
     command = ['%s/contrafold' % LOC, 'predict', fname]
 
+    posterior_fname = None
     if bpps:
         posterior_fname = '%s.posteriors' % filename()
         command = command + ['--posteriors', '0.001', posterior_fname]
@@ -201,6 +578,37 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False, param
     else:
         convert_dbn_to_contrafold_input(seq, ''.join(['.' for x in range(len(seq))]), fname)
 
+    return command, fname, posterior_fname
+
+def pfunc_contrafold_result_(stdout, posterior_fname):
+    """read Z from the output of a `pfunc_contrafold_command_` run"""
+
+    if posterior_fname is None:
+        logZ = float(stdout.decode('utf-8').rstrip().split()[-1])
+        return np.exp(logZ), None
+    else:
+        return 0, posterior_fname
+
+def pfunc_rnasoft_(seq, version=DEFAULT_VERSIONS['rnasoft'], T=37, constraint=None, bpps=False):
+    return pfunc_rnasoft_result_(rnasoft_output_(seq, version=version), bpps=bpps)
+
+def pfunc_rnasoft_result_(stdout, bpps=False):
+    """read Z from decoded simfold_pf stdout, writing the pair lines to a file if bpps"""
+
+    # `bpps` parses the pair lines straight from stdout; only write them out when asked to
+    bpps_fname = None
+    if bpps:
+        bpps_fname = '%s.bpps' % filename()
+        with open(bpps_fname,'w') as f:
+            for line in rnasoft_pair_lines_(stdout):
+                f.write(line+'\n')
+
+    return float(stdout.split('\n')[1].split()[-1]), bpps_fname
+
+def rnasoft_output_(seq, version=DEFAULT_VERSIONS['rnasoft']):
+    """run simfold_pf and return its decoded stdout (Z and base pair probabilities)"""
+    command = rnasoft_command_(seq, version=version)
+
     if DEBUG: print(' '.join(command))
     p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
 
@@ -211,21 +619,17 @@ def pfunc_contrafold_(seq, T=37, version='2', constraint=None, bpps=False, param
         print(stdout)
         print('stderr')
         print(stderr)
+
     if p.returncode:
-        raise Exception('Contrafold failed: on %s\n%s' % (seq, stderr))
+        raise Exception('RNAsoft partition failed: on %s\n%s' % (seq, stderr))
 
-    os.remove(fname)
+    return stdout.decode('utf-8')
 
-    if not bpps:
-        logZ = float(stdout.decode('utf-8').rstrip().split()[-1])
-        return np.exp(logZ), None
-    else:
-        return 0, posterior_fname
+def rnasoft_command_(seq, version=DEFAULT_VERSIONS['rnasoft']):
+    """build the simfold_pf call for `rnasoft_output_`; the sequence goes on the command line"""
+    DIR = locate('rnasoft')
 
-def pfunc_rnasoft_(seq, version='99', T=37, constraint=None, bpps=False):
-    DIR = package_locs['rnasoft']
-
-    if not version: version='blstar'
+    if not version: version=DEFAULT_VERSIONS['rnasoft']
 
     #note for mfe will use simfold instead of simfold pf
 
@@ -238,7 +642,15 @@ def pfunc_rnasoft_(seq, version='99', T=37, constraint=None, bpps=False):
     'lam-cg': '%s/params/LAM-CG.txt' % DIR,
     'nom-cg': '%s/params/NOM-CG.txt' % DIR}
 
-    command = ['%s/simfold_pf' % DIR, '-s', seq, '-p', param_locs[version]]
+    return ['%s/simfold_pf' % DIR, '-s', seq, '-p', param_locs[version]]
+
+def rnasoft_pair_lines_(stdout):
+    """base pair probability lines ("i j p") of simfold_pf output"""
+    return [line for line in stdout.split('\n')[5:] if not 'Glog' in line and len(line) > 1]
+
+def pfunc_nupack_(seq, version=DEFAULT_VERSIONS['nupack'], T=37, dangles=True):
+
+    command, seqfile = nupack_command_('pfunc', seq, version=version, T=T, dangles=dangles)
 
     if DEBUG: print(' '.join(command))
     p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -251,24 +663,24 @@ def pfunc_rnasoft_(seq, version='99', T=37, constraint=None, bpps=False):
         print('stderr')
         print(stderr)
 
-    bpps_fname = '%s.bpps' % filename()
-    if bpps:
-        with open(bpps_fname,'w') as f:
-            for line in stdout.decode('utf-8').split('\n')[5:]:
-                if not 'Glog' in line and len(line) > 1:
-                    f.write(line+'\n')
+    remove_files(seqfile)
 
     if p.returncode:
-        raise Exception('RNAsoft partition failed: on %s\n%s' % (seq, stderr))
+        raise Exception('Nupack pfunc failed: on %s\n%s' % (seq, stderr))
+
+    return pfunc_nupack_result_(stdout), None
 
-    return float(stdout.decode('utf-8').split('\n')[1].split()[-1]), bpps_fname
+def nupack_command_(program, seq, version=DEFAULT_VERSIONS['nupack'], T=37, dangles=True):
+    """build a nupack `pfunc` or `pairs` call
 
-def pfunc_nupack_(seq, version='95', T=37, dangles=True):
+    Returns
+        list, str: command, and the input file it reads (its outputs go next to it)
+    """
 
-    if not version: version='95'
+    if not version: version=DEFAULT_VERSIONS['nupack']
     nupack_materials={'95': 'rna1995', '99': 'rna1999', 'dna':'dna1998'}
 
-    DIR = package_locs['nupack']
+    DIR = locate('nupack')
 
     if dangles:
         dangle_option='some'
@@ -277,27 +689,13 @@ def pfunc_nupack_(seq, version='95', T=37, dangles=True):
 
     seqfile = write([seq])
 
-    command=['%s/pfunc' % DIR, '%s' % seqfile.replace('.in',''),'-T', str(T), '-material', nupack_materials[version], '-dangles', dangle_option]
+    command=['%s/%s' % (DIR, program), '%s' % seqfile.replace('.in',''),'-T', str(T), '-material', nupack_materials[version], '-dangles', dangle_option]
 
-    if DEBUG: print(' '.join(command))
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-
-    stdout, stderr = p.communicate()
+    return command, seqfile
 
-    if DEBUG:
-        print('stdout')
-        print(stdout)
-        print('stderr')
-        print(stderr)
-
-    if p.returncode:
-        raise Exception('Nupack pfunc failed: on %s\n%s' % (seq, stderr))
-
-    Z=float(stdout.decode('utf-8').split('\n')[-2])
-
-    os.remove(seqfile)
-
-    return Z, None
+def pfunc_nupack_result_(stdout):
+    """read Z from the output of a nupack pfunc run"""
+    return float(stdout.decode('utf-8').split('\n')[-2])
 
 def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,bpps=False):
     """get partition function structure representation and free energy
@@ -312,19 +710,7 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,b
         float: partition function
     """
 
-    seqfile = write([seq])
-    pfsfile = '%s.pfs' % filename()
-    DIR = package_locs['rnastructure']
-    command = ['%s/partition' % DIR, seqfile, pfsfile, '-T', str(T+273)]
-
-    if not coaxial:
-        command.extend(['--disablecoax'])
-
-    if constraint is not None:
-        fname = '%s.CON' % filename()
-        #print(fname)
-        convert_dbn_to_RNAstructure_input(seq, constraint, fname)
-        command.extend(['--constraint', fname])
+    command, seqfile, pfsfile, fname = pfunc_rnastructure_command_(seq, T=T, constraint=constraint, coaxial=coaxial)
 
     if DEBUG: print(' '.join(command))
     p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -337,13 +723,13 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,b
         print('stderr')
         print(stderr)
 
+    remove_files(seqfile, fname)
+
     if p.returncode:
         raise Exception('RNAstructure partition failed: on %s\n%s' % (seq, stderr))
 
-    os.remove(seqfile)
-
     if not bpps:
-        command = ['%s/EnsembleEnergy' % DIR, pfsfile]
+        command = rnastructure_energy_command_(pfsfile)
 
         if DEBUG: print(' '.join(command))
         p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
@@ -359,46 +745,54 @@ def pfunc_rnastructure_(seq, version=None, T=37, constraint=None, coaxial=True,b
         if p.returncode:
             raise Exception('RNAstructure EnsembleEnergy failed: on %s\n%s' % (seq, stderr))
 
-        if DEBUG: print(stdout.decode('utf-8').split('\n')[3])
-        free_energy = float(stdout.decode('utf-8').split('\n')[3].split(' ')[-2])
-
-        return np.exp(-1*free_energy/(.0019*(273+T))), pfsfile
+        return pfunc_rnastructure_result_(stdout, T=T), pfsfile
     else:
         return 0, pfsfile
 
-def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False):
-    #available versions: 0 for Turner 04 params, 1 for Mfold 2.3 params
-    #for bpps
-        # command = ['%s/Vfold2d_npk_mac.o %d %d %s %s %d' % (DIR, int(coaxial),\
-        #  T, infile, outfile, int(version))]
+def pfunc_rnastructure_command_(seq, T=37, constraint=None, coaxial=True):
+    """build the RNAstructure partition call for `pfunc_rnastructure_`
 
-    DIR = package_locs["vfold"]
+    Returns
+        list, str, str, str: command, sequence file, .pfs file it writes, constraint file (or None)
+    """
 
-    cwd = os.getcwd()
-    os.chdir(DIR) #vfold precompiled binaries don't work being called from elsewhere
+    seqfile = write([seq])
+    pfsfile = '%s.pfs' % filename()
+    fname = None
+    DIR = locate('rnastructure')
+    command = ['%s/partition' % DIR, seqfile, pfsfile, '-T', str(T+273)]
 
-    if DEBUG: print(os.getcwd())
+    if not coaxial:
+        command.extend(['--disablecoax'])
 
-    seqfile = write([seq])
+    if constraint is not None:
+        fname = '%s.CON' % filename()
+        #print(fname)
+        convert_dbn_to_RNAstructure_input(seq, constraint, fname)
+        command.extend(['--constraint', fname])
 
-    if sys.platform=="linux":
-        platform='linux'
-    elif sys.platform=="darwin":
-        platform='mac'
-    elif sys.platform=="win32":
-        platform='win'
-    else:
-        raise RuntimeError('Vfold has binaries for linux, macOS, and win')
+    return command, seqfile, pfsfile, fname
 
+def rnastructure_energy_command_(pfsfile):
+    """EnsembleEnergy call reading the free energy out of a .pfs file"""
+    return ['%s/EnsembleEnergy' % locate('rnastructure'), pfsfile]
 
-    command = ['./VfoldThermal_npk_%s.o %d %d %d %s tmp %d; cat tmp; rm tmp' % (platform, int(coaxial), T, T, seqfile, int(version))]
+def pfunc_rnastructure_result_(stdout, T=37):
+    """read Z from the output of a `rnastructure_energy_command_` run"""
+    if DEBUG: print(stdout.decode('utf-8').split('\n')[3])
+    free_energy = float(stdout.decode('utf-8').split('\n')[3].split(' ')[-2])
+    return np.exp(-1*free_energy/(.0019*(273+T)))
+
+def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False):
+
+    command, DIR, seqfile, outfile = vfold_command_('VfoldThermal', seq, version=version, T=T, coaxial=coaxial)
 
     if DEBUG: print(' '.join(command))
 
-    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    #vfold precompiled binaries don't work being called from elsewhere
+    p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE, cwd=DIR)
 
     stdout, stderr = p.communicate()
-    os.chdir(cwd)
 
     if DEBUG:
         print('stdout')
@@ -406,14 +800,57 @@ def pfunc_vfold_(seq, version='0', T=37, coaxial=True, bpps=False):
         print('stderr')
         print(stderr)
     if p.returncode:
+        remove_files(seqfile, outfile)
         raise Exception('VfoldThermal_npk failed: on %s\n%s' % (seq, stderr))
 
-    Z=float(stdout.decode('utf-8').split('\n')[-2].split()[1])
-
-    os.remove(seqfile)
+    Z = pfunc_vfold_result_(outfile)
+    remove_files(seqfile, outfile)
     return Z, None
-    #output: take second field of last line for Z 
 
+def vfold_command_(program, seq, version='0', T=37, coaxial=True):
+    """build a 'VfoldThermal' (Z) or 'Vfold2d' (pair probabilities) call
+
+    Returns
+        list, str, str, str: command, directory to run it in, sequence file, output file
+    """
+    #available versions: 0 for Turner 04 params, 1 for Mfold 2.3 params
+
+    DIR = locate('vfold')
 
+    seqfile = write([seq])
 
+    if sys.platform=="linux":
+        platform='linux'
+    elif sys.platform=="darwin":
+        platform='mac'
+    elif sys.platform=="win32":
+        platform='win'
+    else:
+        raise RuntimeError('Vfold has binaries for linux, macOS, and win')
 
+    if program == 'VfoldThermal':
+        outfile = filename()
+        # takes a temperature range; the same T at both ends
+        command = ['./VfoldThermal_npk_%s.o' % platform, str(int(coaxial)), '%d' % T, '%d' % T, seqfile, outfile, str(int(version))]
+    else:
+        outfile = filename()+'.pij'
+        command = ['./Vfold2d_npk_%s.o' % platform, str(int(coaxial)), '%d' % T, seqfile, outfile, str(int(version))]
+
+    return command, DIR, seqfile, outfile
+
+def pfunc_vfold_result_(outfile):
+    """read Z from a VfoldThermal output file: second field of the last line"""
+    with open(outfile) as f:
+        return float(f.read().split('\n')[-2].split()[1])
+
+def pfunc_arnie_(seq, version='np', T=37, constraint=None, return_free_energy=False):
+    '''partition function of the built-in numpy model, computed in-process (no temp file)'''
+    if version not in [None, 'np']:
+        raise ValueError('package arnie_%s not understood, use arnie_np.' % version)
+
+    result = npfold.fold(seq, T=T, constraint=constraint, bpps=False)
+
+    if return_free_energy:
+        return result['free_energy'], None
+    else:
+        return np.exp(result['logZ']), None
@@ -0,0 +1,251 @@
+import os, select, shutil, tempfile, threading, atexit, time
+import subprocess as sp
+from .utils import *
+from .config import package_locs, locate
+
+DEBUG=False
+
+# route vienna 2 pfunc/bpps/mfe calls through long-running RNAfold processes.
+# Turn on with enable_pool(), or set directly.
+ENABLED=False
+
+# seconds to wait for one record before treating the worker as hung
+TIMEOUT=600
+
+_pool = {}
+_pool_lock = threading.Condition()
+_pool_size = 1
+_pool_pid = os.getpid()
+
+def enable_pool(size=1):
+    '''Route vienna 2 `pfunc`, `bpps` and `mfe` calls through persistent RNAfold workers.
+
+    Args:
+    size (int): max number of worker processes kept per folding configuration
+    '''
+    global ENABLED, _pool_size
+    _pool_size = size
+    ENABLED=True
+
+def disable_pool():
+    '''Stop routing calls through the pool and shut down all workers.'''
+    global ENABLED
+    ENABLED=False
+    shutdown_pool()
+
+def shutdown_pool():
+    '''Terminate all worker processes.'''
+    with _pool_lock:
+        if _pool_pid == os.getpid():
+            for workers in _pool.values():
+                for worker in workers:
+                    worker.stop()
+        _pool.clear()
+
+atexit.register(shutdown_pool)
+
+class ViennaWorker:
+    '''One RNAfold process that keeps reading records from stdin.
+
+    Every record is sent with a constraint line (all '.' if unconstrained) so
+    that a single `-C --enforceConstraint` process serves both cases. Record
+    output is framed by the auto-generated `>prefix_NNNN` header and ends with
+    the mfe line (mode 'mfe') or the `frequency of mfe structure` line
+    (modes 'pfunc', 'bpps').
+    '''
+
+    def __init__(self, LOC, mode='pfunc', T=37, dangles=True, param_file=None, reweight=None):
+        if mode not in ['mfe', 'pfunc', 'bpps']:
+            raise ValueError('worker mode %s not understood.' % mode)
+
+        self.mode = mode
+        self.workdir = tempfile.mkdtemp(prefix='pool_', dir=scratch_dir())
+        self.output_id = local_rand_filename()
+
+        command = ['%s/RNAfold' % LOC, '-T', str(T), '-C', '--enforceConstraint', '--id-prefix=%s' % self.output_id]
+
+        if mode=='bpps':
+            command.append('-p')
+        else:
+            if mode=='pfunc':
+                command.append('-p0') # ensemble free energy only, no pair probabilities
+            command.append('--noPS')
+
+        if not dangles:
+            command.append('--dangles=0')
+
+        if reweight is not None:
+            command.append('--commands=%s' % reweight)
+
+        if param_file:
+            command.append('--paramFile=%s' % param_file)
+
+        # RNAfold block-buffers stdout on a pipe; force line buffering where possible
+        if shutil.which('stdbuf'):
+            command = ['stdbuf', '-oL'] + command
+
+        self.command = command
+        self.proc = None
+        self.busy = False
+        self.start()
+
+    def start(self):
+        if DEBUG: print(' '.join(self.command))
+        self.proc = sp.Popen(self.command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE, cwd=self.workdir)
+        self.n_records = 0
+        self._buffer = b''
+
+    def stop(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.proc.wait()
+            for stream in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+                stream.close()
+            self.proc = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def restart(self):
+        self.stop()
+        os.makedirs(self.workdir, exist_ok=True)
+        self.start()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _drain_stderr(self):
+        fd = self.proc.stderr.fileno()
+        chunks = []
+        while select.select([fd], [], [], 0)[0]:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks).decode('utf-8')
+
+    def _readline(self):
+        fd = self.proc.stdout.fileno()
+        deadline = time.time() + TIMEOUT
+        while b'\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError('RNAfold worker did not answer within %d s' % TIMEOUT)
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError('RNAfold worker exited')
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line.decode('utf-8')
+
+    def _record_done(self, lines):
+        if self.mode=='mfe':
+            return len(lines) >= 2 # sequence echo, mfe structure
+        return 'frequency of mfe structure' in lines[-1]
+
+    def _wait_for_dot_plot(self, fname):
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline:
+            if os.path.exists(fname):
+                with open(fname, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell()-64))
+                    if b'EOF' in f.read():
+                        return
+            time.sleep(0.001)
+        raise TimeoutError('RNAfold worker did not write %s' % fname)
+
+    def fold(self, seq, constraint=None):
+        '''Fold one record.
+
+        Returns
+            dict with keys 'lines' (record output), 'omitted' (constraint was omitted)
+            and 'dot_plot' (path of the dot plot file, bpps mode only)
+        '''
+        if constraint is None:
+            constraint = '.'*len(seq)
+
+        self._drain_stderr()
+        self.proc.stdin.write(('%s\n%s\n' % (seq, constraint)).encode('utf-8'))
+        self.proc.stdin.flush()
+        self.n_records += 1
+
+        record_id = '%s_%04d' % (self.output_id, self.n_records)
+
+        header = self._readline()
+        while not header.startswith('>'):
+            header = self._readline()
+        if header[1:].split()[0] != record_id:
+            raise RuntimeError('RNAfold worker out of sync: expected %s, got %s' % (record_id, header))
+
+        lines = []
+        while not lines or not self._record_done(lines):
+            line = self._readline()
+            if line.strip():
+                lines.append(line)
+
+        stderr = self._drain_stderr()
+        if DEBUG:
+            print('\n'.join(lines))
+            print(stderr)
+
+        result = {'lines': lines, 'omitted': 'omitting constraint' in stderr, 'dot_plot': None}
+
+        if self.mode=='bpps':
+            ss_file = os.path.join(self.workdir, '%s_ss.ps' % record_id)
+            result['dot_plot'] = os.path.join(self.workdir, '%s_dp.ps' % record_id)
+            self._wait_for_dot_plot(result['dot_plot'])
+            if os.path.exists(ss_file):
+                os.remove(ss_file)
+
+        return result
+
+def _acquire(key):
+    global _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # forked child: the parent's workers aren't ours to use or stop
+            _pool.clear()
+            _pool_pid = os.getpid()
+        while True:
+            workers = _pool.setdefault(key, [])
+            for worker in workers:
+                if not worker.busy:
+                    worker.busy = True
+                    return worker
+            if len(workers) < _pool_size:
+                worker = ViennaWorker(*key)
+                worker.busy = True
+                workers.append(worker)
+                return worker
+            _pool_lock.wait()
+
+def _release(worker):
+    with _pool_lock:
+        worker.busy = False
+        _pool_lock.notify()
+
+def fold(seq, mode, constraint=None, T=37, dangles=True, param_file=None, reweight=None):
+    '''Fold one sequence on a pooled vienna 2 worker, restarting it once if it crashed.
+
+    Args:
+    mode (str): 'mfe', 'pfunc' or 'bpps'
+    (remaining args as in `pfunc`)
+
+    Returns
+        dict as returned by `ViennaWorker.fold`
+    '''
+    key = (locate('vienna_2'), mode, T, dangles, param_file, reweight)
+    worker = _acquire(key)
+    try:
+        for attempt in range(2):
+            if not worker.alive():
+                worker.restart()
+            try:
+                return worker.fold(seq, constraint=constraint)
+            except (EOFError, BrokenPipeError, TimeoutError, RuntimeError) as e:
+                if DEBUG: print('restarting RNAfold worker: %s' % e)
+                worker.restart()
+                if attempt:
+                    raise Exception('RNAfold failed: on %s\n%s' % (seq, e))
+    finally:
+        _release(worker)
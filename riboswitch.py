@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+from .utils import write_constraints
+from .pfunc import pfunc_batch, constraint_forces_noncanonical_
+from .parallel import map_ordered
+
+DEBUG=False
+
+# K_d and fold change of MS2-reporter riboswitches, after examples/riboswitch_fold_change.ipynb:
+#   K_d,MS2 without ligand   ~ Z / Z_MS2
+#   K_d,MS2 with ligand [L]  ~ (Z + b Z_lig) / (Z_MS2 + b Z_MS2+lig),  b = [L]/K_d,ligand
+# where Z_x is the partition function with aptamer(s) x constrained folded. Everything below
+# works on p_x = Z_x/Z, kept as log p_x (-inf for impossible constraints).
+
+APTAMERS = {'FMN':[('nAGGAUAU', '(xxxxxx('),('AGAAGGn', ')xxxxx)')],
+            'FMN_rev':[('AGAAGGn', '(xxxxx('),('nAGGAUAU', ')xxxxxx)')],
+            'Theophylline':[('GAUACCAG','(xxx(((('),('CCCUUGGCAGC',')xxx)))xxx)')],
+            'Theophylline_rev':[('CCCUUGGCAGC','(xxx(((xxx('),('GAUACCAG',')xxx))))')],
+            'Tryptophan':[('AGGACCGG','((xxx((('),('CCGCCACU',')))xxx))')],
+            'Tryptophan_rev':[('CCGCCACU','(((xxx(('),('AGGACCGG','))xxx)))')]}
+
+CONCENTRATION = {'FMN':200e-6,'Theophylline':2e-3,'Tryptophan':2.4e-3}
+INTRINSIC_KD = {'FMN':2.2e-6,'Theophylline':20e-6,'Tryptophan':13e-6}
+
+STATES = ['MS2', 'lig', 'MS2_lig']
+
+def riboswitch_constraints(seq, ligand, aptamers=APTAMERS):
+    '''MS2, ligand and MS2 + ligand aptamer constraints of one design, as in the notebook
+    (the reversed ligand aptamer if the forward one doesn't fit).
+
+    Returns
+        list of 3 constraint strings, or None if an aptamer isn't in the sequence
+    '''
+    try:
+        MS2_aptamer = write_constraints(seq, MS2=True)
+        lig_aptamer = write_constraints(seq, LIG=True, lig1=aptamers[ligand][0], lig2=aptamers[ligand][1])
+        if len(lig_aptamer) > len(seq):
+            lig_aptamer = write_constraints(seq, LIG=True, lig1=aptamers['%s_rev' % ligand][0], lig2=aptamers['%s_rev' % ligand][1])
+        MS2_lig_aptamer = write_constraints(seq, MS2=True, LIG=True, lig1=aptamers[ligand][0], lig2=aptamers[ligand][1])
+    except RuntimeError:
+        return None
+    return [MS2_aptamer, lig_aptamer, MS2_lig_aptamer]
+
+def ensemble_states(designs, package='vienna_2', T=37, out_file=None, n_jobs=None, block_size=100, aptamers=APTAMERS):
+    '''log p_MS2, log p_lig, log p_MS2_lig of every distinct (sequence, ligand) in designs.
+
+    Designs go in blocks of block_size: for vienna 2, one multi-record RNAfold run folds all
+    four states of every design in a block; n_jobs blocks run at a time. With out_file (csv),
+    each batch of blocks is appended as it finishes, and designs already in the file are
+    not folded again, so an interrupted screen picks up where it stopped.
+
+    Args:
+    designs (DataFrame): 'sequence' and 'ligand' columns
+    (package, T as in `pfunc`)
+
+    Returns
+        DataFrame with sequence, ligand, log_p_MS2, log_p_lig, log_p_MS2_lig; NaN where an
+        aptamer wasn't found
+    '''
+    keys = pd.DataFrame({'sequence': designs['sequence'], 'ligand': designs['ligand']}).drop_duplicates()
+
+    done = None
+    if out_file is not None and os.path.exists(out_file):
+        done = pd.read_csv(out_file)
+        merged = keys.merge(done[['sequence', 'ligand']].drop_duplicates(), how='left', indicator=True)
+        keys = keys[(merged['_merge'] == 'left_only').values]
+
+    todo = list(keys.itertuples(index=False, name=None))
+    blocks = [todo[k:k+block_size] for k in range(0, len(todo), block_size)]
+    step = n_jobs or os.cpu_count()
+
+    results = [] if done is None else [done]
+    for start in range(0, len(blocks), step):
+        found = map_ordered(ensemble_states_block_, blocks[start:start+step], n_jobs=n_jobs, backend='thread',
+            raise_errors=True, package=package, T=T, aptamers=aptamers)
+        found = pd.concat(found, ignore_index=True)
+        if DEBUG: print('%d of %d blocks' % (min(start+step, len(blocks)), len(blocks)))
+
+        if out_file is not None:
+            found.to_csv(out_file, mode='a', header=not os.path.exists(out_file), index=False)
+        results.append(found)
+
+    if not results:
+        return pd.DataFrame(columns=['sequence', 'ligand'] + ['log_p_%s' % s for s in STATES])
+    return pd.concat(results, ignore_index=True)
+
+def ensemble_states_block_(block, package='vienna_2', T=37, aptamers=APTAMERS):
+    '''log probabilities of the constrained states of a block of (sequence, ligand)'''
+    seqs, constraints, where = [], [], []
+    log_p = np.full([len(block), len(STATES)], np.nan)
+
+    for b, (seq, ligand) in enumerate(block):
+        states = riboswitch_constraints(seq, ligand, aptamers=aptamers)
+        if states is None:
+            continue
+        seqs.append(seq)
+        constraints.append(None)
+        where.append((b, -1))
+        for k, constraint in enumerate(states):
+            if constraint_forces_noncanonical_(seq, constraint):
+                log_p[b, k] = -np.inf # can't fold; skip it, so the batch doesn't refold one by one
+            else:
+                seqs.append(seq)
+                constraints.append(constraint)
+                where.append((b, k))
+
+    with np.errstate(divide='ignore'):
+        logZ = np.log(np.array(pfunc_batch(seqs, package=package, T=T, constraints=constraints), dtype=float))
+
+    reference = {}
+    for (b, k), value in zip(where, logZ):
+        if k < 0:
+            reference[b] = value
+        else:
+            log_p[b, k] = value - reference[b]
+
+    result = pd.DataFrame(log_p, columns=['log_p_%s' % s for s in STATES])
+    result.insert(0, 'ligand', [ligand for _, ligand in block])
+    result.insert(0, 'sequence', [seq for seq, _ in block])
+    return result
+
+def log_kd(log_p_MS2, log_p_lig, log_p_MS2_lig, ligand_bonus):
+    '''log K_d of MS2 binding (up to a constant), broadcast over designs and ligand_bonus = [L]/K_d,ligand.
+
+    log((1 + b p_lig)/(p_MS2 + b p_MS2_lig)), with b = 0 giving -log p_MS2.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_b = np.log(np.asarray(ligand_bonus, dtype=float))
+        return np.logaddexp(0, log_b + log_p_lig) - np.logaddexp(log_p_MS2, log_b + log_p_MS2_lig)
+
+def titration_curves(states, concentrations, intrinsic_kd=INTRINSIC_KD):
+    '''log K_d of every design over a grid of ligand concentrations.
+
+    Args:
+    states (DataFrame): from `ensemble_states` (or `screen_riboswitches`)
+    concentrations (array): ligand concentrations (M), C of them
+    intrinsic_kd (dict): ligand -> K_d of the isolated aptamer (M); or an 'intrinsic_kd' column
+
+    Returns
+        n_designs x C array of log K_d; fold change is log_kd at 0 minus these
+    '''
+    kd_ligand = _per_design(states, 'intrinsic_kd', intrinsic_kd)
+    bonus = np.asarray(concentrations, dtype=float)[None, :]/kd_ligand[:, None]
+    return log_kd(*[states['log_p_%s' % s].values[:, None] for s in STATES], bonus)
+
+def screen_riboswitches(designs, package='vienna_2', T=37, concentration=CONCENTRATION, intrinsic_kd=INTRINSIC_KD,
+    concentrations=None, out_file=None, n_jobs=None, block_size=100, aptamers=APTAMERS):
+    '''K_d and fold change predictions for a table of riboswitch designs.
+
+    Args:
+    designs (DataFrame or dict of columns): 'sequence' and 'ligand'; optional 'switch'
+        ('ON'/'OFF'), 'concentration' and 'intrinsic_kd' columns override the dicts
+    concentration (dict): ligand -> concentration (M) for kd_est_with_lig
+    intrinsic_kd (dict): ligand -> K_d of the isolated aptamer (M)
+    concentrations (array): also return titration curves over this grid
+    out_file, n_jobs, block_size: see `ensemble_states`
+
+    Returns
+        DataFrame: designs plus log_p_* columns, kd_est_no_lig, kd_est_with_lig and
+        pred_log_AR (activation ratio; no_lig - with_lig for ON switches and for designs
+        without 'switch', with_lig - no_lig for OFF); and the n_designs x C titration
+        array if concentrations is given
+    '''
+    designs = pd.DataFrame(designs).reset_index(drop=True)
+    states = ensemble_states(designs, package=package, T=T, out_file=out_file, n_jobs=n_jobs,
+        block_size=block_size, aptamers=aptamers)
+    df = designs.merge(states.drop_duplicates(['sequence', 'ligand']), on=['sequence', 'ligand'], how='left')
+
+    bonus = _per_design(df, 'concentration', concentration)/_per_design(df, 'intrinsic_kd', intrinsic_kd)
+    log_p = [df['log_p_%s' % s].values for s in STATES]
+    df['kd_est_no_lig'] = log_kd(*log_p, 0*bonus)
+    df['kd_est_with_lig'] = log_kd(*log_p, bonus)
+
+    off = (df['switch'] == 'OFF').values if 'switch' in df else np.zeros(len(df), dtype=bool)
+    df['pred_log_AR'] = np.where(off, df['kd_est_with_lig'] - df['kd_est_no_lig'], df['kd_est_no_lig'] - df['kd_est_with_lig'])
+
+    if concentrations is not None:
+        return df, titration_curves(df, concentrations, intrinsic_kd)
+    return df
+
+def _per_design(df, column, values):
+    if column in df:
+        return df[column].values.astype(float)
+    return np.array([values.get(ligand, np.nan) for ligand in df['ligand']], dtype=float)
@@ -1,17 +1,24 @@
-import os, re, sys, shutil
+import os, re, sys, shutil, tempfile, warnings
 import subprocess as sp
 import random, string
 import numpy as np
 from .utils import *
+from .config import package_locs, locate
+from .parallel import map_ordered
+from .pfunc import constraint_forces_noncanonical_
+from . import npfold
 
-DEBUG=False
+try:
+    import RNA # ViennaRNA python bindings, for seeded sampling
+except ImportError:
+    RNA = None
 
-# load package locations from yaml file, watch! global dict
-package_locs = load_package_locations()
+DEBUG=False
 
 def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=None, 
-	dangles=True, reweight=None, nonredundant=False):
-    ''' Draw stochastic sampled structures for RNA sequence. Possible packages: 'vienna_1', 'vienna_2'
+	dangles=True, reweight=None, nonredundant=False, return_energies=False,
+	structure_format='dotbracket', return_counts=False, chunk_size=10000, n_jobs=None, seed=None):
+    ''' Draw stochastic sampled structures for RNA sequence. Possible packages: 'vienna_1', 'vienna_2', 'arnie_np'
 
         Args:
         seq (str): nucleic acid sequence
@@ -20,11 +27,22 @@ def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=
         motif (str): argument to vienna motif 
         dangles (bool): dangles or not, specifiable for vienna, nupack
         noncanonical(bool): include noncanonical pairs or not (for contrafold, RNAstructure (Cyclefold))
+        nonredundant (bool): sample without replacement (RNAsubopt -N)
+        return_energies (bool): also return energies (kcal/mol) and Boltzmann probabilities
+        structure_format (str): 'dotbracket' (list of str, 'x' for unpaired), 'partners' (MxN
+            int32 partner array) or 'packed' (M x ceil(N/4) uint8, see structures.convert_dotbracket_to_packed)
+        return_counts (bool): collapse repeated structures, in order of first appearance, and
+            also return how many times each was drawn (all ones with nonredundant)
+        chunk_size (int): samples parsed at a time while RNAsubopt runs
+        n_jobs (int): split the samples over this many worker processes, merged in order
+        seed (int): fixed seed, same samples for the same seed and n_jobs. vienna then samples
+            through the ViennaRNA python bindings (RNA) when they import and reweight isn't set;
+            RNAsubopt itself can't be seeded. nonredundant sampling always runs as one job.
         
     Returns
-        list of structures
-        list of energies
-        list of probabilities 
+        structures
+        array of energies, array of probabilities (if return_energies)
+        array of counts (if return_counts)
     '''
 
     try:
@@ -35,16 +53,191 @@ def sample_structures(seq, n_samples = 10, package='vienna_2', T=37, constraint=
     if not dangles and pkg not in ['vienna','nupack']:
         print('Warning: %s does not support dangles options' % pkg)
 
-    if pkg=='vienna':
-        struct_list = sample_vienna_(seq, n_samples=n_samples, version=version, T=T, 
-        	dangles=dangles, constraint=constraint, reweight=reweight, nonredundant = nonredundant)
+    if pkg=='vienna' and n_jobs is None and seed is None:
+        chunks = list(sample_structures_iter(seq, n_samples=n_samples, package=package, T=T, constraint=constraint,
+            dangles=dangles, reweight=reweight, nonredundant=nonredundant, chunk_size=chunk_size, structure_format=structure_format))
+
+    elif pkg in ['vienna', 'arnie']:
+        chunks = sample_shards_(seq, n_samples=n_samples, pkg=pkg, version=version, T=T, constraint=constraint,
+            dangles=dangles, reweight=reweight, nonredundant=nonredundant, structure_format=structure_format,
+            n_jobs=n_jobs, seed=seed)
 
     else:
         raise ValueError('package %s either not understood or not supported at this moment.' % package)
 
-    return struct_list
+    struct_list, energies, probabilities = _join_sample_chunks_(chunks, len(seq), structure_format)
+
+    if return_counts:
+        struct_list, energies, probabilities, counts = _count_samples_(struct_list, energies, probabilities)
+
+    result = [struct_list]
+    if return_energies:
+        result += [energies, probabilities]
+    if return_counts:
+        result.append(counts)
+    return result[0] if len(result) == 1 else tuple(result)
+
+def sample_structures_iter(seq, n_samples=10, package='vienna_2', T=37, constraint=None,
+	dangles=True, reweight=None, nonredundant=False, chunk_size=10000, structure_format='dotbracket', seed=None):
+    ''' Stochastic sampled structures, read from RNAsubopt chunk_size at a time while it runs,
+    so the whole output never sits in memory. Closing the generator early kills RNAsubopt.
+
+    For 'arnie_np', and for vienna with a seed (through the python bindings, as in
+    `sample_structures`), the partition function is computed once and every chunk is
+    drawn from it with one seeded random stream.
+
+        Args as in `sample_structures`.
+
+    Yields
+        structures (in structure_format), array of energies, array of probabilities
+    '''
+    try:
+        pkg, version = package.lower().split('_')
+    except:
+        pkg, version = package.lower(), None
+
+    if pkg=='arnie':
+        for structures, energies, probabilities in npfold.sample_iter(seq, n_samples=n_samples, T=T,
+            constraint=constraint, seed=seed, chunk_size=chunk_size):
+            yield format_samples_(structures, len(seq), structure_format), energies, probabilities
+        return
+
+    if pkg!='vienna':
+        raise ValueError('package %s either not understood or not supported at this moment.' % package)
+
+    if seed is not None:
+        # non-redundant samples can't be drawn a chunk at a time from the bindings
+        if RNA is not None and reweight is None and not nonredundant and (version or '2').startswith('2'):
+            RNA.init_rand(seed)
+            fc, ensemble_energy = bindings_fold_compound_(seq, T=T, constraint=constraint, dangles=dangles)
+            for start in range(0, n_samples, chunk_size):
+                structures, energies, probabilities = bindings_samples_(fc, ensemble_energy, min(chunk_size, n_samples - start))
+                yield format_samples_(structures, len(seq), structure_format), energies, probabilities
+            return
+        warnings.warn('RNAsubopt has no seed option; samples drawn with seed=%s are not reproducible.' % seed)
+
+    command, stdin = sample_vienna_command_(seq, n_samples=n_samples, T=T, version=version, constraint=constraint,
+        dangles=dangles, reweight=reweight, nonredundant=nonredundant)
+
+    if DEBUG: print(' '.join(command))
+
+    # stderr to a file: a full stderr pipe would block RNAsubopt while we read stdout
+    with tempfile.TemporaryFile() as err:
+        p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=err)
+        try:
+            p.stdin.write(stdin.encode('utf-8'))
+            p.stdin.close()
+
+            lines = []
+            p.stdout.readline() # first line is just repeating sequence
+            for line in p.stdout:
+                if not line.strip():
+                    continue
+                lines.append(line)
+                if len(lines) == chunk_size:
+                    _check_sample_stderr_(err)
+                    yield parse_sample_lines_(lines, len(seq), structure_format)
+                    lines = []
+
+            p.wait()
+            stderr = _read_stderr_(err)
+            if p.returncode:
+                raise Exception('RNAsubopt failed: on %s\n%s' % (seq, stderr))
+            _check_sample_stderr_(err)
+            if lines:
+                yield parse_sample_lines_(lines, len(seq), structure_format)
+        finally:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+            p.stdout.close()
+
+def sample_shards_(seq, n_samples=10, pkg='vienna', version=None, T=37, constraint=None, dangles=True,
+	reweight=None, nonredundant=False, structure_format='dotbracket', n_jobs=None, seed=None):
+    """Split n_samples over n_jobs independent samplers, each with its own seed spawned from `seed`.
+
+    Returns
+        list of (structures, energies, probabilities), one per shard, in shard order
+    """
+    if n_jobs is None or nonredundant: # nonredundant shards would draw the same structures
+        n_jobs = 1
+    sizes = [n_samples//n_jobs + (k < n_samples % n_jobs) for k in range(n_jobs)]
+    seeds = [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(n_jobs)]
+    shards = [(n, s) for n, s in zip(sizes, seeds) if n > 0]
+
+    if pkg == 'arnie':
+        sampler = 'arnie'
+    elif RNA is not None and reweight is None and (version or '2').startswith('2'):
+        sampler = 'bindings'
+    else:
+        sampler = 'cli'
+        if seed is not None:
+            warnings.warn('RNAsubopt has no seed option; samples drawn with seed=%s are not reproducible.' % seed)
 
-def sample_vienna_(seq, n_samples=10, T=37, version='2', constraint=None, 
+    return map_ordered(sample_shard_, shards, n_jobs=n_jobs, backend='thread' if sampler == 'cli' else 'process',
+        raise_errors=True, seq=seq, sampler=sampler, version=version, T=T, constraint=constraint, dangles=dangles,
+        reweight=reweight, nonredundant=nonredundant, structure_format=structure_format)
+
+def sample_shard_(shard, seq, sampler='bindings', version=None, T=37, constraint=None, dangles=True,
+	reweight=None, nonredundant=False, structure_format='dotbracket'):
+    """(n_samples, seed) samples from one sampler: 'cli' (RNAsubopt), 'bindings' (RNA) or 'arnie' (npfold)"""
+    n_samples, seed = shard
+
+    if sampler == 'cli':
+        package = 'vienna_%s' % version if version else 'vienna'
+        chunks = list(sample_structures_iter(seq, n_samples=n_samples, package=package, T=T, constraint=constraint,
+            dangles=dangles, reweight=reweight, nonredundant=nonredundant, structure_format=structure_format))
+        return _join_sample_chunks_(chunks, len(seq), structure_format)
+
+    if sampler == 'arnie':
+        structures, energies, probabilities = npfold.sample(seq, n_samples=n_samples, T=T, constraint=constraint, seed=seed)
+
+    else:
+        RNA.init_rand(seed)
+        fc, ensemble_energy = bindings_fold_compound_(seq, T=T, constraint=constraint, dangles=dangles)
+        structures, energies, probabilities = bindings_samples_(fc, ensemble_energy, n_samples, nonredundant=nonredundant)
+
+    return format_samples_(structures, len(seq), structure_format), energies, probabilities
+
+def bindings_fold_compound_(seq, T=37, constraint=None, dangles=True):
+    """ViennaRNA bindings fold compound with its partition function computed, ready to
+    pbacktrack from, and the ensemble free energy"""
+    md = RNA.md()
+    md.temperature = T
+    md.uniq_ML = 1
+    if not dangles:
+        md.dangles = 0
+    fc = RNA.fold_compound(seq, md)
+    if constraint is not None:
+        fc.hc_add_from_db(constraint, RNA.CONSTRAINT_DB_DEFAULT | RNA.CONSTRAINT_DB_ENFORCE_BP)
+    structure, mfe = fc.mfe()
+    if constraint is not None and not _satisfies_constraint_(seq, structure, mfe, constraint):
+        # RNAsubopt omits such constraints and the CLI path raises; fail the same way
+        raise RuntimeError("Constraint omitted, Impossible structure")
+    fc.exp_params_rescale(mfe)
+    _, ensemble_energy = fc.pf()
+    return fc, ensemble_energy
+
+def bindings_samples_(fc, ensemble_energy, n_samples, nonredundant=False):
+    """n_samples structures from a `bindings_fold_compound_`, their energies and probabilities"""
+    options = RNA.PBACKTRACK_NON_REDUNDANT if nonredundant else RNA.PBACKTRACK_DEFAULT
+    structures = list(fc.pbacktrack(n_samples, options)) if n_samples > 0 else []
+    energies = np.array([fc.eval_structure(s) for s in structures])
+    probabilities = np.exp((ensemble_energy - energies)/(fc.exp_params.kT/1000))
+    return structures, energies, probabilities
+
+def _satisfies_constraint_(seq, structure, mfe, constraint):
+    '''False if the bindings couldn't honor a hard constraint: a non-canonical forced pair (which
+    they would take but RNAsubopt omits), or an MFE structure without the forced pairs and
+    unpaired positions (what they return for an empty constrained ensemble)'''
+    if constraint_forces_noncanonical_(seq, constraint) or not np.isfinite(mfe):
+        return False
+    forced = convert_dotbracket_to_partners(constraint, brackets=['()'])
+    partners = convert_dotbracket_to_partners(structure)
+    unpaired = np.array([c == 'x' for c in constraint], dtype=bool)
+    return np.all(partners[forced >= 0] == forced[forced >= 0]) and np.all(partners[unpaired] < 0)
+
+def sample_vienna_(seq, n_samples=10, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, 
 	dangles=True, reweight=None, nonredundant=False):
     """get partition function structure representation and Z
 
@@ -56,25 +249,36 @@ def sample_vienna_(seq, n_samples=10, T=37, version='2', constraint=None,
     Returns
         str, float: secondary structure representation and Z
     """
+    package = 'vienna_%s' % version if version else 'vienna'
+    return sample_structures(seq, n_samples=n_samples, package=package, T=T, constraint=constraint,
+        dangles=dangles, reweight=reweight, nonredundant=nonredundant)
+
+def sample_vienna_command_(seq, n_samples=10, T=37, version=DEFAULT_VERSIONS['vienna'], constraint=None, 
+	dangles=True, reweight=None, nonredundant=False):
+    """build the RNAsubopt call for `sample_vienna_`
+
+    Returns
+        list, str: command and stdin
+    """
 
     if not version:
-        version='2'
+        version=DEFAULT_VERSIONS['vienna']
 
     if version.startswith('2'):
-        LOC=package_locs['vienna_2']
+        LOC=locate('vienna_2')
     elif version.startswith('1'):
-        LOC=package_locs['vienna_1']
+        LOC=locate('vienna_1')
     else:
         raise RuntimeError('Error, vienna version %s not present' % version)
 
     command = ['%s/RNAsubopt' % LOC, '-T', str(T), '--stochBT_en=%d' % n_samples]#, '-N']
 
     if constraint is not None:
-        fname = write([seq, constraint])
+        stdin = '%s\n%s\n' % (seq, constraint)
         command.append('-C')
         command.append('--enforceConstraint')
     else:
-        fname = write([seq])
+        stdin = '%s\n' % seq
 
     if not dangles:
         command.append('--dangles=0')
@@ -85,31 +289,77 @@ def sample_vienna_(seq, n_samples=10, T=37, version='2', constraint=None,
     if reweight is not None:
         command.append('--commands=%s' % reweight)
 
-    with open(fname) as f:
-        if DEBUG: print(fname)
-        if DEBUG: print(' '.join(command))
-        p = sp.Popen(command, stdin=f, stdout=sp.PIPE, stderr=sp.PIPE)
-    stdout, stderr = p.communicate()
-
-    if DEBUG:
-        print('stdout')
-        print(stdout)
-        print('stderr')
-        print(stderr)
+    return command, stdin
 
-    if p.returncode:
-        raise Exception('RNAsubopt failed: on %s\n%s' % (seq, stderr))
-    os.remove(fname)
+def sample_vienna_result_(stdout, stderr):
+    """read the sampled structures from the output of a `sample_vienna_command_` run"""
 
     if 'omitting constraint' in stderr.decode('utf-8'):
         raise RuntimeError("Constraint omitted, Impossible structure")
 
+    output_lines = stdout.split(b'\n')[1:] # first line is just repeating sequence
+    output_lines = [line for line in output_lines if line.strip()]
+    N = len(output_lines[0].split()[0]) if output_lines else 0
+    return parse_sample_lines_(output_lines, N)[0]
+
+def _read_stderr_(err):
+    '''contents of a stderr file RNAsubopt is still writing to. pread leaves the shared file
+    offset alone: seeking would move the child's write position back over what it wrote.'''
+    chunks = []
+    while True:
+        chunk = os.pread(err.fileno(), 1<<16, sum(map(len, chunks)))
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+def _check_sample_stderr_(err):
+    if b'omitting constraint' in _read_stderr_(err):
+        raise RuntimeError("Constraint omitted, Impossible structure")
+
+def parse_sample_lines_(lines, N, structure_format='dotbracket'):
+    """structures, energies and probabilities of RNAsubopt --stochBT_en output lines (bytes)
+
+    Each line is `structure energy probability`; missing numbers are nan.
+    """
+    fields = [line.split() for line in lines]
+    energies = np.array([float(f[1]) if len(f) > 1 else np.nan for f in fields])
+    probabilities = np.array([float(f[2]) if len(f) > 2 else np.nan for f in fields])
+    structures = [f[0].decode('ascii') for f in fields]
+    return format_samples_(structures, N, structure_format), energies, probabilities
+
+def format_samples_(structures, N, structure_format='dotbracket'):
+    """sampled dot-bracket structures in structure_format"""
+    if structure_format == 'dotbracket':
+        #explicitly converting .'s to x's here to maintain x=unpaired, .=unconstrained
+        structures = [s.replace('.','x') for s in structures]
+    elif structure_format == 'partners':
+        structures = convert_dotbracket_to_partners(structures) if structures else np.zeros([0, N], dtype=np.int32)
+    elif structure_format == 'packed':
+        structures = convert_dotbracket_to_packed(structures) if structures else np.zeros([0, (N+3)//4], dtype=np.uint8)
     else:
-        struct_list, prob_list, energy_list = [],[],[]
-        output_lines = stdout.decode('utf-8').split('\n')[1:-1] # first line is just repeating sequence, last is empty space
-        for line in output_lines:
-            struct_list.append(line.split(' ')[0].replace('.','x')) #explicitly converting .'s to x's here to maintain x=unpaired, .=unconstrained
-            # prob_list.append(float(line.split(' ')[-2]))
-            # energy_list.append(float(line.split(' ')[-1]))
-
-    return struct_list
+        raise ValueError('structure_format %s not understood' % structure_format)
+    return structures
+
+def _join_sample_chunks_(chunks, N, structure_format):
+    energies = np.concatenate([c[1] for c in chunks]) if chunks else np.zeros(0)
+    probabilities = np.concatenate([c[2] for c in chunks]) if chunks else np.zeros(0)
+    if structure_format == 'dotbracket':
+        return [s for c in chunks for s in c[0]], energies, probabilities
+    if not chunks:
+        return parse_sample_lines_([], N, structure_format)
+    return np.concatenate([c[0] for c in chunks]), energies, probabilities
+
+def _count_samples_(structures, energies, probabilities):
+    """unique structures in order of first appearance, with their energies, probabilities and counts"""
+    if isinstance(structures, list):
+        first, counts = {}, {}
+        for k, s in enumerate(structures):
+            first.setdefault(s, k)
+            counts[s] = counts.get(s, 0) + 1
+        idx = np.array(list(first.values()), dtype=np.int64)
+        return list(first), energies[idx], probabilities[idx], np.array(list(counts.values()), dtype=np.int64)
+
+    _, idx, counts = np.unique(structures, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(idx)
+    idx = idx[order]
+    return structures[idx], energies[idx], probabilities[idx], counts[order]
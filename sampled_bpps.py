@@ -0,0 +1,126 @@
+import numpy as np
+from .sample_structures import sample_structures_iter
+from .sparse import SparseBPPs
+from .structures import convert_dotbracket_to_partners, convert_pairs_to_partners, convert_partners_to_dotbracket
+
+DEBUG=False
+
+class SampledBPPs:
+    '''Base pair probabilities of an N-nucleotide sequence estimated from sampled structures,
+    updated a chunk of samples at a time.
+
+    Pair counts are kept sparse, as sorted keys i*N+j (i < j) and counts, so memory grows with
+    the number of distinct pairs seen, not N^2.
+
+    Attributes:
+    N (int): sequence length
+    n (int): samples added so far
+    z (float): normal quantile of the confidence intervals (1.96 for 95%)
+    '''
+
+    def __init__(self, N, z=1.96):
+        self.N = int(N)
+        self.n = 0
+        self.z = z
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.paired_counts = np.zeros(self.N, dtype=np.int64)
+
+    def add(self, structures):
+        '''Count the pairs of a chunk of samples: an MxN partner array or a list of dot-brackets.'''
+        if not isinstance(structures, np.ndarray):
+            structures = convert_dotbracket_to_partners(list(structures))
+        partners = np.asarray(structures).reshape(-1, self.N)
+
+        rows, i = np.nonzero(partners > np.arange(self.N))
+        keys = i.astype(np.int64)*self.N + partners[rows, i]
+
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        self.counts = np.bincount(inverse, np.concatenate([self.counts, np.ones(len(i), dtype=np.int64)]),
+            minlength=len(keys)).astype(np.int64)
+        self.keys = keys
+        self.paired_counts += np.count_nonzero(partners >= 0, axis=0)
+        self.n += len(partners)
+        return self
+
+    def pairs(self):
+        '''i, j (i < j) and estimated probability of every pair seen'''
+        p = self.counts/max(self.n, 1)
+        return self.keys // self.N, self.keys % self.N, p
+
+    def bpps(self, sparse=False):
+        '''NxN symmetric matrix of estimated pair probabilities, or SparseBPPs'''
+        i, j, p = self.pairs()
+        if sparse:
+            return SparseBPPs(i, j, p, self.N)
+        probs = np.zeros([self.N, self.N])
+        probs[i, j] = probs[j, i] = p
+        return probs
+
+    def unpaired(self):
+        '''estimated probability that each nucleotide is unpaired'''
+        return 1 - self.paired_counts/max(self.n, 1)
+
+    def confidence_interval(self):
+        '''Wilson score interval of each pair seen.
+
+        Returns
+        i, j, lower, upper arrays. A pair never sampled has probability below
+        z^2/(n+z^2), see max_half_width.
+        '''
+        i, j, p = self.pairs()
+        lower, upper = _wilson(p, self.n, self.z)
+        return i, j, lower, upper
+
+    def max_half_width(self):
+        '''Error bound: widest confidence interval half-width over all pairs, sampled or not'''
+        if self.n == 0:
+            return np.inf
+        _, _, lower, upper = self.confidence_interval()
+        unseen = self.z**2/(self.n + self.z**2)
+        return max(np.max((upper - lower)/2, initial=0), unseen)
+
+    def centroid(self):
+        '''Centroid structure: every pair with estimated probability above 1/2 (these never cross)'''
+        i, j, p = self.pairs()
+        keep = p > 0.5
+        return convert_partners_to_dotbracket(convert_pairs_to_partners(i[keep], j[keep], self.N))
+
+def _wilson(p, n, z):
+    if n == 0:
+        return np.zeros_like(p), np.ones_like(p)
+    center = (p + z**2/(2*n))/(1 + z**2/n)
+    half = z*np.sqrt(p*(1-p)/n + z**2/(4*n**2))/(1 + z**2/n)
+    return np.clip(center - half, 0, 1), np.clip(center + half, 0, 1)
+
+def sampled_bpps(seq, n_samples=10000, package='vienna_2', tol=None, chunk_size=1000, z=1.96, seed=None, **kwargs):
+    '''Estimate base pair probabilities, unpaired probabilities and the centroid structure
+    from stochastic samples, streamed chunk_size at a time.
+
+    Args:
+    seq (str): nucleic acid sequence
+    n_samples (int): most samples to draw
+    package (str): any package sample_structures_iter supports
+    tol (float): stop early once max_half_width() (the confidence half-width of every pair
+        probability) is below tol, checked after each chunk
+    z (float): normal quantile of the confidence intervals
+    seed (int): same seed, same estimate (see sample_structures_iter)
+    (remaining args, e.g. T, constraint, dangles, go to sample_structures_iter)
+
+    Returns
+    SampledBPPs: .bpps(), .unpaired(), .centroid(), .confidence_interval(), .n samples used
+    '''
+    estimate = SampledBPPs(len(seq), z=z)
+
+    # one partition function, sampled a chunk at a time
+    chunks = (chunk[0] for chunk in sample_structures_iter(seq, n_samples=n_samples, package=package,
+        chunk_size=chunk_size, structure_format='partners', seed=seed, **kwargs))
+
+    for partners in chunks:
+        estimate.add(partners)
+        if DEBUG: print(estimate.n, estimate.max_half_width())
+        if tol is not None and estimate.max_half_width() <= tol:
+            break
+
+    chunks.close() # stops RNAsubopt if we stopped early
+    return estimate
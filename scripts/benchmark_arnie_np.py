@@ -0,0 +1,41 @@
+import sys, time, argparse
+import numpy as np
+from arnie.pfunc import pfunc
+from arnie.bpps import bpps
+from arnie.mfe import mfe
+
+if __name__=='__main__':
+    p = argparse.ArgumentParser(description=
+        """Time package='arnie_np' against another package on random sequences,
+        and compare their ensemble free energies and base pair probabilities.
+        """)
+
+    p.add_argument("-l", "--lengths", type=int, nargs='+', default=[20, 40, 80, 120],
+                   help="sequence lengths to time")
+    p.add_argument("-n", type=int, default=5, help="sequences per length")
+    p.add_argument("-p", "--package", default='vienna_2', help="package to compare against")
+    p.add_argument("--seed", type=int, default=0)
+
+    args = p.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    print('%6s %-10s %10s %10s %10s %10s' % ('length', 'package', 'pfunc (s)', 'bpps (s)', 'mfe (s)', 'mean dG'))
+    for N in args.lengths:
+        seqs = [''.join(rng.choice(list('ACGU'), N)) for _ in range(args.n)]
+        results = {}
+
+        for package in ['arnie_np', args.package]:
+            t0 = time.time()
+            dG = [pfunc(seq, package=package, return_free_energy=True) for seq in seqs]
+            t1 = time.time()
+            probs = [bpps(seq, package=package) for seq in seqs]
+            t2 = time.time()
+            for seq in seqs:
+                mfe(seq, package=package)
+            t3 = time.time()
+
+            results[package] = probs
+            print('%6d %-10s %10.3f %10.3f %10.3f %10.2f' % (N, package, (t1-t0)/args.n, (t2-t1)/args.n, (t3-t2)/args.n, np.mean(dG)))
+
+        diff = [np.abs(a - b).max() for a, b in zip(results['arnie_np'], results[args.package])]
+        print('%6d max |bpp difference| %.3f' % (N, np.max(diff)))
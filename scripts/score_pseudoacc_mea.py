@@ -1,10 +1,14 @@
 from arnie.mea.mea import *
+from arnie.parallel import map_ordered
+from arnie.utils import load_matrix
+from arnie.bppstore import BPPStore
 import numpy as np
 from glob import glob
 import argparse
 import sys, os
 
-def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False, metric='mcc', output_dir='MEA_output'):
+def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False, metric='mcc', output_dir='MEA_output',
+    n_jobs=None, search='grid', tol=0.1, store=None):
     '''Estimate maximum expected pseudoaccuracy structures per Hamada et al. BMC Bioinf 2010 11:586.
     
     Note: Files in matrix_dir and true_structs need to have the same names corresponding to their same constructs, but suffixes don't matter.
@@ -15,6 +19,11 @@ def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False
     gamma_min, gamma_max: min/max log_2(gamma) value used, defaults are -7 and 7.
     metric: keyword-based, which metric to use to select structure. Options are 'sen', 'ppv', 'mcc', 'fscore'.
     verbose: print output or not (for command line use)
+    n_jobs: worker processes, each loading and scoring its own matrices (default os.cpu_count())
+    search: 'grid' scores every integer log_2(gamma) in [gamma_min, gamma_max) in one MEA pass,
+        'golden' runs a golden-section search for the best log_2(gamma) in [gamma_min, gamma_max] per matrix
+    tol: log_2(gamma) interval at which the golden-section search stops
+    store: path of a BPPStore; matrix_list is then entry names in it (all entries if empty)
 
     Outputs:
     List of predicted structures (in dbn format) at each gamma.
@@ -23,56 +32,51 @@ def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False
 
     metric_ind = ['sen', 'ppv', 'mcc', 'fscore'].index(metric)
 
+    if store is not None and len(matrix_list) == 0:
+        matrix_list = BPPStore(store).names()
+
     if len(matrix_list) == 0:
         raise ValueError('No matrix files found!')
 
-    matrices = [np.loadtxt(x) for x in matrix_list]
-    pdb_indices = [os.path.basename(x).split('.')[0] for x in matrix_list]
+    if search not in ['grid', 'golden']:
+        raise ValueError('search %s not understood, use grid or golden.' % search)
 
-    n_constructs = len(matrices)
+    pdb_indices = [os.path.basename(x).split('.')[0] for x in matrix_list]
 
     gamma_vals = [x for x in range(gamma_min, gamma_max)]
+
+    # matrices are read in the workers, one at a time, instead of all up front
+    results = map_ordered(best_MEA_structure, matrix_list, n_jobs=n_jobs, raise_errors=True, metric_ind=metric_ind,
+        search=search, gamma_vals=gamma_vals, gamma_min=gamma_min, gamma_max=gamma_max, tol=tol, store=store)
+
     best_metric_values, best_gammas, best_structs,best_metrics = [],[],[],[]
 
     metrics_across_gammas = {k:[] for k in gamma_vals}
 
     if verbose: print('\nmetric\tpdb_ind\tbest_log2g\tbest_metric_value\tbest_struct')
 
-    for i, matrix in enumerate(matrices):
-
-        running_best_metrics = []
-        running_best_value = 0
-        running_best_gamma = -101
-        running_best_struct = ''
+    for i, (scored, running_best_metrics, running_best_value, running_best_gamma, running_best_struct) in enumerate(results):
 
-        for g in gamma_vals:
-
-            mea_cls = MEA(matrix, gamma=2**g)
-
-            metrics = mea_cls.score_expected() #sen, ppv, mcc, fscore
-            metrics_across_gammas[g].append(metrics)
-
-            if metrics[metric_ind] > running_best_value:
-                running_best_value = metrics[metric_ind]
-                running_best_metrics = metrics
-                running_best_gamma = g
-                running_best_struct = mea_cls.structure
+        if search == 'grid':
+            for g, metrics, _ in scored:
+                metrics_across_gammas[g].append(metrics)
 
         best_metrics.append(running_best_metrics)
         best_metric_values.append(running_best_value)
         best_gammas.append(running_best_gamma)
         best_structs.append(running_best_struct)
 
-        if verbose: print("%s\t%s\t%d\t%.3f\t%s" % (metric, pdb_indices[i], running_best_gamma, running_best_value, running_best_struct))
+        if verbose: print("%s\t%s\t%g\t%.3f\t%s" % (metric, pdb_indices[i], running_best_gamma, running_best_value, running_best_struct))
 
     # print('Avg metrics across gamma vals')
 
     print('\t\tlog2(g)\tsen\tppv\tmcc\tfscore')
 
-    for g in gamma_vals:
+    if search == 'grid':
+        for g in gamma_vals:
 
-        [sen, ppv, mcc, fscore] = np.mean(metrics_across_gammas[g], axis=0)
-        print('gamma_avg\t%d\t%.3f\t%.3f\t%.3f\t%.3f' % (g, sen, ppv, mcc, fscore))
+            [sen, ppv, mcc, fscore] = np.mean(metrics_across_gammas[g], axis=0)
+            print('gamma_avg\t%d\t%.3f\t%.3f\t%.3f\t%.3f' % (g, sen, ppv, mcc, fscore))
 
     # print('Best avg metrics using individual gammas')
     [sen, ppv, mcc, fscore] = np.mean(np.array(best_metrics), axis=0)
@@ -90,6 +94,75 @@ def predict_MEA_structures(matrix_list, gamma_min=-7, gamma_max=7, verbose=False
 
     return best_structs
     
+_stores = {} # opened once per worker
+
+def best_MEA_structure(matrix_file, metric_ind=2, search='grid', gamma_vals=range(-7,7), gamma_min=-7, gamma_max=7, tol=0.1, store=None):
+    '''Best-scoring MEA structure of one base pair probability matrix file (see predict_MEA_structures).
+
+    Returns: list of (log_2(gamma), [sen, ppv, mcc, fscore], structure) for every gamma tried, and the
+    metrics, metric value, log_2(gamma) and structure of the best one.
+    With store (path of a BPPStore), matrix_file is the name of an entry in it.'''
+
+    if store is not None:
+        if store not in _stores:
+            _stores[store] = BPPStore(store)
+        matrix = _stores[store].get(matrix_file)
+    else:
+        matrix = load_matrix(matrix_file)
+
+    if search == 'grid':
+        meas = MEA.for_gammas(matrix, [2**g for g in gamma_vals])
+        metrics = np.transpose(score_expected(np.stack([mea.MEA_bp_matrix for mea in meas]), matrix))
+        scored = [(g, list(m), mea.structure) for g, m, mea in zip(gamma_vals, metrics, meas)]
+    else:
+        scored = golden_section_MEA(matrix, metric_ind, gamma_min, gamma_max, tol=tol)
+
+    running_best_metrics = []
+    running_best_value = 0
+    running_best_gamma = -101
+    running_best_struct = ''
+
+    for g, metrics, struct in scored:
+        if metrics[metric_ind] > running_best_value:
+            running_best_value = metrics[metric_ind]
+            running_best_metrics = metrics
+            running_best_gamma = g
+            running_best_struct = struct
+
+    return scored, running_best_metrics, running_best_value, running_best_gamma, running_best_struct
+
+def golden_section_MEA(matrix, metric_ind, lo, hi, tol=0.1):
+    '''Golden-section search for the log_2(gamma) in [lo, hi] maximizing one expected accuracy metric.
+
+    The metric is a step function of gamma, so this finds a local maximum; both ends of the
+    interval are scored as well.
+
+    Returns: list of (log_2(gamma), [sen, ppv, mcc, fscore], structure) in the order they were scored.'''
+
+    invphi = (np.sqrt(5) - 1)/2
+    scored = {}
+
+    def metric_at(x):
+        if x not in scored:
+            mea = MEA(matrix, gamma=2**x)
+            scored[x] = (mea.score_expected(), mea.structure)
+        return scored[x][0][metric_ind]
+
+    metric_at(lo)
+    metric_at(hi)
+
+    a, b = lo, hi
+    c, d = b - invphi*(b - a), a + invphi*(b - a)
+    while b - a > tol:
+        if metric_at(c) >= metric_at(d):
+            b, d = d, c
+            c = b - invphi*(b - a)
+        else:
+            a, c = c, d
+            d = a + invphi*(b - a)
+
+    return [(x, metrics, struct) for x, (metrics, struct) in scored.items()]
+
 def score_against_true_structs(pred_struct_list, true_struct_list, verbose=False, weight_by_n_bps=False):
     '''Score maximum expected pseudoaccuracy structures against provided 3D structures.  
     
@@ -131,33 +204,19 @@ def score_against_true_structs(pred_struct_list, true_struct_list, verbose=False
 
     assert len(pred_structs) == len(true_structs)
 
-    tally, ptl_sen, ptl_ppv, ptl_mcc, ptl_fscore = 0, 0, 0, 0, 0
-
     pdb_indices = [os.path.basename(x).split('.')[0] for x in pred_struct_list]
-    
-    for i in range(len(pred_structs)):
-        
-        sen, ppv, mcc, fscore, N = score_ground_truth(pred_structs[i], true_structs[i])
-        print('Score:\t%s\t%.3f\t%.3f\t%.3f\t%.3f' % (pdb_indices[i], sen, ppv, mcc, fscore))
 
-        if weight_by_n_bps:
-            ptl_sen += sen*N
-            ptl_ppv += ppv*N
-            ptl_mcc += mcc*N
-            ptl_fscore += fscore*N
-            tally += N
+    sens, ppvs, mccs, fscores, Ns = score_ground_truth_batch(pred_structs, true_structs)
 
-        else:
-            ptl_sen += sen
-            ptl_ppv += ppv
-            ptl_mcc += mcc
-            ptl_fscore += fscore
-            tally += 1
+    for i in range(len(pred_structs)):
+        print('Score:\t%s\t%.3f\t%.3f\t%.3f\t%.3f' % (pdb_indices[i], sens[i], ppvs[i], mccs[i], fscores[i]))
+
+    if weight_by_n_bps:
+        weights = Ns
+    else:
+        weights = np.ones(len(Ns))
 
-    mean_sen = ptl_sen/tally
-    mean_ppv = ptl_ppv/tally
-    mean_mcc = ptl_mcc/tally
-    mean_fscore = ptl_fscore/tally
+    mean_sen, mean_ppv, mean_mcc, mean_fscore = [np.sum(x*weights)/np.sum(weights) for x in [sens, ppvs, mccs, fscores]]
 
     print("Avg:\tsen\tppv\tmcc\tfscore\n\t%.3f\t%.3f\t%.3f\t%.3f" % (mean_sen, mean_ppv, mean_mcc, mean_fscore))
 
@@ -176,6 +235,9 @@ if __name__ == '__main__':
     parser.add_argument('--bp_matrices','-p', nargs='+', 
         help='path to NxN matrices of bp probabilities, i.e. `contrafold/*.bpps`.')
 
+    parser.add_argument('--store', default=None,
+        help='Read matrices from this BPPStore (see write_bpp_matrices.py --store); --bp_matrices are then entry names, default all.')
+
     parser.add_argument('--output_dir', '-o', 
         help="Path to output of predicted MEA structures. Default is `MEA_output`.", default = 'MEA_output')
 
@@ -188,6 +250,11 @@ if __name__ == '__main__':
     parser.add_argument('--gamma_min',type=int, default=-7, help='Min value for log_2(gamma), default is -7')
     parser.add_argument('--gamma_max',type=int, default=7, help='Max value for log_2(gamma), default is 7')
 
+    parser.add_argument('--search', default='grid', choices=['grid', 'golden'],
+        help='`grid` tries every integer log_2(gamma) from gamma_min to gamma_max, `golden` searches between them per matrix. Default is `grid`.')
+    parser.add_argument('--tol', type=float, default=0.1, help='log_2(gamma) precision of the golden search, default is 0.1')
+    parser.add_argument('--n_jobs', '-j', type=int, default=None, help='Worker processes, default is one per CPU')
+
     parser.add_argument('--weight_by_n_bps', dest='weight_by_n_bps', action='store_true', 
         help='For scoring to true structures, weight accuracy over dataset by number of bps.\
          If flag not included, equal weight across constructs.')
@@ -203,6 +270,9 @@ if __name__ == '__main__':
         
     args = parser.parse_args()
 
+    if args.store and not args.bp_matrices:
+        args.bp_matrices = BPPStore(args.store).names()
+
     #if args.true_structs:
         #assert len(args.bp_matrices) == len(args.true_structs)
 
@@ -215,7 +285,8 @@ if __name__ == '__main__':
         print('\nScanning gamma for MEA structure prediction:')
 
     if not args.score_truth_only:
-        predict_MEA_structures(args.bp_matrices, gamma_min = args.gamma_min, gamma_max = args.gamma_max, verbose=args.verbose, metric = args.metric, output_dir = args.output_dir)
+        predict_MEA_structures(args.bp_matrices, gamma_min = args.gamma_min, gamma_max = args.gamma_max, verbose=args.verbose, metric = args.metric, output_dir = args.output_dir,
+            n_jobs = args.n_jobs, search = args.search, tol = args.tol, store = args.store)
 
     if args.true_structs:
         if args.verbose: print('\nScoring provided true structures against maximum expected pseudoaccuracy structures:')
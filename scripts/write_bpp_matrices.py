@@ -1,18 +1,80 @@
 import sys, os, argparse
+from glob import glob
+import numpy as np
 import arnie.bpps as bpps
-from arnie.utils import write_matrix_to_file
+from arnie.utils import write_matrix
+from arnie.parallel import map_ordered
+from arnie.bppstore import BPPStore, fold_conditions
+
+EXTENSIONS = {'txt': 'bpps', 'npy': 'npy', 'npz': 'npz'}
+
+def write_bpp_matrix(seqfile, output_dir='.', package='vienna_2', fmt='txt', layout='dense', dtype=None, threshold=0):
+    '''Fold one *.seq file (sequence on its last line) and write its matrix; returns the output file'''
+    seq = open(seqfile,'r').readlines()[-1].rstrip()
+    seq_id = os.path.basename(seqfile).replace('.seq','')
+    outfile = "%s/%s.%s" % (output_dir, seq_id, EXTENSIONS[fmt])
+
+    # sparse layout never builds the NxN matrix
+    bp_matrix = bpps.bpps(seq, package=package, sparse=layout=='sparse', threshold=threshold)
+    write_matrix(bp_matrix, outfile, layout=layout, dtype=dtype, threshold=threshold)
+    return outfile
+
+def fold_seq_file(seqfile, package='vienna_2', sparse=False):
+    '''(sequence, matrix or SparseBPPs of all pairs) of one *.seq file, for a store'''
+    seq = open(seqfile,'r').readlines()[-1].rstrip()
+    return seq, bpps.bpps(seq, package=package, sparse=sparse)
+
+def write_to_store(seqfiles, store, package='vienna_2', n_jobs=None, overwrite=False):
+    '''Fold *.seq files on n_jobs workers into a BPPStore, entries named by file; returns the names written'''
+    conditions = fold_conditions(package)
+    store.check(conditions)
+    names = [os.path.basename(x).replace('.seq','') for x in seqfiles]
+    todo = [(x, name) for x, name in zip(seqfiles, names) if overwrite or name not in store]
+    if len(todo) < len(seqfiles): print('Skipping %d sequences already in %s' % (len(seqfiles) - len(todo), store.path))
+
+    # a few rounds of workers at a time, so finished matrices don't pile up in memory
+    step = 4*(n_jobs or os.cpu_count())
+    written = []
+    for start in range(0, len(todo), step):
+        chunk = todo[start:start+step]
+        # every pair goes to the store, which applies its threshold after taking the unpaired vector
+        results = map_ordered(fold_seq_file, [x for x, _ in chunk], n_jobs=n_jobs, package=package,
+            sparse=store.layout=='sparse')
+        for (seqfile, name), result in zip(chunk, results):
+            if isinstance(result, Exception):
+                print('%s failed: %s' % (seqfile, result))
+                continue
+            seq, bp_matrix = result
+            store.put(seq, bp_matrix, name=name, conditions=conditions)
+            written.append(name)
+            print('%s -> %s' % (seqfile, store.path))
+    return written
 
 if __name__=='__main__':
     p = argparse.ArgumentParser(description=
         """
         Write base pairing probability matrices to files.
         """)
-    
+
     p.add_argument("seq_dir", nargs='+',
-                   help="path to dir of *.seq files")
+                   help="*.seq files, or dirs of them")
     p.add_argument("-o", help="name of output dir")
     p.add_argument("-p", "--package", default='vienna_2',
                    help="Package to use")
+    p.add_argument("--format", choices=sorted(EXTENSIONS), default='txt',
+                   help="txt: '%%.3f' text (.bpps); npy or npz: binary")
+    p.add_argument("--layout", choices=['dense', 'triu', 'sparse'], default='dense',
+                   help="NxN matrix, upper triangle only (npy/npz), or i, j, p triples (npz)")
+    p.add_argument("--dtype", choices=['float16', 'float32', 'float64'], default=None,
+                   help="Stored float type for npy/npz")
+    p.add_argument("--threshold", type=float, default=0,
+                   help="Sparse layout keeps pairs above this probability")
+    p.add_argument("-j", "--n_jobs", type=int, default=None,
+                   help="Worker processes, default is one per CPU")
+    p.add_argument("--overwrite", action='store_true',
+                   help="Refold sequences whose output already exists (skipped by default)")
+    p.add_argument("--store",
+                   help="Append to this BPPStore directory instead of writing a file per sequence (--layout triu or sparse, --dtype)")
 
     if len(sys.argv)==1:
         p.print_help(sys.stderr)
@@ -20,13 +82,35 @@ if __name__=='__main__':
 
     args = p.parse_args()
 
+    seqfiles = []
+    for x in args.seq_dir:
+        seqfiles.extend(sorted(glob(os.path.join(x, '*.seq'))) if os.path.isdir(x) else [x])
+
+    if args.store:
+        layout = 'triu' if args.layout == 'dense' else args.layout
+        store = BPPStore(args.store, layout=layout, dtype=args.dtype or 'float32', threshold=args.threshold)
+        write_to_store(seqfiles, store, package=args.package, n_jobs=args.n_jobs, overwrite=args.overwrite)
+        sys.exit(0)
+
+    if args.layout != 'dense' and args.format == 'txt':
+        p.error('--layout %s needs --format npy or npz' % args.layout)
+    if args.layout == 'sparse' and args.format != 'npz':
+        p.error('--layout sparse needs --format npz')
+
     if not os.path.exists('./%s' % args.o):
         os.makedirs('./%s' % args.o)
 
-    for seqfile in args.seq_dir:
-        print(seqfile)
-        seq=open(seqfile,'r').readlines()[-1].rstrip()
-        seq_id = os.path.basename(seqfile).replace('.seq','')
-        bp_matrix = bpps.bpps(seq, package=args.package)
-        with open("%s/%s.bpps" % (args.o, seq_id),'w') as f:
-            write_matrix_to_file(bp_matrix, f)
+    if not args.overwrite:
+        done = [x for x in seqfiles if os.path.exists("%s/%s.%s" % (args.o,
+            os.path.basename(x).replace('.seq',''), EXTENSIONS[args.format]))]
+        if done: print('Skipping %d sequences already written' % len(done))
+        seqfiles = [x for x in seqfiles if x not in set(done)]
+
+    results = map_ordered(write_bpp_matrix, seqfiles, n_jobs=args.n_jobs, output_dir=args.o, package=args.package,
+        fmt=args.format, layout=args.layout, dtype=args.dtype, threshold=args.threshold)
+
+    for seqfile, result in zip(seqfiles, results):
+        if isinstance(result, Exception):
+            print('%s failed: %s' % (seqfile, result))
+        else:
+            print(result)
@@ -1,18 +1,51 @@
 import sys, os, argparse
+from glob import glob
 import arnie.bpps as bpps
 import numpy as np
 from arnie.utils import write_vector_to_file
+from arnie.parallel import map_ordered
+from arnie.bppstore import BPPStore, fold_conditions
+
+# per-nucleotide vector (a SparseBPPs method) -> file extension
+VECTORS = {'unpaired': 'unp', 'entropy': 'ent', 'expected_partner': 'partner'}
+
+def fold_vectors(item, package='vienna_2'):
+    '''fold a (sequence, vectors) once and return each of vectors, from the pair list (no NxN matrix)'''
+    seq, vectors = item
+    pairs = bpps.bpps(seq, package=package, sparse=True)
+    return [getattr(pairs, vector)() for vector in vectors]
+
+def stored_vectors(store, seq, vectors):
+    '''vectors of a sequence from a BPPStore; unpaired probabilities are stored as they are'''
+    pairs = None
+    result = []
+    for vector in vectors:
+        if vector == 'unpaired':
+            result.append(store.unpaired(seq))
+        else:
+            if pairs is None:
+                pairs = store.get(seq, sparse=True)
+            result.append(getattr(pairs, vector)())
+    return result
 
 if __name__=='__main__':
     p = argparse.ArgumentParser(description=
-        """Write unpaired posterior probabilities to files.
+        """Write unpaired posterior probabilities (or positional entropies, expected partners) to files.
         """)
-    
+
     p.add_argument("seq_dir", nargs='+',
-                   help="path to dir of *.seq files")
+                   help="*.seq files, or dirs of them")
     p.add_argument("-o", help="name of output dir")
-    p.add_argument("-p", "--package", choices=['vienna_2', 'contrafold_se', 'nupack_95'], default='vienna_2',
+    p.add_argument("-p", "--package", choices=['vienna_2', 'contrafold_se', 'nupack_95', 'arnie_np'], default='vienna_2',
                    help="Package to use")
+    p.add_argument("-v", "--vector", choices=sorted(VECTORS), nargs='+', default=['unpaired'],
+                   help="Vectors to write, as .unp, .ent and .partner files")
+    p.add_argument("-j", "--n_jobs", type=int, default=None,
+                   help="Worker processes, default is one per CPU")
+    p.add_argument("--overwrite", action='store_true',
+                   help="Refold sequences whose outputs already exist (skipped by default)")
+    p.add_argument("--store",
+                   help="Take the pair probabilities of sequences in this BPPStore from it instead of folding")
 
     if len(sys.argv)==1:
         p.print_help(sys.stderr)
@@ -23,12 +56,35 @@ if __name__=='__main__':
     if not os.path.exists('./%s' % args.o):
         os.makedirs('./%s' % args.o)
 
-    for seqfile in args.seq_dir:
-        print(seqfile)
-        seq=open(seqfile,'r').readlines()[-1].rstrip()
-    	seq_id = os.path.basename(seqfile).replace('.seq','')
+    seqfiles = []
+    for x in args.seq_dir:
+        seqfiles.extend(sorted(glob(os.path.join(x, '*.seq'))) if os.path.isdir(x) else [x])
+    seq_ids = [os.path.basename(x).replace('.seq','') for x in seqfiles]
+    store = None
+    if args.store:
+        store = BPPStore(args.store)
+        store.check(fold_conditions(args.package))
+
+    # the vectors each sequence still needs
+    todo = []
+    for seqfile, seq_id in zip(seqfiles, seq_ids):
+        vectors = [v for v in args.vector if args.overwrite or not os.path.exists("%s/%s.%s" % (args.o, seq_id, VECTORS[v]))]
+        if vectors:
+            todo.append((seqfile, seq_id, open(seqfile,'r').readlines()[-1].rstrip(), vectors))
+    if len(todo) < len(seqfiles): print('Skipping %d sequences already written' % (len(seqfiles) - len(todo)))
 
-        unp_vector = 1-np.sum(bpps.bpps(seq, package=args.package),axis=0)
+    stored = [store is not None and seq in store for _, _, seq, _ in todo]
 
-    	with open("%s/%s.unp" % (args.o, seq_id),'w') as f:
-    		write_vector_to_file(unp_vector, f)
+    # each sequence is folded once for all its vectors; a sequence per worker
+    folded = iter(map_ordered(fold_vectors, [(seq, vectors) for (_, _, seq, vectors), s in zip(todo, stored) if not s],
+        n_jobs=args.n_jobs, package=args.package))
+
+    for (seqfile, seq_id, seq, vectors), s in zip(todo, stored):
+        result = stored_vectors(store, seq, vectors) if s else next(folded)
+        if isinstance(result, Exception):
+            print('%s failed: %s' % (seqfile, result))
+            continue
+        print(seqfile)
+        for vector, vec in zip(vectors, result):
+            with open("%s/%s.%s" % (args.o, seq_id, VECTORS[vector]),'w') as f:
+                write_vector_to_file(vec, f)
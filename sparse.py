@@ -0,0 +1,126 @@
+import numpy as np
+
+DEBUG=False
+
+class SparseBPPs:
+    '''Base pair probabilities of an N-nucleotide sequence as (i, j, p) triples with i < j.
+
+    What `bpps(..., sparse=True)` returns in place of the symmetric NxN matrix.
+
+    Attributes:
+    i, j (array): 0-indexed paired positions, i < j, sorted by i then j
+    p (array): pair probabilities
+    N (int): sequence length
+    '''
+
+    def __init__(self, i, j, p, N):
+        i, j, p = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64), np.asarray(p, dtype=np.float64)
+        lo, hi = np.minimum(i, j), np.maximum(i, j)
+
+        # sort, keeping the last entry given for a repeated pair
+        order = np.lexsort((np.arange(len(p))[::-1], hi, lo))
+        lo, hi, p = lo[order], hi[order], p[order]
+        first = np.ones(len(p), dtype=bool)
+        first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+
+        self.i = lo[first].astype(np.int32)
+        self.j = hi[first].astype(np.int32)
+        self.p = p[first]
+        self.N = int(N)
+
+    @classmethod
+    def from_dense(cls, matrix, threshold=0):
+        '''Pairs of the upper triangle of an NxN matrix with probability above `threshold`.'''
+        matrix = np.asarray(matrix)
+        i, j = np.triu_indices(matrix.shape[0], k=1)
+        p = matrix[i, j]
+        keep = p > threshold
+        return cls(i[keep], j[keep], p[keep], matrix.shape[0])
+
+    @property
+    def shape(self):
+        return (self.N, self.N)
+
+    @property
+    def nnz(self):
+        return len(self.p)
+
+    def __len__(self):
+        return self.N
+
+    def __repr__(self):
+        return 'SparseBPPs(N=%d, nnz=%d)' % (self.N, self.nnz)
+
+    def toarray(self, dtype=np.float64):
+        '''symmetric NxN matrix'''
+        matrix = np.zeros([self.N, self.N], dtype=dtype)
+        matrix[self.i, self.j] = self.p
+        matrix[self.j, self.i] = self.p
+        return matrix
+
+    def __array__(self, dtype=None, copy=None):
+        return self.toarray(dtype=dtype or np.float64)
+
+    def tocsr(self):
+        '''symmetric scipy.sparse.csr_matrix (needs scipy)'''
+        try:
+            from scipy.sparse import csr_matrix
+        except ImportError:
+            raise ImportError('tocsr needs scipy; use toarray() or the i, j, p arrays instead.')
+        rows = np.concatenate([self.i, self.j])
+        cols = np.concatenate([self.j, self.i])
+        return csr_matrix((np.concatenate([self.p, self.p]), (rows, cols)), shape=self.shape)
+
+    def threshold(self, theta):
+        '''pairs with probability above theta'''
+        keep = self.p > theta
+        return SparseBPPs(self.i[keep], self.j[keep], self.p[keep], self.N)
+
+    def paired(self):
+        '''probability that each nucleotide is paired (row sums of the matrix)'''
+        return np.bincount(self.i, self.p, minlength=self.N) + np.bincount(self.j, self.p, minlength=self.N)
+
+    def unpaired(self):
+        '''probability that each nucleotide is unpaired'''
+        return 1 - self.paired()
+
+    def entropy(self):
+        '''positional entropy of each nucleotide, -sum_j p_ij ln p_ij - q_i ln q_i with q_i unpaired'''
+        terms = -self.p*np.log(np.where(self.p > 0, self.p, 1))
+        q = np.clip(self.unpaired(), 0, 1)
+        return (np.bincount(self.i, terms, minlength=self.N) + np.bincount(self.j, terms, minlength=self.N)
+            - q*np.log(np.where(q > 0, q, 1)))
+
+    def expected_partner(self):
+        '''mean partner position of each nucleotide, weighted by pair probability; -1 if it has no pairs'''
+        weighted = np.bincount(self.i, self.p*self.j, minlength=self.N) + np.bincount(self.j, self.p*self.i, minlength=self.N)
+        paired = self.paired()
+        return np.divide(weighted, paired, out=np.full(self.N, -1.0), where=paired > 0)
+
+    def max_per_position(self):
+        '''largest pair probability of each nucleotide (0 for nucleotides without pairs)'''
+        maxp = np.zeros(self.N)
+        np.maximum.at(maxp, self.i, self.p)
+        np.maximum.at(maxp, self.j, self.p)
+        return maxp
+
+def triples_to_bpps(i, j, p, N, sparse=False, threshold=0):
+    '''Base pair probabilities from parsed (i, j, p) triples (0-indexed, either order).
+
+    Args:
+    sparse (bool): return SparseBPPs of the pairs above `threshold` instead of a dense matrix
+    threshold (float): probability cutoff for sparse output
+
+    Returns
+    NxN array, or SparseBPPs
+    '''
+    i, j, p = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64), np.asarray(p, dtype=np.float64)
+
+    if sparse:
+        keep = p > threshold
+        return SparseBPPs(i[keep], j[keep], p[keep], N)
+
+    probs = np.zeros([N, N])
+    probs[i, j] = p
+    probs[j, i] = p
+    return probs
@@ -0,0 +1,239 @@
+import numpy as np
+
+DEBUG=False
+
+# Secondary structures as partner arrays: partners[i] is the 0-indexed nucleotide i pairs
+# with, -1 if unpaired (int32). Every converter takes one structure or a batch of
+# equal-length ones: a string or a list of strings, a length-N or an MxN partner array.
+
+# bracket pairs of extended dot-bracket notation, in the order they go to crossing stems
+BRACKETS = ['()', '[]', '{}', '<>'] + [chr(c) + chr(c).lower() for c in range(ord('A'), ord('Z')+1)]
+
+def _bracket_codes(brackets):
+    '''code point (< 256) -> k+1 for the opener of bracket pair k, -(k+1) for its closer, else 0'''
+    table = np.zeros(256, dtype=np.int16)
+    for k, (opener, closer) in enumerate(brackets):
+        table[ord(opener)] = k+1
+        table[ord(closer)] = -(k+1)
+    return table
+
+def _partners_one(structure, brackets):
+    '''stack per bracket type; unmatched brackets are left unpaired'''
+    partners = np.full(len(structure), -1, dtype=np.int32)
+    kind = {}
+    for k, (opener, closer) in enumerate(brackets):
+        kind[opener], kind[closer] = (k, True), (k, False)
+
+    stacks = [[] for _ in brackets]
+    for i, c in enumerate(structure):
+        if c in kind:
+            k, opens = kind[c]
+            if opens:
+                stacks[k].append(i)
+            elif stacks[k]:
+                j = stacks[k].pop()
+                partners[i], partners[j] = j, i
+    return partners
+
+def convert_dotbracket_to_partners(structures, brackets=BRACKETS):
+    '''Partner array(s) of dot-bracket structure(s).
+
+    Balanced structures of a batch are matched all at once: per bracket type, an opener
+    pairs with the next closer at the same nesting depth, so sorting bracket positions by
+    (structure, depth, position) lines each opener up right before its closer. Others go
+    through a stack per bracket type.
+
+    Args:
+    structures (str or list of str): equal-length structures for a batch
+    brackets (list): bracket pairs to read; other characters are unpaired
+
+    Returns
+    int32 array, N or MxN
+    '''
+    if isinstance(structures, str):
+        return _partners_one(structures, brackets)
+
+    structures = list(structures)
+    if len(set(map(len, structures))) > 1:
+        raise ValueError('structures differ in length; convert them separately')
+    M = len(structures)
+    N = len(structures[0]) if M else 0
+
+    partners = np.full([M, N], -1, dtype=np.int32)
+    if M == 0 or N == 0:
+        return partners
+
+    codes = np.array(structures, dtype='U%d' % N).view(np.uint32).reshape(M, N)
+    kinds = np.where(codes < 256, _bracket_codes(brackets)[np.minimum(codes, 255)], 0)
+
+    unbalanced = np.zeros(M, dtype=bool)
+    for k in np.unique(np.abs(kinds[kinds != 0])):
+        step = (kinds == k).astype(np.int32) - (kinds == -k)
+        depth = np.cumsum(step, axis=1)
+        bad = (depth.min(axis=1) < 0) | (depth[:, -1] != 0)
+        unbalanced |= bad
+
+        rows, cols = np.nonzero(step * ~bad[:, None])
+        level = depth[rows, cols] + (step[rows, cols] < 0)
+        order = np.argsort((rows.astype(np.int64)*(N+1) + level)*N + cols, kind='stable')
+        opens, closes = order[0::2], order[1::2]
+        partners[rows[opens], cols[opens]] = cols[closes]
+        partners[rows[closes], cols[closes]] = cols[opens]
+
+    for r in np.flatnonzero(unbalanced):
+        partners[r] = _partners_one(structures[r], brackets)
+
+    return partners
+
+def _dotbracket_one(partners, brackets):
+    '''pairs in 5' order take the first bracket type none of whose open pairs they cross'''
+    structure = ['.']*len(partners)
+    levels = [] # per bracket type, closing positions of its open pairs, innermost last
+    for i, j in enumerate(partners):
+        if j <= i:
+            continue
+        for k, stack in enumerate(levels):
+            while stack and stack[-1] < i:
+                stack.pop()
+            if not stack or stack[-1] > j:
+                break
+        else:
+            k = len(levels)
+            if k == len(brackets):
+                raise ValueError('structure needs more than %d bracket types' % len(brackets))
+            levels.append([])
+        levels[k].append(j)
+        structure[i], structure[j] = brackets[k][0], brackets[k][1]
+    return ''.join(structure)
+
+def convert_partners_to_dotbracket(partners, brackets=BRACKETS):
+    '''Dot-bracket string(s) of partner array(s); crossing stems get [], {}, <>, Aa, ...
+
+    Returns
+    str, or list of str for an MxN array
+    '''
+    partners = np.asarray(partners)
+    if partners.ndim == 1:
+        return _dotbracket_one(partners, brackets)
+
+    M, N = partners.shape
+    idx = np.arange(N)
+    chars = np.full([M, N], ord('.'), dtype=np.uint32)
+    chars[(partners > idx)] = ord(brackets[0][0])
+    chars[(partners >= 0) & (partners < idx)] = ord(brackets[0][1])
+    structures = chars.view('U%d' % N).ravel().tolist() if N else ['']*M
+
+    # with one bracket type, pseudoknotted rows don't read back the same
+    if N:
+        nested = np.all(convert_dotbracket_to_partners(structures, brackets[:1]) == partners, axis=1)
+        for r in np.flatnonzero(~nested):
+            structures[r] = _dotbracket_one(partners[r], brackets)
+    return structures
+
+def convert_dotbracket_to_packed(structures):
+    '''Nested dot-bracket structure(s) at 2 bits per nucleotide, 4 nucleotides per byte.
+
+    '(' is 1, ')' is 2, anything else ('.', 'x', ...) unpaired, 0; [], {} and <>
+    raise ValueError. A quarter of the memory of the structure as uint8 characters.
+
+    Returns
+    uint8 array, ceil(N/4) or M x ceil(N/4) for a list of equal-length structures
+    '''
+    single = isinstance(structures, str)
+    structures = [structures] if single else list(structures)
+    if len(set(map(len, structures))) > 1:
+        raise ValueError('structures differ in length; convert them separately')
+    M = len(structures)
+    N = len(structures[0]) if M else 0
+
+    codes = np.array(structures, dtype='U%d' % max(N, 1)).view(np.uint32).reshape(M, max(N, 1))[:, :N]
+    if np.any(np.isin(codes, [ord(c) for pair in BRACKETS[1:4] for c in pair])):
+        raise ValueError('packed structures hold nested () pairs only')
+    bits = (codes == ord('(')).astype(np.uint8) + 2*(codes == ord(')'))
+
+    bits = np.pad(bits, [(0, 0), (0, -N % 4)]).reshape(M, (N+3)//4, 4)
+    packed = (bits[:, :, 0] << 6) | (bits[:, :, 1] << 4) | (bits[:, :, 2] << 2) | bits[:, :, 3]
+    return packed[0] if single else packed
+
+def convert_packed_to_dotbracket(packed, N, unpaired='.'):
+    '''Dot-bracket string(s) of N nucleotides from convert_dotbracket_to_packed output.
+
+    Returns
+    str, or list of str for an M x ceil(N/4) array
+    '''
+    packed = np.asarray(packed, dtype=np.uint8)
+    single = packed.ndim == 1
+    packed = packed.reshape(-1, packed.shape[-1])
+
+    bits = np.stack([packed >> 6, packed >> 4, packed >> 2, packed], axis=-1) & 3
+    bits = bits.reshape(packed.shape[0], -1)[:, :N]
+    chars = np.array([ord(unpaired), ord('('), ord(')'), ord(unpaired)], dtype=np.uint32)[bits]
+    structures = chars.view('U%d' % N).ravel().tolist() if N else ['']*packed.shape[0]
+    return structures[0] if single else structures
+
+def convert_partners_to_pairs(partners):
+    '''(i, j) arrays of the pairs, i < j; (structure index, i, j) for an MxN array'''
+    partners = np.asarray(partners)
+    if partners.ndim == 1:
+        i = np.flatnonzero(partners > np.arange(len(partners))).astype(np.int32)
+        return i, partners[i].astype(np.int32)
+    rows, i = np.nonzero(partners > np.arange(partners.shape[1]))
+    return rows.astype(np.int32), i.astype(np.int32), partners[rows, i].astype(np.int32)
+
+def convert_pairs_to_partners(i, j, N, rows=None, n_structures=None):
+    '''Partner array of N nucleotides from paired positions i, j (either order).
+
+    With `rows` (structure index of each pair), an n_structures x N array.
+    '''
+    i, j = np.asarray(i, dtype=np.int64), np.asarray(j, dtype=np.int64)
+    if rows is None:
+        partners = np.full(N, -1, dtype=np.int32)
+        partners[i], partners[j] = j, i
+        return partners
+
+    rows = np.asarray(rows, dtype=np.int64)
+    if n_structures is None:
+        n_structures = int(rows.max()) + 1 if len(rows) else 0
+    partners = np.full([n_structures, N], -1, dtype=np.int32)
+    partners[rows, i], partners[rows, j] = j, i
+    return partners
+
+def convert_partners_to_matrix(partners, symmetric=True, dtype=np.float64):
+    '''NxN (or MxNxN) base pair matrix of partner array(s): 1 at each pair, only i < j unless symmetric'''
+    partners = np.asarray(partners)
+    N = partners.shape[-1]
+    matrix = np.zeros(partners.shape + (N,), dtype=dtype)
+
+    pairs = convert_partners_to_pairs(partners)
+    if partners.ndim == 1:
+        i, j = pairs
+        matrix[i, j] = 1
+        if symmetric:
+            matrix[j, i] = 1
+    else:
+        rows, i, j = pairs
+        matrix[rows, i, j] = 1
+        if symmetric:
+            matrix[rows, j, i] = 1
+    return matrix
+
+def convert_matrix_to_partners(matrix):
+    '''Partner array(s) of an NxN (or MxNxN) base pair matrix, symmetric or upper triangular.
+    Nonzero entries are pairs; a nucleotide paired twice raises ValueError.'''
+    matrix = np.asarray(matrix)
+    N = matrix.shape[-1]
+    paired = (matrix != 0) | (np.swapaxes(matrix, -1, -2) != 0)
+    paired = paired & np.triu(np.ones([N, N], dtype=bool), 1)
+
+    if matrix.ndim == 2:
+        i, j = np.nonzero(paired)
+        rows = None
+        n_partners = np.bincount(np.concatenate([i, j]), minlength=N)
+    else:
+        rows, i, j = np.nonzero(paired)
+        n_partners = np.bincount(np.concatenate([rows*N + i, rows*N + j]), minlength=matrix.shape[0]*N)
+
+    if np.any(n_partners > 1):
+        raise ValueError('matrix pairs a nucleotide more than once')
+
+    return convert_pairs_to_partners(i, j, N, rows=rows, n_structures=None if rows is None else matrix.shape[0])
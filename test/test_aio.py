@@ -0,0 +1,65 @@
+'''aio.py: file-based packages run as asyncio subprocesses, against stub executables. A cancelled
+or timed out call kills its binary and removes the files the call wrote.'''
+import os, stat, asyncio
+import pytest
+import arnie.utils, arnie.pfunc
+from arnie.aio import apfunc, abpps
+
+SEQ = 'GGGAAACCC'
+
+@pytest.fixture
+def stubs(tmp_path, monkeypatch):
+    scratch, bin_dir = tmp_path / 'scratch', tmp_path / 'bin'
+    scratch.mkdir()
+    bin_dir.mkdir()
+    monkeypatch.setattr(arnie.utils, 'scratch_dir', lambda: str(scratch))
+    monkeypatch.setattr(arnie.pfunc, 'locate', lambda package: str(bin_dir))
+
+    def stub(name, script):
+        fname = bin_dir / name
+        fname.write_text('#!/bin/sh\n' + script)
+        os.chmod(str(fname), os.stat(str(fname)).st_mode | stat.S_IEXEC)
+    stub.scratch = scratch
+    stub.pidfile = tmp_path / 'pid'
+    return stub
+
+def killed(pidfile):
+    pid = int(pidfile.read_text())
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    return False
+
+def test_nupack_pfunc(stubs):
+    stubs('pfunc', 'echo "% nupack"\necho 1.0e+02\n')
+    assert asyncio.run(apfunc(SEQ, package='nupack')) == 100.0
+    assert not os.listdir(str(stubs.scratch))
+
+def test_timeout_kills(stubs):
+    # writes its output file, then never finishes
+    stubs('partition', 'echo $$ > %s\ntouch "$2"\nexec sleep 60\n' % stubs.pidfile)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(apfunc(SEQ, package='rnastructure', timeout=0.5))
+    assert killed(stubs.pidfile)
+    assert not os.listdir(str(stubs.scratch))
+
+def test_cancel_kills(stubs):
+    stubs('pairs', 'echo $$ > %s\ntouch "$1.ppairs"\nexec sleep 60\n' % stubs.pidfile)
+
+    async def cancel():
+        task = asyncio.ensure_future(abpps(SEQ, package='nupack'))
+        while not stubs.pidfile.exists():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert killed(stubs.pidfile)
+    assert not os.listdir(str(stubs.scratch))
+
+def test_failure(stubs):
+    stubs('simfold_pf', 'echo bad parameters >&2\nexit 1\n')
+    with pytest.raises(Exception, match='RNAsoft partition failed'):
+        asyncio.run(abpps(SEQ, package='rnasoft'))
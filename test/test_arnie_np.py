@@ -0,0 +1,123 @@
+'''package='arnie_np' against brute force: every structure of a short sequence, scored
+loop by loop with npfold.energy_of_structure.'''
+import asyncio
+from functools import lru_cache
+import numpy as np
+import pytest
+from arnie import npfold
+from arnie.pfunc import pfunc, pfunc_constraints, constraint_forces_noncanonical_
+from arnie.bpps import bpps
+from arnie.mfe import mfe
+from arnie.aio import amfe, apfunc, abpps
+
+SEQS = ['GGGAAACCCGGGAAACCCAA', 'GCGCAAAGCGCGCAAAGCGC', 'GGAGCAAAGCGCUAAAGCCUCC', 'UGUAUUACGAGGUUC']
+
+def all_structures(seq):
+    @lru_cache(None)
+    def inside(i, j):
+        if j < i:
+            return ['']
+        found = ['.' + s for s in inside(i+1, j)]
+        for k in range(i+npfold.MIN_HAIRPIN+1, j+1):
+            if (seq[i], seq[k]) in npfold.PAIR_TYPES:
+                found += ['(' + a + ')' + b for a in inside(i+1, k-1) for b in inside(k+1, j)]
+        return found
+    return inside(0, len(seq)-1)
+
+def pairs(structure):
+    stack, found = [], []
+    for k, c in enumerate(structure):
+        if c == '(':
+            stack.append(k)
+        elif c == ')':
+            found.append((stack.pop(), k))
+    return found
+
+def satisfies(structure, constraint):
+    if any(c == 'x' and s != '.' for s, c in zip(structure, constraint)):
+        return False
+    return set(pairs(constraint)) <= set(pairs(structure))
+
+def enumerate_ensemble(seq, constraint=None, T=37):
+    structures = [s for s in all_structures(seq) if constraint is None or satisfies(s, constraint)]
+    energies = np.array([npfold.energy_of_structure(seq, s, T=T) for s in structures])
+    weights = np.exp(-energies/npfold.kT(T))
+
+    probs = np.zeros([len(seq), len(seq)])
+    for s, w in zip(structures, weights):
+        for i, j in pairs(s):
+            probs[i, j] += w
+            probs[j, i] += w
+    return structures, energies, np.log(weights.sum()), probs/weights.sum()
+
+@pytest.mark.parametrize('seq', SEQS)
+@pytest.mark.parametrize('T', [37, 60])
+def test_matches_enumeration(seq, T):
+    structures, energies, logZ, probs = enumerate_ensemble(seq, T=T)
+    result = npfold.fold(seq, T=T)
+
+    np.testing.assert_allclose(result['logZ'], logZ, atol=1e-9)
+    np.testing.assert_allclose(result['bpps'], probs, atol=1e-10)
+
+    structure, energy = npfold.mfe(seq, T=T)
+    np.testing.assert_allclose(energy, energies.min(), atol=1e-9)
+    np.testing.assert_allclose(npfold.energy_of_structure(seq, structure), energies.min(), atol=1e-9)
+
+@pytest.mark.parametrize('constraint', ['((((...))))' + '.'*9, 'x.x.x.x.x.x.x.x.x.x.', '.......(.........)..'])
+def test_constraints_match_enumeration(constraint):
+    seq = SEQS[1]
+    structures, energies, logZ, probs = enumerate_ensemble(seq, constraint=constraint)
+    result = npfold.fold(seq, constraint=constraint)
+
+    np.testing.assert_allclose(result['logZ'], logZ, atol=1e-9)
+    np.testing.assert_allclose(result['bpps'], probs, atol=1e-10)
+
+    structure, energy = npfold.mfe(seq, constraint=constraint)
+    assert satisfies(structure, constraint)
+    np.testing.assert_allclose(energy, energies.min(), atol=1e-9)
+
+def test_impossible_constraint():
+    seq = 'AAAAAAAAAA'
+    assert np.isinf(npfold.fold(seq, constraint='(........)')['free_energy'])
+    assert not npfold.fold(seq, constraint='(........)')['bpps'].any()
+    with pytest.raises(ValueError):
+        npfold.mfe(seq, constraint='(........)')
+
+def test_package_entry_points():
+    seq = SEQS[0]
+    result = npfold.fold(seq)
+    assert np.isclose(pfunc(seq, package='arnie_np', return_free_energy=True), result['free_energy'])
+    assert np.isclose(np.log(pfunc(seq, package='arnie_np')), result['logZ'])
+    assert np.array_equal(bpps(seq, package='arnie_np'), result['bpps'])
+    assert np.array_equal(bpps(seq, package='arnie_np', sparse=True).toarray(), result['bpps'])
+    assert mfe(seq, package='arnie_np') == npfold.mfe(seq)[0]
+
+def test_async_entry_points():
+    seq = SEQS[0]
+    assert asyncio.run(amfe(seq, package='arnie_np')) == mfe(seq, package='arnie_np')
+    assert np.isclose(asyncio.run(apfunc(seq, package='arnie_np')), pfunc(seq, package='arnie_np'))
+    assert np.array_equal(asyncio.run(abpps(seq, package='arnie_np')), bpps(seq, package='arnie_np'))
+
+def test_sampling_matches_enumeration():
+    seq = SEQS[0]
+    structures, energies, logZ, probs = enumerate_ensemble(seq)
+    sampled, sampled_energies, sampled_probs = npfold.sample(seq, 4000, seed=0)
+
+    exact = dict(zip(structures, np.exp(-energies/npfold.kT() - logZ)))
+    frequencies = {s: sampled.count(s)/len(sampled) for s in set(sampled)}
+    assert max(abs(frequencies.get(s, 0) - p) for s, p in exact.items()) < 0.03
+    np.testing.assert_allclose(sampled_probs, [exact[s] for s in sampled])
+    assert npfold.sample(seq, 5, seed=1)[0] == npfold.sample(seq, 5, seed=1)[0]
+
+def test_pfunc_constraints():
+    seq = SEQS[1]
+    constraints = ['((((...))))' + '.'*9, None, 'x.x.x.x.x.x.x.x.x.x.', '(........)' + '.'*10, '((((...))))' + '.'*9]
+    energies, probabilities, reference = pfunc_constraints(seq, constraints, package='arnie_np')
+
+    assert np.isclose(reference, npfold.fold(seq)['free_energy'])
+    for constraint, energy, p in zip(constraints, energies, probabilities):
+        result = npfold.fold(seq, constraint=constraint)
+        assert energy == result['free_energy'] or np.isclose(energy, result['free_energy'])
+        assert np.isclose(p, np.exp(result['logZ'] - npfold.fold(seq)['logZ']))
+    assert np.isinf(energies[3]) and probabilities[3] == 0
+    assert constraint_forces_noncanonical_(seq, constraints[3]) and not constraint_forces_noncanonical_(seq, constraints[0])
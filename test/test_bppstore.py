@@ -0,0 +1,90 @@
+'''BPPStore in bppstore.py: round trips for both layouts and dtypes, zero-copy reads,
+reopening, batches, and the bpps(store=) hook, with arnie_np.'''
+import numpy as np
+import pytest
+from arnie.bpps import bpps
+from arnie.bppstore import BPPStore, fold_conditions
+from arnie.sparse import SparseBPPs
+
+SEQS = ['GGGGAAAACCCCAUAUGGGAAAUCCC', 'GGGAAAUCCCAAAGGGAAACCCAA', 'GGGCGCAAGCCU']
+
+@pytest.mark.parametrize('layout', ['triu', 'sparse'])
+@pytest.mark.parametrize('dtype', [np.float16, np.float32])
+@pytest.mark.parametrize('threshold', [0, 0.1])
+def test_round_trip(tmp_path, layout, dtype, threshold):
+    store = BPPStore(str(tmp_path / 'store'), layout=layout, dtype=dtype, threshold=threshold)
+    matrices = [bpps(seq, package='arnie_np') for seq in SEQS]
+    for k, (seq, m) in enumerate(zip(SEQS, matrices)):
+        store.put(seq, SparseBPPs.from_dense(m) if k == 1 else m, name='seq%d' % k)
+
+    tol = 1e-3 if dtype == np.float16 else 1e-6
+    reopened = BPPStore(str(tmp_path / 'store'))
+    assert reopened.layout == layout and reopened.dtype == dtype and len(reopened) == 3
+    for k, (seq, m) in enumerate(zip(SEQS, matrices)):
+        kept = np.where(m > threshold, m, 0) if layout == 'sparse' else m
+        assert np.allclose(reopened.get(seq), kept, atol=tol)
+        assert np.allclose(reopened.get('seq%d' % k, sparse=True).toarray(), kept, atol=tol)
+
+        # unpaired probabilities count the pairs below threshold too
+        unpaired = reopened.unpaired(seq)
+        assert isinstance(unpaired.base, np.memmap) and unpaired.dtype == dtype
+        assert np.allclose(unpaired, 1 - m.sum(axis=0), atol=tol)
+
+    names, values = zip(*[(n, v) for batch_names, batch in reopened.iter_batches(batch_size=2) for n, v in zip(batch_names, batch)])
+    assert list(names) == ['seq0', 'seq1', 'seq2']
+    assert np.allclose(values[2], np.where(matrices[2] > threshold, matrices[2], 0) if layout == 'sparse' else matrices[2], atol=tol)
+
+def test_overwrite_and_partial_index(tmp_path):
+    path = str(tmp_path / 'store')
+    store = BPPStore(path)
+    m = bpps(SEQS[0], package='arnie_np')
+    store.put(SEQS[0], np.zeros_like(m))
+    store.put(SEQS[0], m)
+    assert len(store) == 1 and np.allclose(store.get(SEQS[0]), m)
+    assert np.allclose(store.triu(SEQS[0]), m[np.triu_indices(len(m), k=1)])
+
+    with open(path + '/index.tsv', 'a') as f:
+        f.write('deadbeef\tx\t0') # a writer stopped mid-line
+    assert len(BPPStore(path)) == 1
+
+    with pytest.raises(KeyError):
+        store.get(SEQS[1])
+
+def test_bpps_hook(tmp_path):
+    store = BPPStore(str(tmp_path / 'store'), layout='sparse', threshold=0.01)
+    first = bpps(SEQS[0], package='arnie_np', sparse=True, threshold=0.5, store=store).toarray()
+    full = bpps(SEQS[0], package='arnie_np')
+    assert SEQS[0] in store
+    assert np.allclose(first, np.where(full > 0.5, full, 0))
+    assert np.allclose(store.unpaired(SEQS[0]), 1 - full.sum(axis=0))
+
+    first = bpps(SEQS[0], package='arnie_np', store=store)
+    assert np.allclose(first, np.where(full > 0.01, full, 0))
+    assert np.allclose(bpps(SEQS[0], package='arnie_np', store=store, sparse=True, threshold=0.5).toarray(),
+        np.where(first > 0.5, first, 0))
+
+    constraint = 'x'*len(SEQS[0])
+    assert np.allclose(bpps(SEQS[0], package='arnie_np', constraint=constraint, store=store), 0)
+    assert len(store) == 2
+
+def test_bpps_hook_returns_stored(tmp_path):
+    store = BPPStore(str(tmp_path / 'store'), layout='triu', dtype=np.float16)
+    miss = bpps(SEQS[1], package='arnie_np', store=store)
+    hit = bpps(SEQS[1], package='arnie_np', store=store)
+    # the miss hands back the float16 round trip, as the hit does
+    assert np.array_equal(miss, hit)
+    assert not np.array_equal(miss, bpps(SEQS[1], package='arnie_np'))
+
+def test_fold_conditions(tmp_path):
+    path = str(tmp_path / 'store')
+    store = BPPStore(path)
+    bpps(SEQS[0], package='arnie', store=store)
+    assert BPPStore(path).conditions['package'] == 'arnie_np'
+
+    with pytest.raises(ValueError, match='package arnie_np, not vienna_2'):
+        bpps(SEQS[0], package='vienna', store=store)
+    with pytest.raises(ValueError, match='T 37.0, not 24.0'):
+        bpps(SEQS[1], package='arnie_np', T=24, store=BPPStore(path))
+    with pytest.raises(ValueError):
+        store.put(SEQS[1], np.zeros([len(SEQS[1])]*2), conditions=fold_conditions('contrafold_2'))
+    assert len(store) == 1
@@ -0,0 +1,157 @@
+'''cache.py: key normalization, DiskCache, Memo, and the cached pfunc/bpps/mfe calls.'''
+import os
+import numpy as np
+import pytest
+import arnie.cache as cache
+import arnie.pfunc
+from arnie.cache import DiskCache, Memo, make_key, normalize_package
+from arnie.bpps import bpps
+from arnie.pfunc import pfunc
+from arnie.mfe import mfe
+
+SEQ = 'GGGGAAAACCCCAUAUGGGAAAUCCC'
+
+@pytest.fixture
+def caches(tmp_path):
+    cache.enable_memo()
+    cache.enable_disk_cache(str(tmp_path / 'cache'))
+    yield
+    cache.disable_memo()
+    cache.disable_disk_cache()
+
+def test_default_versions():
+    # a bare package name means the version its backend runs when none is given
+    assert normalize_package('vienna') == normalize_package('Vienna_2') == 'vienna_2'
+    assert normalize_package('rnasoft') == normalize_package('rnasoft_BLstar') == 'rnasoft_blstar'
+    assert normalize_package('rnasoft') != normalize_package('rnasoft_99')
+    assert normalize_package('nupack') == 'nupack_95'
+    assert normalize_package('rnastructure') == 'rnastructure'
+
+def test_key_normalization():
+    key = make_key('bpps', {'sequence': 'GGGAAACCC', 'package': 'vienna', 'T': 37})
+    assert key == make_key('bpps', {'sequence': ' gggaaaccc\n', 'package': 'vienna_2', 'T': 37})
+    assert key == make_key('bpps', {'sequence': 'GGGAAACCC', 'package': 'vienna_2', 'T': np.int64(37)})
+    assert key != make_key('bpps', {'sequence': 'GGGAAACCC', 'package': 'vienna_2', 'T': 24})
+    assert key != make_key('pfunc', {'sequence': 'GGGAAACCC', 'package': 'vienna_2', 'T': 37})
+    assert make_key('bpps', {'sequence': 'GGG', 'package': 'rnasoft'}) != make_key('bpps', {'sequence': 'GGG', 'package': 'rnasoft_99'})
+
+def test_key_param_file_contents(tmp_path):
+    a, b = str(tmp_path / 'a.par'), str(tmp_path / 'b.par')
+    for fname in [a, b]:
+        with open(fname, 'w') as f:
+            f.write('# params\n1 2 3\n')
+    key = lambda fname: make_key('bpps', {'sequence': 'GGGAAACCC', 'param_file': fname})
+    # same contents, same key; edited contents, new key
+    assert key(a) == key(b)
+    with open(b, 'w') as f:
+        f.write('# params\n1 2 4\n')
+    assert key(a) != key(b)
+    assert key(a) != key(None)
+
+def test_disk_round_trip(tmp_path):
+    disk = DiskCache(str(tmp_path))
+    matrix = np.random.RandomState(0).rand(6, 6)
+    symmetric = np.triu(matrix, k=1) + np.triu(matrix, k=1).T
+    values = {'a'*64: 1.5, 'b'*64: '((...))', 'c'*64: symmetric, 'd'*64: matrix}
+    for key, value in values.items():
+        disk.put(key, value)
+    for key, value in values.items():
+        assert np.array_equal(disk.get(key, 6), value)
+    assert isinstance(disk.get('b'*64, 6), str)
+    # a symmetric matrix is stored as its upper triangle
+    assert np.load(disk._fname('c'*64)).shape == (15,)
+    assert disk.get('e'*64, 6) is None
+
+    info = disk.info()
+    assert (info['hits'], info['misses'], info['writes'], info['entries']) == (5, 1, 4, 4)
+    assert not [f for _, _, files in os.walk(str(tmp_path)) for f in files if f.endswith('.tmp')]
+
+def test_disk_failed_write(tmp_path, monkeypatch):
+    disk = DiskCache(str(tmp_path))
+    def fail(src, dst):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        disk.put('a'*64, np.zeros(10))
+    # the temp file is removed and no entry appears
+    assert disk.get('a'*64, 10) is None
+    assert not [f for _, _, files in os.walk(str(tmp_path)) for f in files]
+
+def test_disk_eviction(tmp_path):
+    value = np.arange(400.).reshape(20, 20)
+    disk = DiskCache(str(tmp_path), max_size=10**6)
+    keys = ['%02d' % k + 'a'*62 for k in range(4)]
+    for k, key in enumerate(keys):
+        disk.put(key, value)
+        os.utime(disk._fname(key), (1000 + k, 1000 + k))
+    os.utime(disk._fname(keys[0]), (2000, 2000)) # most recently used
+
+    entry_size = os.path.getsize(disk._fname(keys[0]))
+    disk.max_size = int(3.5*entry_size)
+    disk.put('99' + 'a'*62, value)
+
+    # least recently used go first, down to 90% of max_size
+    assert [disk.get(key, 20) is not None for key in keys] == [True, False, False, True]
+    assert disk.info()['evictions'] == 2
+    assert disk.info()['size'] <= 0.9*disk.max_size
+
+    disk.clear()
+    assert disk.info()['entries'] == 0
+
+def test_memo():
+    memo = Memo(maxsize=2)
+    memo.put('a', np.zeros(3))
+    memo.put('b', 2.0)
+    memo.get('a')
+    memo.put('c', 3.0) # evicts b, the least recently used
+    assert memo.get('b') is None
+    assert memo.get('c') == 3.0
+
+    # callers get copies
+    memo.get('a')[0] = 1
+    assert not memo.get('a').any()
+    assert memo.info() == cache.CacheInfo(hits=4, misses=1, maxsize=2, currsize=2, nbytes=24 + 64)
+
+    memo = Memo(max_bytes=100)
+    memo.put('a', np.zeros(10))
+    memo.put('b', np.zeros(10)) # 160 bytes together
+    assert memo.get('a') is None and memo.get('b') is not None
+    memo.put('c', np.zeros(100)) # bigger than max_bytes, not kept
+    assert memo.get('c') is None
+
+def test_cached_calls(caches):
+    first = bpps(SEQ, package='arnie_np')
+    first[0, 0] = 5 # callers may modify what they get back
+    again = bpps(SEQ.lower(), package='arnie_np')
+    assert again[0, 0] == 0
+    assert cache.cache_info().hits == 1
+
+    # a new process only has the disk cache
+    cache.cache_clear()
+    assert np.array_equal(bpps(SEQ, package='arnie_np'), again)
+    assert cache.disk_cache_info()['hits'] == 1
+
+    # sparse results are not cached
+    bpps(SEQ, package='arnie_np', sparse=True)
+    assert cache.disk_cache_info()['writes'] == 1
+
+def test_vienna_together(caches, monkeypatch):
+    N = len(SEQ)
+    matrix = np.zeros([N, N])
+    matrix[0, N-1] = matrix[N-1, 0] = 0.75
+    calls = []
+    def ensemble(seq, bpps=True, **kwargs):
+        calls.append(bpps)
+        return {'free_energy': -5.0, 'structure': '('+'.'*(N-2)+')', 'bpps': matrix.copy() if bpps else None}
+    monkeypatch.setattr(arnie.pfunc, 'vienna_ensemble_', ensemble)
+
+    assert np.array_equal(bpps(SEQ, package='vienna'), matrix)
+    # the one run answers pfunc, free energy and mfe of the same conditions
+    assert pfunc(SEQ, package='vienna_2', return_free_energy=True) == -5.0
+    assert np.isclose(pfunc(SEQ, package='vienna'), np.exp(5.0/(.0019899*310)))
+    assert mfe(SEQ, package='vienna') == '('+'.'*(N-2)+')'
+    assert calls == [True]
+
+    # other conditions fold again
+    pfunc(SEQ, package='vienna', T=24)
+    assert calls == [True, True]
@@ -0,0 +1,52 @@
+'''Lazy aptamer constraint enumeration in utils.py against the meshgrid-and-prune version
+it replaced, plus caps, sampling and uneven fragment counts.'''
+import re
+import numpy as np
+import pytest
+from arnie.utils import write_combo_constraints, iter_combo_constraints, prune_combo_list, combo_list_to_dbn_list
+
+FRAGMENTS = ['GGA', 'CUU', 'AUG', 'UCA']
+STRUCTURES = ['(x(', 'x)x', '.(.', 'x).']
+
+# reference, as it was before iter_combo_placements (needs the same count of every fragment)
+
+def reference_combo_constraints(seq, raw_apt_seq, raw_apt_ss):
+    apt_seq_list, apt_ss_list = raw_apt_seq.split('+'), raw_apt_ss.split('+')
+    apt_idx_list = np.array([[idx, m.span()[0], m.span()[1], len(apt_seq)]
+        for idx, apt_seq in enumerate(apt_seq_list) for m in re.finditer(apt_seq, seq)])
+    N_frag = len(apt_ss_list)
+    temp = np.array([np.where(apt_idx_list[:,0] == idx)[0] for idx in range(N_frag)])
+    if len(temp) > 1:
+        combo_list = np.array(np.meshgrid(*temp)).T.reshape(-1,N_frag)
+    else:
+        combo_list = np.array([[x] for x in temp[0]])
+    final_combo_list = prune_combo_list(combo_list, apt_idx_list, N_frag)
+    return combo_list_to_dbn_list(seq, final_combo_list, apt_idx_list, apt_ss_list)
+
+def random_case(rng, copies):
+    F = len(copies)
+    parts = [FRAGMENTS[f] for f in range(F) for _ in range(copies[f])]
+    rng.shuffle(parts)
+    seq = ''.join(p + 'A'*rng.integers(0, 3) for p in parts)
+    return seq, '+'.join(FRAGMENTS[:F]), '+'.join(STRUCTURES[:F])
+
+@pytest.mark.parametrize('F', [1, 2, 3, 4])
+def test_matches_reference(F):
+    rng = np.random.default_rng(F)
+    for _ in range(50):
+        seq, raw_apt_seq, raw_apt_ss = random_case(rng, [rng.integers(1, 4)]*F)
+        assert write_combo_constraints(seq, raw_apt_seq, raw_apt_ss) == reference_combo_constraints(seq, raw_apt_seq, raw_apt_ss)
+
+def test_uneven_counts_cap_and_sample():
+    seq = ('GGAAA' + 'CUUAA' + 'AUGAA')*12 + 'GGA'
+    all_constraints = write_combo_constraints(seq, 'GGA+CUU+AUG', '(x(+x)x+.(.')
+    assert len(all_constraints) == len(set(all_constraints)) > 0
+
+    assert list(iter_combo_constraints(seq, 'GGA+CUU+AUG', '(x(+x)x+.(.', max_constraints=7)) == all_constraints[:7]
+    sample = write_combo_constraints(seq, 'GGA+CUU+AUG', '(x(+x)x+.(.', n_samples=10, seed=0)
+    assert len(sample) == 10 and set(sample) <= set(all_constraints)
+    assert sample == write_combo_constraints(seq, 'GGA+CUU+AUG', '(x(+x)x+.(.', n_samples=10, seed=0)
+
+def test_missing_fragment():
+    with pytest.raises(ValueError):
+        write_combo_constraints('GGAAAA', 'GGA+CUU', '(x(+x)x')
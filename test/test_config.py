@@ -0,0 +1,87 @@
+'''config.py: configure, reload, locate and the lazily read arnie file.'''
+import os, sys, subprocess
+import pytest
+import arnie.config as config
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(config, '_arnie_file', None)
+    monkeypatch.setattr(config, '_overrides', {})
+    config.reload()
+    yield
+    config.reload()
+
+def write_arnie_file(path, **entries):
+    with open(path, 'w') as f:
+        f.write('# package locations\n')
+        for key, value in entries.items():
+            f.write('%s: %s\n' % (key, value))
+    return str(path)
+
+def test_import_without_arnie_file():
+    env = {k: v for k, v in os.environ.items() if k != 'ARNIEFILE'}
+    code = '''
+import arnie.bpps, arnie.pfunc, arnie.mfe, arnie.sample_structures
+from arnie.config import package_locs
+try:
+    package_locs['TMP']
+except RuntimeError as e:
+    print(e)
+'''
+    p = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(config.__file__)))
+    assert p.returncode == 0, p.stderr
+    assert 'No arnie file' in p.stdout
+
+def test_parsed_once(fresh, tmp_path, monkeypatch):
+    fname = write_arnie_file(tmp_path / 'test.arnie', vienna_2=tmp_path, contrafold_2='None', TMP=tmp_path)
+    monkeypatch.setenv('ARNIEFILE', fname)
+    reads = []
+    read = config.read_arnie_file
+    monkeypatch.setattr(config, 'read_arnie_file', lambda fname: reads.append(fname) or read(fname))
+
+    assert reads == [] # nothing read until first looked at
+    assert config.package_locs['TMP'] == str(tmp_path)
+    assert sorted(config.package_locs) == ['TMP', 'contrafold_2', 'vienna_2']
+    assert len(config.package_locs) == 3
+    assert config.locate('vienna_2') == str(tmp_path)
+    assert reads == [fname]
+
+    config.reload()
+    config.locate('vienna_2')
+    assert reads == [fname, fname]
+
+def test_locate(fresh, tmp_path, monkeypatch):
+    os.makedirs(str(tmp_path / 'bin'))
+    fname = write_arnie_file(tmp_path / 'test.arnie', vienna_2='%s/bin/' % tmp_path, contrafold_2='None',
+        nupack_95=tmp_path / 'missing')
+    monkeypatch.setenv('ARNIEFILE', fname)
+
+    assert config.locate('vienna_2') == str(tmp_path / 'bin')
+    with pytest.raises(RuntimeError, match='contrafold_2 is not set'):
+        config.locate('contrafold_2')
+    with pytest.raises(RuntimeError, match='rnasoft is not set'):
+        config.locate('rnasoft')
+    with pytest.raises(RuntimeError, match='does not exist'):
+        config.locate('nupack_95')
+
+def test_configure(fresh, tmp_path, monkeypatch):
+    monkeypatch.delenv('ARNIEFILE', raising=False)
+    with pytest.raises(RuntimeError, match='No arnie file'):
+        config.locations()
+
+    # keyword locations alone make up a configuration
+    config.configure(vienna_2=tmp_path, TMP=tmp_path)
+    assert dict(config.package_locs) == {'vienna_2': str(tmp_path), 'TMP': str(tmp_path)}
+
+    # a file takes over, with the keyword locations still on top of it
+    other = tmp_path / 'other'
+    os.makedirs(str(other))
+    fname = write_arnie_file(tmp_path / 'test.arnie', vienna_2=other, contrafold_2=other)
+    config.configure(arnie_file=fname)
+    assert config.locate('vienna_2') == str(tmp_path)
+    assert config.locate('contrafold_2') == str(other)
+
+    # configure forgets paths already resolved
+    config.configure(vienna_2=other)
+    assert config.locate('vienna_2') == str(other)
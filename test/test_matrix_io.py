@@ -0,0 +1,35 @@
+'''write_matrix / load_matrix round trips in utils.py for every file type, layout and dtype.'''
+import numpy as np
+import pytest
+from arnie.utils import write_matrix, load_matrix
+from arnie.sparse import SparseBPPs
+
+def random_bpps(N=30, seed=0):
+    rng = np.random.default_rng(seed)
+    m = np.triu(rng.random([N, N]) * (rng.random([N, N]) < 0.1), 1)
+    return m + m.T
+
+@pytest.mark.parametrize('fname,layout', [('m.npy', 'dense'), ('m.npy', 'triu'), ('m.npz', 'dense'),
+    ('m.npz', 'triu'), ('m.npz', 'sparse'), ('m.bpps', 'dense')])
+@pytest.mark.parametrize('dtype', [None, np.float16, np.float32])
+def test_round_trip(tmp_path, fname, layout, dtype):
+    m = random_bpps()
+    write_matrix(m, str(tmp_path / fname), layout=layout, dtype=dtype)
+    loaded = load_matrix(str(tmp_path / fname))
+
+    assert loaded.shape == m.shape and loaded.dtype == np.float64
+    tol = 1e-3 if fname.endswith('.bpps') or dtype == np.float16 else 1e-7
+    assert np.allclose(loaded, m, atol=tol)
+
+    sparse = load_matrix(str(tmp_path / fname), sparse=True)
+    assert isinstance(sparse, SparseBPPs) and np.allclose(sparse.toarray(), loaded)
+
+def test_sparse_input_and_errors(tmp_path):
+    m = random_bpps()
+    write_matrix(SparseBPPs.from_dense(m), str(tmp_path / 's.npz'), layout='sparse', threshold=0.5)
+    assert np.array_equal(load_matrix(str(tmp_path / 's.npz')), np.where(m > 0.5, m, 0))
+
+    with pytest.raises(ValueError):
+        write_matrix(m, str(tmp_path / 's.npy'), layout='sparse')
+    with pytest.raises(ValueError):
+        write_matrix(m, str(tmp_path / 's.txt'), layout='triu')
@@ -0,0 +1,126 @@
+'''Golden tests: the vectorized MEA fill and iterative traceback against the cell-by-cell,
+recursive versions they replaced.'''
+import numpy as np
+import pytest
+from arnie.mea.mea import MEA
+from arnie.mea.mea_utils import score_ground_truth, score_ground_truth_batch, score_expected
+
+# reference MEA, as it was before the anti-diagonal fill
+
+def reference_fill(bpps, gamma, min_hp_length=3):
+    N = bpps.shape[0]
+    W, tb = np.zeros([N, N]), np.zeros([N, N])
+    for length in range(min_hp_length, N):
+        for i in range(N-length):
+            j = i + length
+            options = [W[i+1, j], W[i, j-1], (gamma+1)*bpps[i,j] + W[i+1, j-1] - 1,
+                np.max([W[i,k] + W[k+1, j] for k in range(i+1,j)])]
+            W[i,j] = np.max(options)
+            tb[i,j] = np.argmax(options)
+    return W, tb
+
+def reference_traceback(W, tb, i, j, bp_list):
+    if j <= i:
+        return
+    elif tb[i,j] == 0:
+        reference_traceback(W, tb, i+1, j, bp_list)
+    elif tb[i,j] == 1:
+        reference_traceback(W, tb, i, j-1, bp_list)
+    elif tb[i,j] == 2:
+        bp_list.append((i,j))
+        reference_traceback(W, tb, i+1, j-1, bp_list)
+    else:
+        for k in range(i+1,j):
+            if W[i,j] == W[i, k] + W[k+1,j]:
+                reference_traceback(W, tb, i, k, bp_list)
+                reference_traceback(W, tb, k+1, j, bp_list)
+                break
+
+def reference_counts(pred_matrix, true_matrix):
+    N = pred_matrix.shape[0]
+    true = true_matrix[np.triu_indices(N)]
+    pred = pred_matrix[np.triu_indices(N)]
+    a, b = np.triu_indices(N)
+    TP, FP, cFP, TN, FN = 0, 0, 0, 0, 0
+    for i in range(len(true)):
+        if true[i] == 1:
+            if pred[i] == 1:
+                TP += 1
+            else:
+                FN += 1
+        elif true[i] == 0:
+            if pred[i] == 0:
+                TN += 1
+            else:
+                FP += 1
+                if np.sum(true_matrix,axis=0)[a[i]]+ np.sum(true_matrix,axis=0)[b[i]]==0:
+                   cFP +=1
+    return TP, FP, cFP, TN, FN
+
+def random_structure_matrix(rng, N):
+    m = (rng.random([N, N]) < 0.05).astype(float)
+    m[rng.integers(N), rng.integers(N)] = 0.5 # neither paired nor unpaired
+    return m
+
+def random_bpps(seed, N=60):
+    rng = np.random.default_rng(seed)
+    probs = rng.random([N, N]) * (rng.random([N, N]) < 0.15)
+    if seed % 2:
+        probs = np.round(probs, 1) # plenty of ties
+    probs = np.triu(probs, 1)
+    return probs + probs.T
+
+@pytest.mark.parametrize('seed', range(6))
+@pytest.mark.parametrize('gamma', [0.25, 1.0, 8.0])
+def test_mea_matches_reference(seed, gamma):
+    probs = random_bpps(seed)
+    W, tb = reference_fill(probs, gamma)
+    bp_list = []
+    reference_traceback(W, tb, 0, len(probs)-1, bp_list)
+
+    mea = MEA(probs, gamma=gamma)
+    assert np.array_equal(mea.W, W)
+    assert np.array_equal(mea.tb, tb)
+    assert mea.MEA_bp_list == bp_list
+
+def test_long_sequence_traceback():
+    # deeper than python's default recursion limit
+    N = 1100
+    probs = np.zeros([N, N])
+    i = np.arange(N//2 - 2)
+    probs[i, N-1-i] = probs[N-1-i, i] = 0.9
+
+    mea = MEA(probs)
+    assert mea.structure == '('*len(i) + '.'*(N - 2*len(i)) + ')'*len(i)
+
+def test_for_gammas_matches_single_gamma():
+    probs = random_bpps(7)
+    gammas = [2.0**g for g in range(-7, 7)]
+    for gamma, mea in zip(gammas, MEA.for_gammas(probs, gammas)):
+        single = MEA(probs, gamma=gamma)
+        assert np.array_equal(mea.W, single.W)
+        assert mea.MEA_bp_list == single.MEA_bp_list
+        assert mea.structure == single.structure
+
+def test_score_ground_truth_counts():
+    rng = np.random.default_rng(0)
+    preds, trues = [], []
+    for N in [5, 20, 20, 37]:
+        pred, true = random_structure_matrix(rng, N), random_structure_matrix(rng, N)
+        TP, FP, cFP, TN, FN = reference_counts(pred, true)
+        sen, ppv, mcc, fscore, _ = score_ground_truth(pred, true)
+        assert sen == (1 if TP + FN == 0 else TP/(TP + FN))
+        assert ppv == (1 if TP + FP - cFP == 0 else TP/(TP + FP - cFP))
+        preds.append(pred)
+        trues.append(true)
+
+    batch = score_ground_truth_batch(preds, trues)
+    for k, (pred, true) in enumerate(zip(preds, trues)):
+        np.testing.assert_allclose([x[k] for x in batch], score_ground_truth(pred, true), rtol=1e-12)
+
+def test_score_expected_stack():
+    probs = random_bpps(8)
+    meas = MEA.for_gammas(probs, [0.5, 2.0, 8.0])
+    stacked = score_expected(np.stack([mea.MEA_bp_matrix for mea in meas]), probs)
+    for k, mea in enumerate(meas):
+        assert [x[k] for x in stacked] == list(mea.score_expected())
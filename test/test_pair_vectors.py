@@ -0,0 +1,28 @@
+'''Per-nucleotide vectors from pair lists (unpaired_probs, positional_entropy, expected_partner
+in bpps.py) against the same reductions of the dense matrix, with arnie_np.'''
+import numpy as np
+from arnie.bpps import bpps, unpaired_probs, positional_entropy, expected_partner
+
+SEQS = ['GGGGAAAACCCCAUAUGGGAAAUCCC', 'GGGAAAUCCCAAAGGGAAACCCAA', 'AAAAAAAA']
+
+def dense_vectors(seq):
+    m = bpps(seq, package='arnie_np')
+    q = 1 - m.sum(axis=0)
+    logm = np.log(np.where(m > 0, m, 1))
+    entropy = -np.sum(m*logm, axis=0) - q*np.log(np.where(q > 0, q, 1))
+    paired = m.sum(axis=1)
+    partner = np.where(paired > 0, (m*np.arange(len(seq))).sum(axis=1)/np.where(paired > 0, paired, 1), -1)
+    return q, entropy, partner
+
+def test_vectors_match_dense():
+    for seq in SEQS:
+        q, entropy, partner = dense_vectors(seq)
+        assert np.allclose(unpaired_probs(seq, package='arnie_np'), q)
+        assert np.allclose(positional_entropy(seq, package='arnie_np'), entropy)
+        assert np.allclose(expected_partner(seq, package='arnie_np'), partner)
+
+def test_batch():
+    vectors = positional_entropy(SEQS, package='arnie_np', n_jobs=2)
+    assert [len(v) for v in vectors] == [len(s) for s in SEQS]
+    assert np.allclose(vectors[1], dense_vectors(SEQS[1])[1])
+    assert np.allclose(unpaired_probs(SEQS[:1], package='arnie_np', constraints=['x'*len(SEQS[0])])[0], 1)
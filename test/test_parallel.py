@@ -0,0 +1,57 @@
+'''map_ordered in parallel.py.'''
+import os
+import numpy as np
+import pytest
+from arnie.parallel import map_ordered, SHARED_MEMORY_MIN_BYTES
+
+def shared_blocks():
+    return set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+def exit_on_two(x):
+    if x == 2:
+        os._exit(1)
+    return np.full(SHARED_MEMORY_MIN_BYTES//8, x, dtype=np.float64)
+
+def test_worker_dies():
+    before = shared_blocks()
+    results = map_ordered(exit_on_two, [0, 1, 2, 3, 4], n_jobs=2)
+    assert len(results) == 5
+    assert isinstance(results[2], Exception)
+    for x, result in enumerate(results):
+        assert isinstance(result, Exception) or np.all(result == x)
+    # blocks of results lost with the pool are unlinked
+    assert shared_blocks() == before
+
+def square(x, offset=0):
+    if x < 0:
+        raise ValueError('negative %d' % x)
+    return x*x + offset
+
+def big(x):
+    return np.full([x, SHARED_MEMORY_MIN_BYTES//(8*x) + 1], x, dtype=np.float64)
+
+@pytest.mark.parametrize('backend', ['process', 'thread'])
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_order_and_errors(backend, n_jobs):
+    items = [3, -1, 0, 5, -2, 1, 4]
+    results = map_ordered(square, items, n_jobs=n_jobs, backend=backend, offset=1)
+    for x, result in zip(items, results):
+        if x < 0:
+            assert isinstance(result, ValueError) and str(result) == 'negative %d' % x
+        else:
+            assert result == x*x + 1
+
+def test_raise_errors():
+    with pytest.raises(ValueError, match='negative -1'):
+        map_ordered(square, [1, -1, 2], n_jobs=2, raise_errors=True)
+    assert map_ordered(square, [1, 2, 3], n_jobs=2, raise_errors=True, chunksize=2) == [1, 4, 9]
+    with pytest.raises(ValueError):
+        map_ordered(square, [1, 2], backend='mpi')
+
+def test_shared_memory():
+    before = shared_blocks()
+    results = map_ordered(big, [1, 2, 3], n_jobs=2)
+    for x, result in zip([1, 2, 3], results):
+        assert result.nbytes >= SHARED_MEMORY_MIN_BYTES
+        assert result.shape == big(x).shape and np.all(result == x)
+    assert shared_blocks() == before
@@ -0,0 +1,158 @@
+'''Golden tests: the bulk parsers in parsers.py against the line-by-line parsing they replaced.'''
+import numpy as np
+import pytest
+from arnie.parsers import *
+from arnie.sparse import triples_to_bpps
+
+N = 60
+
+def random_pairs(seed, n_pairs=80):
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, N-1, n_pairs)
+    j = np.minimum(i + rng.integers(1, N, n_pairs), N-1)
+    keep = j > i
+    return i[keep]+1, j[keep]+1, rng.random(keep.sum())
+
+# reference parsers, as they were before parsers.py
+
+def reference_vienna(fname):
+    probs=np.zeros([N, N])
+    with open(fname,'r') as f:
+        for line in f.readlines():
+            if 'ubox' in line:
+                try:
+                    i, j, p, _ = line.split()
+                    i, j, p = int(i)-1, int(j)-1, float(p)**2
+                    probs[i,j] = p
+                    probs[j,i] = p
+                except:
+                    pass
+    return probs
+
+def reference_contrafold(fname):
+    probs=np.zeros([N, N])
+    for line in open(fname).readlines():
+        if len(line.split(':')) > 1:
+            first_ind = int(line.split()[0])-1
+            for x in line.split()[2:]:
+                second_ind = int(x.split(':')[0])-1
+                p = float(x.split(':')[1])
+                probs[first_ind, second_ind] = p
+                probs[second_ind, first_ind] = p
+    return probs
+
+def reference_nupack(fname):
+    probs=np.zeros([N, N])
+    with open(fname, 'r') as f:
+        for line in f.readlines():
+            if not line.startswith('%'):
+                fields = line.split()
+                if len(fields) > 1:
+                    if int(fields[1]) <= N:
+                        i, j, p = int(fields[0])-1, int(fields[1])-1, float(fields[2])
+                        probs[i,j] = p
+                        probs[j,i] = p
+    return probs
+
+def reference_rnastructure(fname):
+    probs=np.zeros([N, N])
+    with open(fname, 'r') as f:
+        for line in f.readlines()[2:]:
+            fields = line.split()
+            i, j, p = int(fields[0])-1, int(fields[1])-1, 10**(-1*float(fields[2]))
+            probs[i,j] = p
+            probs[j,i] = p
+    return probs
+
+def reference_vfold(fname):
+    probs = np.zeros([N, N])
+    for i,j,p in np.loadtxt(fname,usecols=(0,2,3)):
+        probs[int(i-1),int(j-1)] = p
+        probs[int(j-1),int(i-1)] = p
+    return probs
+
+def reference_rnasoft(lines):
+    probs=np.zeros([N, N])
+    for line in lines:
+        i,j,p = int(line.split()[0]), int(line.split()[1]), float(line.split()[2])
+        probs[i,j] = p
+        probs[j,i] = p
+    return probs
+
+# writers for each package's output format
+
+def write_vienna(fname, i, j, p):
+    with open(fname, 'w') as f:
+        f.write('%!PS-Adobe-3.0 EPSF-3.0\n%% i  j  sqrt(p(i,j)) ubox\n/ubox {\n   logscale {\n} def\n')
+        f.write('%start of base pair probability data\n')
+        for a, b, c in zip(i, j, p):
+            f.write('%d %d %.7f ubox\n' % (a, b, np.sqrt(c)))
+        f.write('1 %d 0.95 lbox\nshowpage\nend\n%%%%EOF\n' % N)
+
+def write_contrafold(fname, i, j, p):
+    with open(fname, 'w') as f:
+        for a in range(1, N+1):
+            pairs = ['%d:%g' % (b, c) for x, b, c in zip(i, j, p) if x == a]
+            f.write(' '.join(['%d' % a, 'GACU'[a % 4]] + pairs) + '\n')
+
+def write_nupack(fname, i, j, p):
+    with open(fname, 'w') as f:
+        f.write('%% NUPACK 3.0\n%% Program: pairs\n%%\n%d\n' % N)
+        for a, b, c in zip(i, j, p):
+            f.write('%d\t%d\t%.4e\n' % (a, b, c))
+        for a in range(1, N+1):
+            f.write('%d\t%d\t%.4e\n' % (a, N+1, 0.5))
+
+def write_rnastructure(fname, i, j, p):
+    with open(fname, 'w') as f:
+        f.write('%d\ni\tj\t-log10(Probability)\n' % N)
+        for a, b, c in zip(i, j, p):
+            f.write('%d\t%d\t%.6f\n' % (a, b, -np.log10(c)))
+
+def write_vfold(fname, i, j, p):
+    with open(fname, 'w') as f:
+        for a, b, c in zip(i, j, p):
+            f.write('%d G %d %.6f\n' % (a, b, c))
+
+def assert_same_bpps(result, expected):
+    # vectorized p**2 and 10**x can be one ulp off the scalar libm pow the old parsers used
+    assert np.array_equal(result != 0, expected != 0)
+    np.testing.assert_allclose(result, expected, rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('writer, reference, parser', [
+    (write_vienna, reference_vienna, parse_vienna_dot_plot),
+    (write_contrafold, reference_contrafold, parse_contrafold_posteriors),
+    (write_nupack, reference_nupack, lambda fname: parse_nupack_ppairs(fname, N)),
+    (write_rnastructure, reference_rnastructure, parse_rnastructure_probs),
+    (write_vfold, reference_vfold, parse_vfold_pij),
+])
+def test_parser_matches_reference(tmp_path, seed, writer, reference, parser):
+    fname = str(tmp_path / 'output')
+    writer(fname, *random_pairs(seed))
+
+    expected = reference(fname)
+    assert_same_bpps(triples_to_bpps(*parser(fname), N), expected)
+    assert_same_bpps(triples_to_bpps(*parser(fname), N, sparse=True).toarray(), expected)
+
+def test_rnasoft_matches_reference():
+    i, j, p = random_pairs(3)
+    lines = ['%d %d %.6f' % (a-1, b-1, c) for a, b, c in zip(i, j, p)]
+    assert_same_bpps(triples_to_bpps(*parse_rnasoft_pairs('\n'.join(lines)), N), reference_rnasoft(lines))
+
+def test_empty_outputs(tmp_path):
+    fname = str(tmp_path / 'output')
+    write_vienna(fname, [], [], [])
+    assert len(parse_vienna_dot_plot(fname)[0]) == 0
+    write_contrafold(fname, [], [], [])
+    assert len(parse_contrafold_posteriors(fname)[0]) == 0
+
+def test_vienna_unexpected_layout(tmp_path):
+    # a PostScript command between the pair lines and showpage sends the parser down its regex path
+    fname = str(tmp_path / 'output')
+    write_vienna(fname, *random_pairs(4))
+    with open(fname) as f:
+        text = f.read().replace('showpage', 'drawgrid\nshowpage')
+    with open(fname, 'w') as f:
+        f.write(text)
+    assert_same_bpps(triples_to_bpps(*parse_vienna_dot_plot(fname), N), reference_vienna(fname))
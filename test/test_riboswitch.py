@@ -0,0 +1,36 @@
+'''Riboswitch screening in riboswitch.py against the per-design notebook computation,
+with arnie_np so it needs no external packages.'''
+import numpy as np
+import pytest
+from arnie.pfunc import pfunc
+from arnie.riboswitch import riboswitch_constraints, screen_riboswitches, ensemble_states
+
+SEQ = 'GGAAAGAGGAUAUGAGGAUACCUAAGAAGGCACAUGAGGAUCACCCAUGUAAAGAAACAACAACAACAAC'
+
+def notebook_kd(seq, concentration, intrinsic_kd):
+    Z = pfunc(seq, package='arnie_np')
+    Z_MS2, Z_lig, Z_MS2_lig = [pfunc(seq, package='arnie_np', constraint=c) for c in riboswitch_constraints(seq, 'FMN')]
+    bonus = concentration/intrinsic_kd
+    return np.log(Z/Z_MS2), np.log((Z + bonus*Z_lig)/(Z_MS2 + bonus*Z_MS2_lig))
+
+def test_screen_matches_notebook():
+    designs = {'sequence': [SEQ, SEQ, 'GGGGAAAACCCC'], 'ligand': ['FMN']*3, 'switch': ['ON', 'OFF', 'ON']}
+    df, curves = screen_riboswitches(designs, package='arnie_np', concentrations=[0, 200e-6])
+
+    no_lig, with_lig = notebook_kd(SEQ, 200e-6, 2.2e-6)
+    assert np.allclose(df['kd_est_no_lig'][:2], no_lig)
+    assert np.allclose(df['kd_est_with_lig'][:2], with_lig)
+    assert np.allclose(df['pred_log_AR'][:2], [no_lig - with_lig, with_lig - no_lig])
+    assert np.allclose(curves[:2], [[no_lig, with_lig]]*2)
+
+    # no aptamers in the last design
+    assert np.all(np.isnan(curves[2])) and np.isnan(df['pred_log_AR'][2])
+
+def test_resume(tmp_path):
+    out_file = str(tmp_path / 'states.csv')
+    first = ensemble_states({'sequence': [SEQ], 'ligand': ['FMN']}, package='arnie_np', out_file=out_file)
+    both = ensemble_states({'sequence': [SEQ, SEQ[:-3]], 'ligand': ['FMN']*2}, package='arnie_np', out_file=out_file)
+
+    assert len(open(out_file).read().splitlines()) == 3 # header and one line per design
+    assert list(both['sequence']) == [SEQ, SEQ[:-3]]
+    assert np.allclose(both.iloc[0, 2:].values.astype(float), first.iloc[0, 2:].values.astype(float))
@@ -1,15 +1,89 @@
-import sample_structures
+'''sample_structures.py: sampling with vienna_2, parsing of RNAsubopt --stochBT_en output on
+canned output, and seeded sampling split over several jobs.'''
+import tempfile
+import numpy as np
+import pytest
+import arnie.sample_structures as sample_module
+from arnie.sample_structures import sample_structures, sample_shards_, parse_sample_lines_, sample_vienna_result_, _count_samples_, \
+    _check_sample_stderr_, _read_stderr_
+from arnie.structures import convert_dotbracket_to_partners, convert_packed_to_dotbracket
 
 sample_seq = 'GGGGAAAACCCC'
 
 def test_sample_seq():
-	
-	struct_list, ener_list, prob_list = sample_structures.sample_structures(sample_seq, n_samples=10, package='vienna_2')
-	print(struct_list)
-	print(ener_list)
-	print(prob_list)
-	return
+    struct_list, ener_list, prob_list = sample_structures(sample_seq, n_samples=10, package='vienna_2', return_energies=True)
+    print(struct_list)
+    print(ener_list)
+    print(prob_list)
+    return
+
+STDOUT = b'''GGGGAAAACCCC
+((((....)))) -4.50 0.6331
+.(((....))). -2.10 0.0132
+((((....)))) -4.50 0.6331
+............   0.00 0.000412
+'''
+
+def test_parse_formats():
+    lines = STDOUT.split(b'\n')[1:-1]
+    structures, energies, probabilities = parse_sample_lines_(lines, 12)
+    assert structures[1] == 'x(((xxxx)))x'
+    assert np.array_equal(energies, [-4.5, -2.1, -4.5, 0])
+    assert np.allclose(probabilities, [0.6331, 0.0132, 0.6331, 0.000412])
+
+    partners = parse_sample_lines_(lines, 12, 'partners')[0]
+    assert np.array_equal(partners, convert_dotbracket_to_partners([l.split()[0].decode() for l in lines]))
+    packed = parse_sample_lines_(lines, 12, 'packed')[0]
+    assert convert_packed_to_dotbracket(packed, 12, 'x') == structures
+
+    assert sample_vienna_result_(STDOUT, b'') == structures
+
+def test_counts():
+    lines = STDOUT.split(b'\n')[1:-1]
+    for structure_format in ['dotbracket', 'packed']:
+        structures, energies, probabilities = parse_sample_lines_(lines, 12, structure_format)
+        unique, energies, probabilities, counts = _count_samples_(structures, energies, probabilities)
+        assert len(unique) == 3
+        assert np.array_equal(counts, [2, 1, 1])
+        assert np.array_equal(energies, [-4.5, -2.1, 0])
+
+def test_seeded_shards():
+    seq = 'GGGAAACCCGGGAAACCCAA'
+    a = sample_structures(seq, 11, package='arnie_np', seed=7, n_jobs=3, structure_format='packed')
+    b = sample_structures(seq, 11, package='arnie_np', seed=7, n_jobs=3, structure_format='packed')
+    assert a.shape == (11, 5) and np.array_equal(a, b)
+    shards = sample_shards_(seq, n_samples=11, pkg='arnie', seed=7, n_jobs=3)
+    assert [len(s[0]) for s in shards] == [4, 4, 3]
+
+def test_cli_seed_warns(monkeypatch):
+    monkeypatch.setattr(sample_module, 'RNA', None)
+    monkeypatch.setattr(sample_module, 'map_ordered', lambda *args, **kwargs: [])
+    with pytest.warns(UserWarning):
+        sample_shards_('GGGAAACCC', n_samples=4, seed=1, n_jobs=2)
+
+def test_bindings_impossible_constraint():
+    if sample_module.RNA is None:
+        pytest.skip('needs the ViennaRNA python bindings')
+    # a hairpin too small to close, and a non-canonical forced pair
+    for constraint in ['()........', '(........)']:
+        with pytest.raises(RuntimeError):
+            sample_module.sample_shard_((3, 1), 'GCAAAAAAAA', sampler='bindings', constraint=constraint)
+    structures, _, probabilities = sample_module.sample_shard_((3, 1), 'GGGAAACCCC', sampler='bindings', constraint='((......))')
+    assert all(s.startswith('((') for s in structures) and np.all(np.isfinite(probabilities))
+
+def test_stderr_check_keeps_write_position():
+    # RNAsubopt shares the file offset and may be anywhere in its writes when we check
+    with tempfile.TemporaryFile() as err:
+        err.write(b'WARNING: structure constraint omitting constraint\n')
+        err.flush()
+        err.seek(9)
+        with pytest.raises(RuntimeError):
+            _check_sample_stderr_(err)
+        assert err.tell() == 9
+        assert _read_stderr_(err) == b'WARNING: structure constraint omitting constraint\n'
+
+    with tempfile.TemporaryFile() as err:
+        _check_sample_stderr_(err) # nothing written yet
 
 if __name__=='__main__':
-	test_sample_seq()
-		#test_pkg_w_bpps(pkg.lower())
+    test_sample_seq()
@@ -0,0 +1,51 @@
+'''Sample-based base pair probabilities in sampled_bpps.py: counting on known structures,
+and estimates from arnie_np samples against its exact probabilities.'''
+import numpy as np
+import pytest
+from arnie.sampled_bpps import SampledBPPs, sampled_bpps
+from arnie.structures import convert_dotbracket_to_partners
+from arnie import npfold
+
+def test_counts():
+    structures = ['((...))..', '((...))..', '.(...)...', '.........']
+    estimate = SampledBPPs(9).add(structures[:2]).add(convert_dotbracket_to_partners(structures[2:]))
+    assert estimate.n == 4
+    expected = np.zeros([9, 9])
+    expected[0, 6] = expected[1, 5] = 0.5
+    expected[1, 5] += 0.25
+    expected = expected + expected.T
+    assert np.allclose(estimate.bpps(), expected)
+    assert np.allclose(estimate.bpps(sparse=True).toarray(), expected)
+    assert np.allclose(estimate.unpaired(), 1 - expected.sum(axis=0))
+    assert estimate.centroid() == '.(...)...'
+
+    i, j, lower, upper = estimate.confidence_interval()
+    assert np.all(lower <= estimate.bpps()[i, j]) and np.all(estimate.bpps()[i, j] <= upper)
+
+def test_estimate_against_exact():
+    seq = 'GGAGCAAAGCGCUAAAGCCUCC'
+    exact = npfold.fold(seq)['bpps']
+    estimate = sampled_bpps(seq, 20000, package='arnie_np', seed=0, chunk_size=5000, tol=0.02)
+    assert estimate.n < 20000 and estimate.max_half_width() <= 0.02
+    assert np.abs(estimate.bpps() - exact).max() < 0.02
+    i, j, lower, upper = estimate.confidence_interval()
+    assert np.mean((exact[i, j] >= lower) & (exact[i, j] <= upper)) > 0.8
+
+def test_one_partition_function(monkeypatch):
+    seq = 'GGAGCAAAGCGCUAAAGCCUCC'
+    calls = []
+    inside = npfold._inside
+    monkeypatch.setattr(npfold, '_inside', lambda *args: calls.append(1) or inside(*args))
+    estimate = sampled_bpps(seq, 1000, package='arnie_np', seed=1, chunk_size=100)
+    assert estimate.n == 1000 and len(calls) == 1
+
+    # chunks come from one random stream, so chunk_size doesn't change the samples
+    again = sampled_bpps(seq, 1000, package='arnie_np', seed=1, chunk_size=300)
+    assert np.array_equal(estimate.bpps(), again.bpps())
+
+def test_bindings_chunks():
+    pytest.importorskip('RNA')
+    seq = 'GGAGCAAAGCGCUAAAGCCUCC'
+    estimate = sampled_bpps(seq, 2000, package='vienna_2', seed=2, chunk_size=200)
+    again = sampled_bpps(seq, 2000, package='vienna_2', seed=2, chunk_size=700)
+    assert estimate.n == 2000 and np.array_equal(estimate.bpps(), again.bpps())
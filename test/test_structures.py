@@ -0,0 +1,82 @@
+'''Structure conversions in structures.py: against the bracket matching they replaced, and
+round trips between dot-bracket strings, partner arrays, pair lists and matrices.'''
+import numpy as np
+import pytest
+from arnie.structures import *
+from arnie.utils import convert_dotbracket_to_bp_list
+from arnie.mea.mea_utils import convert_dotbracket_to_matrix, convert_matrix_to_dotbracket
+
+# reference parser, as it was before structures.py
+
+def reference_bp_list(s, allow_pseudoknots=False):
+    m = {}
+    for opener, closer in ['()', '[]'] if allow_pseudoknots else ['()']:
+        bp1 = [i for i, char in enumerate(s) if char == opener]
+        bp2 = [i for i, char in enumerate(s) if char == closer]
+        for i in list(reversed(bp1)):
+            for j in bp2:
+                if j > i:
+                    m[i]=j
+                    m[j]=i
+                    bp2.remove(j)
+                    break
+    return m
+
+def random_partners(rng, N, n_pairs):
+    # random pairs, pseudoknots and all
+    order = rng.permutation(N)[:2*n_pairs]
+    return convert_pairs_to_partners(order[0::2], order[1::2], N)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_reference_parser(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(300):
+        s = ''.join(rng.choice(list('..(()))[]x<>{}'), rng.integers(1, 30))) # unbalanced too
+        for allow_pseudoknots in [False, True]:
+            assert convert_dotbracket_to_bp_list(s, allow_pseudoknots) == reference_bp_list(s, allow_pseudoknots)
+
+def test_batch_matches_single():
+    rng = np.random.default_rng(3)
+    structures = [''.join(rng.choice(list('..(()[]{}<>AaBb'), 40)) for _ in range(200)]
+    partners = convert_dotbracket_to_partners(structures)
+    for s, p in zip(structures, partners):
+        assert np.array_equal(p, convert_dotbracket_to_partners(s))
+
+def test_round_trips():
+    rng = np.random.default_rng(4)
+    N = 50
+    partners = np.array([random_partners(rng, N, rng.integers(0, 20)) for _ in range(100)])
+
+    structures = convert_partners_to_dotbracket(partners)
+    assert structures[:5] == [convert_partners_to_dotbracket(p) for p in partners[:5]]
+    assert np.array_equal(convert_dotbracket_to_partners(structures), partners)
+
+    matrices = convert_partners_to_matrix(partners)
+    assert np.array_equal(convert_matrix_to_partners(matrices), partners)
+    assert convert_matrix_to_dotbracket(matrices[0]) == structures[0]
+
+    rows, i, j = convert_partners_to_pairs(partners)
+    assert np.all(i < j)
+    assert np.array_equal(convert_pairs_to_partners(i, j, N, rows=rows, n_structures=len(partners)), partners)
+
+def test_pseudoknot_brackets():
+    s = '((..[[..))..]]..{{..}}..<<..AA..>>..aa'
+    assert convert_partners_to_dotbracket(convert_dotbracket_to_partners(s)) == '((..[[..))..]]..((..))..((..[[..))..]]'
+    assert np.array_equal(convert_dotbracket_to_matrix('((..[[..))..]]'), np.triu(convert_partners_to_matrix(convert_dotbracket_to_partners('((..[[..))..]]'))))
+
+def test_matrix_with_shared_nucleotide():
+    matrix = np.zeros([6, 6])
+    matrix[0, 4] = matrix[0, 5] = 1
+    with pytest.raises(ValueError):
+        convert_matrix_to_partners(matrix)
+
+def test_packed_round_trip():
+    rng = np.random.default_rng(5)
+    for N in [1, 4, 37]:
+        structures = [''.join(rng.choice(list('.x'), N)) for _ in range(3)] + ['(' * (N//2) + '.' * (N % 2) + ')' * (N//2)]
+        packed = convert_dotbracket_to_packed(structures)
+        assert packed.shape == (4, (N+3)//4)
+        assert convert_packed_to_dotbracket(packed, N) == [s.replace('x', '.') for s in structures]
+        assert convert_packed_to_dotbracket(packed[3], N) == structures[3]
+    with pytest.raises(ValueError):
+        convert_dotbracket_to_packed('((..[[..))..]]')
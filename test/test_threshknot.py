@@ -0,0 +1,90 @@
+'''ThreshKnot engine against the dense ProbKnot heuristic it replaced, on stacks, sparse
+inputs and the iterative variant.'''
+import numpy as np
+import pytest
+from arnie.sparse import SparseBPPs
+from arnie.mea.mea import MEA
+from arnie.mea.threshknot import threshknot, threshknot_partners, threshknot_sparse_
+from arnie.structures import convert_dotbracket_to_partners
+
+def reference_threshknot(bp_matrix, theta):
+    bp_matrix = bp_matrix.copy()
+    bp_matrix[np.where(bp_matrix <= theta)] = 0
+    output = np.zeros(bp_matrix.shape)
+    output[np.where(bp_matrix == np.max(bp_matrix,axis=0))] = 1
+    array_of_bps = np.clip(output+np.transpose(output)-1,0,1)
+    bp_matrix[np.where(array_of_bps == 0)] = 0
+    return bp_matrix
+
+def random_bpps(N, seed):
+    rng = np.random.default_rng(seed)
+    probs = np.triu(rng.random([N, N])**8, 4)
+    probs = probs + probs.T
+    return probs/max(1, probs.sum(axis=0).max())
+
+def partners_of_matrix(matrix):
+    partners = np.full(matrix.shape[0], -1, dtype=np.int32)
+    i, j = np.nonzero(matrix)
+    partners[i] = j
+    return partners
+
+@pytest.mark.parametrize('theta', [0, 0.05, 0.2])
+def test_matches_reference(theta):
+    for seed in range(5):
+        probs = random_bpps(60, seed)
+        expected = partners_of_matrix(reference_threshknot(probs, theta))
+        assert np.array_equal(threshknot_partners(probs, theta=theta), expected)
+        assert np.array_equal(threshknot_partners(SparseBPPs.from_dense(probs), theta=theta), expected)
+        assert np.array_equal(threshknot_partners(np.triu(probs), theta=theta), expected)
+
+def test_stack_and_list():
+    probs = np.stack([random_bpps(40, seed) for seed in range(6)])
+    partners, structures = threshknot(probs, theta=0.01)
+    assert partners.shape == (6, 40)
+    for r in range(6):
+        assert np.array_equal(partners[r], threshknot_partners(probs[r], theta=0.01))
+        assert np.array_equal(convert_dotbracket_to_partners(structures[r]), partners[r])
+
+    mixed = [random_bpps(30, 0), SparseBPPs.from_dense(random_bpps(50, 1))]
+    partners, structures = threshknot(mixed, theta=0.01)
+    assert [len(x) for x in partners] == [30, 50]
+    assert np.array_equal(partners[1], threshknot_partners(random_bpps(50, 1), theta=0.01))
+
+def test_pseudoknot_brackets():
+    probs = np.zeros([12, 12])
+    for i, j, p in [(0, 6, 0.9), (1, 5, 0.8), (3, 10, 0.7), (4, 9, 0.6)]:
+        probs[i, j] = probs[j, i] = p
+    partners, structure = threshknot(probs)
+    assert structure == '((.[[))..]].'
+    assert np.array_equal(convert_dotbracket_to_partners(structure), partners)
+
+def test_iterative():
+    # 1 pairs best with 0, which pairs best with 8: only the second round pairs 1 and 6
+    probs = np.zeros([10, 10])
+    for i, j, p in [(0, 8, 0.6), (1, 8, 0.4), (1, 6, 0.3)]:
+        probs[i, j] = probs[j, i] = p
+    assert threshknot(probs)[1] == '(.......).'
+    assert threshknot(probs, iterative=True)[1] == '((....).).'
+    assert threshknot_partners(probs, theta=0.35, iterative=True)[1] == -1
+
+def test_ties_give_one_partner():
+    probs = np.zeros([10, 10])
+    for i, j in [(0, 5), (0, 9), (4, 9)]:
+        probs[i, j] = probs[j, i] = 0.5
+    partners = threshknot_partners(probs)
+    assert partners[0] == 5 and partners[9] == 4
+    assert np.array_equal(partners[partners[[0, 5]]], [0, 5])
+
+def test_probknot_honors_theta():
+    probs = random_bpps(60, 3)
+    for theta in [0, 0.1]:
+        mea = MEA(probs, run_probknot_heuristic=True, theta=theta)
+        expected = reference_threshknot(probs, theta)
+        i, j = np.nonzero(np.triu(expected))
+        assert mea.MEA_bp_list == [[a, b] for a, b in zip(i.tolist(), j.tolist())]
+        assert np.array_equal(convert_dotbracket_to_partners(mea.structure), partners_of_matrix(expected))
+
+def test_sparse_util_matches_dense():
+    probs = random_bpps(50, 4)
+    sparse = threshknot_sparse_(SparseBPPs.from_dense(probs), theta=0.02)
+    assert np.array_equal(sparse.toarray(), reference_threshknot(probs, 0.02))
@@ -0,0 +1,170 @@
+'''Multi-record RNAfold runs (pfunc_batch, mfe_batch, bpps_batch), their command lines and
+output parsing, and the persistent RNAfold workers in pool.py. Tests that run RNAfold skip
+when vienna_2 isn't configured; the worker framing tests run against stub executables.'''
+import os, stat
+import numpy as np
+import pytest
+import arnie.pfunc, arnie.mfe, arnie.pool as pool
+from arnie.utils import scratch_dir, split_vienna_records, parse_vienna_ensemble_energy, vienna_records_input
+from arnie.pfunc import pfunc, pfunc_batch, pfunc_vienna_command_
+from arnie.mfe import mfe, mfe_batch, mfe_vienna_command_
+from arnie.bpps import bpps, bpps_batch
+from arnie.config import locate
+
+SEQS = ['GGGGAAAACCCCAUAUGGGAAAUCCC', 'GGGAAAUCCCAAAGGGAAACCCAA', 'GGGCGCAAGCCU']
+
+@pytest.fixture
+def rnafold():
+    try:
+        LOC = locate('vienna_2')
+    except RuntimeError:
+        pytest.skip('vienna_2 is not configured')
+    if not os.access(os.path.join(LOC, 'RNAfold'), os.X_OK):
+        pytest.skip('no RNAfold in %s' % LOC)
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    for module in [arnie.pfunc, arnie.mfe, pool]:
+        monkeypatch.setattr(module, 'scratch_dir', lambda: str(tmp_path))
+    monkeypatch.setattr(arnie.pfunc, 'locate', lambda package: '/opt/%s/bin' % package)
+    monkeypatch.setattr(arnie.mfe, 'locate', lambda package: '/opt/%s/bin' % package)
+    return str(tmp_path)
+
+def test_split_records():
+    stdout = '>a_0001\nGGGAAACCC\n(((...))) ( -1.20)\n\n>a_0002 extra\nAAAA\n.... (  0.00)\nfree energy of ensemble = -0.10 kcal/mol\n'
+    records = split_vienna_records(stdout)
+    assert [record_id for record_id, _ in records] == ['a_0001', 'a_0002']
+    assert records[0][1] == ['GGGAAACCC', '(((...))) ( -1.20)']
+    assert len(records[1][1]) == 3
+    assert split_vienna_records('') == []
+
+def test_ensemble_energy():
+    assert parse_vienna_ensemble_energy('GGGAAACCC\n(((...))) ( -1.20)\n(((...))) [ -1.57]\n') == -1.57
+    assert parse_vienna_ensemble_energy('((.....)) [-10.25]') == -10.25
+    assert parse_vienna_ensemble_energy(' free energy of ensemble =  -0.81 kcal/mol') == -0.81
+    assert parse_vienna_ensemble_energy('(((...))) ( -1.20)') is None
+
+def test_records_input():
+    assert vienna_records_input(['GGG', 'AAAA']) == 'GGG\nAAAA\n'
+    assert vienna_records_input(['GGG', 'AAAA'], [None, 'x..x']) == 'GGG\n...\nAAAA\nx..x\n'
+
+def test_pfunc_command(scratch):
+    command, stdin, dot_plot = pfunc_vienna_command_('GGGAAACCC', T=24)
+    assert command[:4] == ['/opt/vienna_2/bin/RNAfold', '-T', '24', '-p0']
+    assert '--noPS' in command and '-C' not in command
+    assert stdin == 'GGGAAACCC\n' and dot_plot is None
+
+    command, stdin, dot_plot = pfunc_vienna_command_('GGGAAACCC', bpps=True, constraint='(.......)', dangles=False,
+        param_file='rna.par')
+    assert '-p' in command and '-p0' not in command
+    assert all(x in command for x in ['-C', '--enforceConstraint', '--dangles=0', '--paramFile=rna.par'])
+    prefix = [x for x in command if x.startswith('--id-prefix=')][0].split('=')[1]
+    assert stdin == 'GGGAAACCC\n(.......)\n'
+    # the dot plot is written into the scratch dir, which the command runs in
+    assert dot_plot == '%s/%s_0001_dp.ps' % (scratch, prefix)
+
+def test_mfe_command(scratch):
+    command, stdin = mfe_vienna_command_('GGGAAACCC', constraint='x........')
+    assert command[:4] == ['/opt/vienna_2/bin/RNAfold', '-T', '37', '-p0']
+    assert all(x in command for x in ['--noPS', '-C', '--enforceConstraint'])
+    assert stdin == 'GGGAAACCC\nx........\n'
+
+def test_pfunc_batch(rnafold):
+    singly = [pfunc(seq, package='vienna_2', return_free_energy=True) for seq in SEQS]
+    assert np.allclose(pfunc_batch(SEQS, package='vienna_2', return_free_energy=True), singly)
+    assert pfunc_batch([], package='vienna_2') == []
+    with pytest.raises(ValueError):
+        pfunc_batch(SEQS, package='vienna_2', constraints=[None])
+
+def test_pfunc_batch_constraints(rnafold):
+    constraints = ['x'*4 + '.'*(len(SEQS[0])-4), None, '(' + '.'*(len(SEQS[2])-2) + ')']
+    singly = [pfunc(seq, package='vienna_2', constraint=c) for seq, c in zip(SEQS, constraints)]
+    assert np.allclose(pfunc_batch(SEQS, package='vienna_2', constraints=constraints), singly)
+
+    # forcing a C-C pair: the batch refolds singly and marks only the impossible one
+    impossible = ['(' + '.'*(len(SEQS[0])-2) + ')', None, '.'*5 + '(' + '.'*4 + ')' + '.']
+    assert SEQS[2][5] + SEQS[2][10] == 'CC'
+    Z = pfunc_batch(SEQS, package='vienna_2', constraints=impossible)
+    assert np.isfinite(Z[0]) and np.isclose(Z[1], pfunc(SEQS[1], package='vienna_2'))
+    assert Z[2] == 0
+
+def test_mfe_batch(rnafold):
+    assert mfe_batch(SEQS, package='vienna_2') == [mfe(seq, package='vienna_2') for seq in SEQS]
+    with pytest.raises(ValueError, match='impossible'):
+        mfe_batch(SEQS, package='vienna_2', constraints=[None, None, '.'*5 + '(' + '.'*4 + ')' + '.'])
+
+def test_bpps_batch(rnafold):
+    matrices = bpps_batch(SEQS, package='vienna_2')
+    for seq, matrix in zip(SEQS, matrices):
+        assert np.allclose(matrix, bpps(seq, package='vienna_2'), atol=1e-6)
+    sparse = bpps_batch(SEQS, package='vienna_2', sparse=True)
+    assert np.allclose(sparse[1].toarray(), matrices[1], atol=1e-6)
+    # each record's dot plot is read and removed
+    assert not [f for f in os.listdir(scratch_dir()) if f.endswith('_dp.ps')]
+
+def test_pool(rnafold):
+    pool.enable_pool()
+    try:
+        for seq in SEQS:
+            result = pool.fold(seq, 'pfunc')
+            assert np.isclose(parse_vienna_ensemble_energy('\n'.join(result['lines'])), pfunc(seq, package='vienna_2', return_free_energy=True))
+            assert result['dot_plot'] is None
+        result = pool.fold(SEQS[0], 'bpps')
+        assert os.path.exists(result['dot_plot'])
+        assert pool.fold(SEQS[2], 'pfunc', constraint='.'*5 + '(' + '.'*4 + ')' + '.')['omitted']
+
+        # a crashed worker is restarted and the call answered
+        worker = pool._pool[(locate('vienna_2'), 'pfunc', 37, True, None, None)][0]
+        worker.proc.kill()
+        worker.proc.wait()
+        assert pool.fold(SEQS[1], 'pfunc')['lines'][0] == SEQS[1]
+    finally:
+        pool.disable_pool()
+    assert not os.path.exists(worker.workdir)
+
+def stub_rnafold(path, script):
+    os.makedirs(path)
+    fname = os.path.join(path, 'RNAfold')
+    with open(fname, 'w') as f:
+        f.write('#!/bin/sh\n' + script)
+    os.chmod(fname, os.stat(fname).st_mode | stat.S_IEXEC)
+    return path
+
+def test_worker_command(scratch):
+    LOC = stub_rnafold(os.path.join(scratch, 'bin'), 'cat > /dev/null\n')
+    for mode, flags in [('mfe', ['--noPS']), ('pfunc', ['-p0', '--noPS']), ('bpps', ['-p'])]:
+        worker = pool.ViennaWorker(LOC, mode=mode, T=24, dangles=False, param_file='rna.par')
+        command = worker.command[worker.command.index('%s/RNAfold' % LOC):]
+        assert command[:5] == ['%s/RNAfold' % LOC, '-T', '24', '-C', '--enforceConstraint']
+        assert all(x in command for x in flags + ['--dangles=0', '--paramFile=rna.par'])
+        assert '--noPS' not in command if mode == 'bpps' else '-p' not in command
+        assert os.path.dirname(worker.workdir) == scratch
+        worker.stop()
+        assert not os.path.exists(worker.workdir)
+
+def test_worker_timeout(scratch, monkeypatch):
+    # reads the record but never answers
+    LOC = stub_rnafold(os.path.join(scratch, 'bin'), 'exec sleep 60\n')
+    monkeypatch.setattr(pool, 'TIMEOUT', 0.2)
+    worker = pool.ViennaWorker(LOC)
+    with pytest.raises(TimeoutError):
+        worker.fold('GGGAAACCC')
+    worker.stop()
+
+def test_worker_out_of_sync(scratch):
+    LOC = stub_rnafold(os.path.join(scratch, 'bin'), 'read seq; read constraint; printf ">other_0001\\n$seq\\n"; exec sleep 60\n')
+    worker = pool.ViennaWorker(LOC)
+    with pytest.raises(RuntimeError, match='out of sync'):
+        worker.fold('GGGAAACCC')
+    worker.stop()
+
+def test_worker_exits(scratch, monkeypatch):
+    LOC = stub_rnafold(os.path.join(scratch, 'bin'), 'exit 1\n')
+    monkeypatch.setattr(pool, 'locate', lambda package: LOC)
+    pool.enable_pool()
+    try:
+        # restarted once, then the failure is reported
+        with pytest.raises(Exception, match='RNAfold failed'):
+            pool.fold('GGGAAACCC', 'mfe')
+    finally:
+        pool.disable_pool()
@@ -1,8 +1,14 @@
-import os, re
+import os, re, shutil, tempfile, atexit
+import multiprocessing.util
 import subprocess as sp
 import random, string
 import numpy as np
-import arnie
+from . import config
+from .structures import *
+from .sparse import SparseBPPs
+
+# version each package runs when none is given; the backends and the cache keys both read this
+DEFAULT_VERSIONS = {'vienna': '2', 'contrafold': '2', 'nupack': '95', 'rnasoft': 'blstar', 'vfold': '0', 'arnie': 'np'}
 
 def write_vector_to_file(vector, outfile):
   for x in vector:
@@ -14,51 +20,90 @@ def write_matrix_to_file(matrix, outfile):
     outfile.write('\t'.join(['%.3f' % y for y in x])+'\n')
   return
 
+MATRIX_LAYOUTS = ['dense', 'triu', 'sparse']
+
+def write_matrix(matrix, fname, layout='dense', dtype=None, threshold=0):
+  '''Write a symmetric base pair probability matrix (or SparseBPPs) to fname, by extension:
+    .npy: dense NxN array, or for layout='triu' the N(N-1)/2 values above the diagonal, row by row
+    .npz: any layout, compressed, with the layout and N stored alongside
+    anything else: '%.3f' text rows as write_matrix_to_file (dense only)
+
+  Args:
+    layout: 'dense', 'triu' or 'sparse' (i, j, p triples of the pairs above threshold)
+    dtype: stored float type, e.g. np.float16 or np.float32; default keeps the matrix's
+  Read back with load_matrix.
+  '''
+  if layout not in MATRIX_LAYOUTS:
+    raise ValueError('layout %s not understood, use one of %s' % (layout, ', '.join(MATRIX_LAYOUTS)))
+  ext = os.path.splitext(fname)[1].lower()
+
+  if layout == 'sparse':
+    if ext != '.npz':
+      raise ValueError('sparse triples are written to .npz files, not %s' % fname)
+    if not isinstance(matrix, SparseBPPs):
+      matrix = SparseBPPs.from_dense(matrix, threshold=threshold)
+    elif threshold > 0:
+      matrix = matrix.threshold(threshold)
+    p = matrix.p if dtype is None else matrix.p.astype(dtype)
+    np.savez_compressed(fname, layout=layout, N=matrix.N, i=matrix.i, j=matrix.j, p=p)
+    return
+
+  matrix = np.asarray(matrix)
+  if dtype is not None:
+    matrix = matrix.astype(dtype)
+  values = matrix[np.triu_indices(matrix.shape[0], k=1)] if layout == 'triu' else matrix
+
+  if ext == '.npy':
+    np.save(fname, values)
+  elif ext == '.npz':
+    np.savez_compressed(fname, layout=layout, N=matrix.shape[0], values=values)
+  elif layout == 'dense':
+    with open(fname, 'w') as f:
+      write_matrix_to_file(matrix, f)
+  else:
+    raise ValueError('%s layout needs a .npy or .npz file, not %s' % (layout, fname))
+
+def load_matrix(fname, sparse=False):
+  '''Base pair probability matrix written by write_matrix (or write_matrix_to_file / np.savetxt text).
+
+  Returns
+    symmetric NxN float64 array, or SparseBPPs if sparse
+  '''
+  ext = os.path.splitext(fname)[1].lower()
+  if ext == '.npz':
+    with np.load(fname) as data:
+      layout, N = str(data['layout']), int(data['N'])
+      if layout == 'sparse':
+        matrix = SparseBPPs(data['i'], data['j'], data['p'], N)
+        return matrix if sparse else matrix.toarray()
+      values = data['values']
+  elif ext == '.npy':
+    values = np.load(fname)
+    layout = 'triu' if values.ndim == 1 else 'dense'
+    N = int(round((1 + np.sqrt(1 + 8*len(values)))/2)) if layout == 'triu' else len(values)
+  else:
+    values, layout = np.loadtxt(fname, ndmin=2), 'dense'
+
+  if layout == 'triu':
+    i, j = np.triu_indices(N, k=1)
+    matrix = np.zeros([N, N])
+    matrix[i, j] = matrix[j, i] = values
+  else:
+    matrix = np.asarray(values, dtype=np.float64)
+  return SparseBPPs.from_dense(matrix) if sparse else matrix
+
 def complement_to_(string):
         base_pairing_dct = {'a':'u', 'u':'a', 'g':'c', 'c':'g','t':'a'}
         return ''.join(base_pairing_dct[x.lower()] for x in string[::-1])
 
 def convert_dotbracket_to_bp_list(s, allow_pseudoknots=False):
-    m = {}
-    bp1=[]
-    bp2=[]
-    bp1_pk=[]
-    bp2_pk=[]
-    for i, char in enumerate(s):
-        if char=='(':
-            bp1.append(i)
-        if char==')':
-            bp2.append(i)
-        if allow_pseudoknots:
-            if char=='[':
-              bp1_pk.append(i)
-            if char==']':
-              bp2_pk.append(i)
-
-    for i in list(reversed(bp1)):
-        for j in bp2:
-            if j > i:
-                m[i]=j
-                m[j]=i
-
-                bp2.remove(j)
-                break
-    for i in list(reversed(bp1_pk)):
-        for j in bp2_pk:
-            if j > i:
-                m[i]=j
-                m[j]=i
-
-                bp2_pk.remove(j)
-                break
-    return m
+  # only () (and [] for pseudoknots): constraint strings use other characters, e.g. vienna's < >
+  partners = convert_dotbracket_to_partners(s, brackets=['()', '[]'] if allow_pseudoknots else ['()'])
+  return {int(i): int(j) for i, j in enumerate(partners) if j >= 0}
 
 def convert_dotbracket_to_matrix(s, allow_pseudoknots=False):
-  matrix=np.zeros([len(s),len(s)])
-  bp_list = convert_dotbracket_to_bp_list(s, allow_pseudoknots=allow_pseudoknots)
-  for k,v in bp_list.items():
-    matrix[k,v] = 1
-  return matrix
+  partners = convert_dotbracket_to_partners(s, brackets=['()', '[]'] if allow_pseudoknots else ['()'])
+  return convert_partners_to_matrix(partners)
 
 
 def convert_dbn_to_RNAstructure_input(seq, constraints, filename):
@@ -275,7 +320,7 @@ def combo_list_to_dbn_list(seq, final_combo_list, apt_idx_list, apt_ss_list):
     dbn_string_list.append(dbn_string)
   return dbn_string_list
 
-def write_combo_constraints(seq, raw_apt_seq, raw_apt_ss, verbose=False):
+def write_combo_constraints(seq, raw_apt_seq, raw_apt_ss, verbose=False, max_constraints=None, n_samples=None, seed=None):
   """ Given a sequence, get all possible secondary constraints of the aptamer 
 
   Args:
@@ -289,6 +334,9 @@ def write_combo_constraints(seq, raw_apt_seq, raw_apt_ss, verbose=False):
       x denotes unpaired base
       . denotes wildcard (can be anything)
     verbose: to be verbose
+    max_constraints: stop after this many constraints
+    n_samples: instead, a uniform random sample of this many constraints (all if fewer)
+    seed: seed for n_samples
   Returns
     list of all possible dbn_string for the given aptamer
   """
@@ -297,49 +345,123 @@ def write_combo_constraints(seq, raw_apt_seq, raw_apt_ss, verbose=False):
     print(seq)
     print(raw_apt_seq)
     print(raw_apt_ss)
-  # split everything by +
+
+  if n_samples is not None:
+    return sample_combo_constraints(seq, raw_apt_seq, raw_apt_ss, n_samples, seed=seed)
+
+  # List will be empty if nothing can be in order (only for >= 3 fragments)
+  return list(iter_combo_constraints(seq, raw_apt_seq, raw_apt_ss, max_constraints=max_constraints))
+
+def iter_combo_constraints(seq, raw_apt_seq, raw_apt_ss, max_constraints=None):
+  """ Lazily yield the dbn strings of `write_combo_constraints`, in the same order
+
+  Args:
+    max_constraints: stop after this many
+  """
+  apt_ss_list = raw_apt_ss.split('+')
+  for k, spans in enumerate(iter_combo_placements(seq, raw_apt_seq, raw_apt_ss)):
+    if max_constraints is not None and k >= max_constraints:
+      return
+    yield combo_to_dbn_(seq, spans, apt_ss_list)
+
+def sample_combo_constraints(seq, raw_apt_seq, raw_apt_ss, n_samples, seed=None):
+  """ Uniform random sample of n_samples dbn strings of `write_combo_constraints`
+  (reservoir sampling over the lazy enumeration), in enumeration order
+  """
+  rng = np.random.default_rng(seed)
+  apt_ss_list = raw_apt_ss.split('+')
+  reservoir = []
+  for k, spans in enumerate(iter_combo_placements(seq, raw_apt_seq, raw_apt_ss)):
+    if k < n_samples:
+      reservoir.append((k, spans))
+    else:
+      r = rng.integers(0, k+1)
+      if r < n_samples:
+        reservoir[r] = (k, spans)
+  return [combo_to_dbn_(seq, spans, apt_ss_list) for _, spans in sorted(reservoir)]
+
+def combo_to_dbn_(seq, spans, apt_ss_list):
+  """ dbn string of one placement of the aptamer fragments, flipped if the aptamer is backwards """
+  dbn_string = ['.']*len(seq)
+  for (start, finish), apt_ss in zip(spans, apt_ss_list):
+    dbn_string[start:finish] = list(apt_ss)
+  dbn_string = ''.join(dbn_string)
+
+  # Check if aptamer is flipped
+  if spans[0][0] > spans[-1][0]:
+    dbn_string = flip_ss(dbn_string)
+  return dbn_string
+
+def iter_combo_placements(seq, raw_apt_seq, raw_apt_ss):
+  """ Depth-first walk over placements of the aptamer fragments in seq, pruned as it goes
+
+  One fragment is placed at a time, only at positions that keep the fragments placed so far
+  feasible (as in prune_combo_list): with 2 fragments, different starts; with 3 or more,
+  starts all increasing or all decreasing, each fragment clear of the next. The work scales
+  with the feasible placements, not the product of all fragment positions.
+
+  Yields
+    tuple of (start, finish) per fragment, in the order write_combo_constraints always listed them
+  """
   apt_seq_list = raw_apt_seq.split('+')
   apt_ss_list = raw_apt_ss.split('+')
   if len(apt_seq_list) != len(apt_ss_list):
     raise ValueError('Missing + in aptamer sequence or secondary structure')
 
-  # Iterate through each aptamer fragment and save its idx,
-  apt_idx_list = []
+  # Iterate through each aptamer fragment and save all its locations
+  spans = []
   for idx, (apt_seq, apt_ss) in enumerate(zip(apt_seq_list, apt_ss_list)):
     if seq.find(apt_seq) == -1:
       raise ValueError("Aptamer segment {} not found".format(idx+1))
     if len(apt_seq) != len(apt_ss):
       raise ValueError("Mismatch between aptamer sequence and aptamer secondary structure")
-
-    # Save all locations of each fragment
-    for m in re.finditer(apt_seq, seq):
-      #Note: cannot get overlapping segments
-      span = m.span()
-      start = span[0]
-      finish = span[1]
-      ss_length = len(apt_seq)
-      apt_idx_list.append([idx, start, finish, ss_length])
-  apt_idx_list = np.array(apt_idx_list)
-
-  # Now combine aptamer fragments into full secondary structure constraints
-  N_frag = len(apt_ss_list) # Number of fragments to stitch together
-
-  # Get a list of all possible combination (each combination is a list as well)
-  temp = np.array([np.where(apt_idx_list[:,0] == idx)[0] for idx in range(N_frag)])
-  if len(temp) > 1:
-    combo = np.meshgrid(*temp)
-    combo_list = np.array(combo).T.reshape(-1,N_frag) # reformat the combinations
-  else:
-    combo_list = np.array([[x] for x in temp[0]])
-
-  # Check each combination to make sure it's feasible, if not remove
-  final_combo_list = prune_combo_list(combo_list, apt_idx_list, N_frag)
-  
-  # Convert each combination into a dbn_string
-  dbn_list = combo_list_to_dbn_list(seq, final_combo_list, apt_idx_list, apt_ss_list)
-  
-  # List will be empty if nothing can be in order (only for >= 3 fragments)
-  return dbn_list
+    #Note: cannot get overlapping segments
+    spans.append([m.span() for m in re.finditer(apt_seq, seq)])
+
+  N_frag = len(spans) # Number of fragments to stitch together
+  starts = [np.array([start for start, _ in x]) for x in spans]
+  lengths = [len(x) for x in apt_seq_list]
+
+  # fragment placed at each depth; this nesting reproduces the old meshgrid order
+  order = list(range(N_frag-1, 1, -1)) + [0, 1] if N_frag > 1 else [0]
+
+  def feasible(f, chosen, direction):
+    s = starts[f]
+    ok = np.ones(len(s), dtype=bool)
+    if N_frag == 2:
+      if 1-f in chosen:
+        ok &= s != chosen[1-f]
+      return np.flatnonzero(ok)
+    increasing, decreasing = ok.copy(), ok.copy()
+    for g in [f-1, f+1]:
+      if g in chosen:
+        lo, hi = min(f, g), max(f, g)
+        dx = (chosen[hi] - s) if lo == f else (s - chosen[lo])
+        increasing &= dx >= lengths[lo]
+        decreasing &= -dx >= lengths[hi]
+    if direction > 0:
+      return np.flatnonzero(increasing)
+    if direction < 0:
+      return np.flatnonzero(decreasing)
+    return np.flatnonzero(increasing | decreasing)
+
+  def walk(depth, chosen, direction):
+    if depth == N_frag:
+      yield tuple(spans[f][chosen_idx[f]] for f in range(N_frag))
+      return
+    f = order[depth]
+    for k in feasible(f, chosen, direction):
+      chosen[f], chosen_idx[f] = starts[f][k], k
+      new_direction = direction
+      if N_frag > 2 and direction == 0:
+        for g in [f-1, f+1]:
+          if g in chosen and g != f:
+            new_direction = 1 if chosen[max(f, g)] > chosen[min(f, g)] else -1
+      yield from walk(depth+1, chosen, new_direction)
+      del chosen[f], chosen_idx[f]
+
+  chosen_idx = {}
+  yield from walk(0, {}, 0)
 
 def get_missing_motif_bases(seq):
   FMN_apt1='AGGAUAU'
@@ -360,15 +482,48 @@ def local_rand_filename(n=6):
   rand = ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
   return rand
 
+_scratch_dirs = {}
+
+def scratch_dir():
+  """per-process directory for the files that some binaries insist on
+
+  Created on first use and removed at exit. Lives under SCRATCH from the arnie
+  file if given, else on tmpfs (/dev/shm) where available, else under TMP.
+  Keyed by pid, so forked workers get their own directory.
+  """
+  pid = os.getpid()
+  if pid not in _scratch_dirs:
+    package_dct = config.locations()
+    if package_dct.get('SCRATCH', 'None') != 'None':
+      base = package_dct['SCRATCH']
+    elif os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+      base = '/dev/shm'
+    else:
+      base = package_dct['TMP']
+    _scratch_dirs[pid] = tempfile.mkdtemp(prefix='arnie_%d_' % pid, dir=base)
+    atexit.register(_remove_scratch_dir, pid)
+    # multiprocessing workers leave through os._exit and skip atexit, but do run these
+    multiprocessing.util.Finalize(None, _remove_scratch_dir, args=(pid,), exitpriority=0)
+  return _scratch_dirs[pid]
+
+def _remove_scratch_dir(pid):
+  if pid == os.getpid() and pid in _scratch_dirs:
+    shutil.rmtree(_scratch_dirs.pop(pid), ignore_errors=True)
+
 def filename(n=6):
-  """generate random filename
+  """generate random filename in the scratch directory
 
   Args:
     n (int): number of characters
   """
   rand = ''.join([random.choice(string.ascii_lowercase) for _ in range(n)])
-  tmpdir = load_package_locations()['TMP']
-  return '%s/%s' % (tmpdir, rand)
+  return '%s/%s' % (scratch_dir(), rand)
+
+def remove_files(*fnames):
+  """remove temporary files, skipping None and files already gone"""
+  for fname in fnames:
+    if fname and os.path.exists(fname):
+      os.remove(fname)
 
 def write(lines, fname=None):
   """write lines to file
@@ -384,30 +539,77 @@ def write(lines, fname=None):
       f.write('%s\n' % line)
   return fname
 
+def vienna_records_input(seqs, constraints=None):
+  """format many sequences as one multi-record Vienna stdin stream
+
+  Args:
+    seqs (list): nucleic acid sequences
+    constraints (list): constraint string (or None) per sequence. If given, every
+      record gets a constraint line, unconstrained records an all-'.' one, so that
+      a single `-C` invocation can read them all.
+  Returns:
+    str
+  """
+  lines = []
+  for i, seq in enumerate(seqs):
+    lines.append(seq)
+    if constraints is not None:
+      if constraints[i] is None:
+        lines.append('.'*len(seq))
+      else:
+        lines.append(constraints[i])
+  return ''.join(['%s\n' % line for line in lines])
+
+def split_vienna_records(stdout):
+  """split multi-record Vienna stdout into per-record blocks
+
+  Args:
+    stdout (str): decoded stdout of e.g. `RNAfold --id-prefix=...`
+  Returns:
+    list of (record id, list of output lines), in output order
+  """
+  records = []
+  for line in stdout.split('\n'):
+    if line.startswith('>'):
+      records.append((line[1:].split()[0], []))
+    elif records and line.strip():
+      records[-1][1].append(line)
+  return records
+
+def parse_vienna_ensemble_energy(text):
+  """read the ensemble free energy from RNAfold output
+
+  Handles both the `-p` form (`<struct> [ -1.23]`) and the `-p0` form
+  (` free energy of ensemble = -1.23 kcal/mol`).
+
+  Returns:
+    float, or None if no ensemble energy is present
+  """
+  m = re.search('([,|\(\.\)\]\[\{\}]+)\s+\[\s*(-*[0-9]+\.[0-9]+)', text)
+  if m:
+    return float(m.group(2))
+  m = re.search('free energy of ensemble\s*=\s*(-*[0-9]+\.[0-9]+)', text)
+  if m:
+    return float(m.group(1))
+  return None
+
 def print_available_packages():
   package_dct = load_package_locations()
   for key,v in package_dct.items():
-    if key != "TMP":
+    if key not in config.SETTINGS:
       print(key,v)
 
 def package_list():
   pkg_list=[]
   package_dct = load_package_locations()
   for key,v in package_dct.items():
-    if key != "TMP":
+    if key not in config.SETTINGS:
       if v != "None":
         pkg_list.append(key)
   return pkg_list
 
 def load_package_locations():
-    '''Read in user-supplied file to specify paths to RNA folding packages. Specify this in your ~/.bashrc as $ARNIEFILE'''
-    return_dct={}
-    package_path = os.path.dirname(arnie.__file__)
-    with open("%s" % os.environ["ARNIEFILE"],'r') as f:
-        for line in f.readlines():
-            if line.strip():
-              if not line.startswith('#'):
-                key, string = line.split(':')
-                string = string.strip()
-                return_dct[key] = string
-    return return_dct
+    '''Read in user-supplied file to specify paths to RNA folding packages. Specify this in your ~/.bashrc as $ARNIEFILE
+
+    The file is only parsed once; see `config.reload()` and `config.configure()`.'''
+    return dict(config.locations())